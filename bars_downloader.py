@@ -3,6 +3,7 @@ Main module for start
 """
 
 import logging
+import multiprocessing
 
 from bars_provider import __version__
 from bars_provider.downloads import Downloads
@@ -10,6 +11,7 @@ from bars_provider.log import logger, setup_logging
 
 
 if __name__ == '__main__':
+  multiprocessing.freeze_support()  # processes of SHARDING in the frozen executable
   logger.setLevel(logging.DEBUG)
   setup_logging()
   logger.info(__version__)
@@ -1,3 +1,31 @@
-from .finam import FinamProvider
-from .quotemedia import QuotemediaProvider
-__version__ = '1.2.1'
\ No newline at end of file
+from importlib import import_module
+import sys
+from types import ModuleType
+
+from .registry import BUILTIN
+
+__version__ = '1.2.1'
+
+
+#######################################################################
+class _Package(ModuleType):
+  """
+  The package imports the provider class (FinamProvider, QuotemediaProvider) on the first access;
+  it's the class of the module because the module-level __getattr__ needs Python 3.7.
+  """
+
+  #----------------------------------------------------------------------
+  def __getattr__(self, name):
+    module = BUILTIN.get(name)
+    if module is None:
+      raise AttributeError("module '{0}' has no attribute '{1}'".format(self.__name__, name))
+    value = getattr(import_module(module), name)
+    setattr(self, name, value)
+    return value
+
+  #----------------------------------------------------------------------
+  def __dir__(self):
+    return sorted(set(self.__dict__) | set(BUILTIN))
+
+
+sys.modules[__name__].__class__ = _Package
@@ -0,0 +1,160 @@
+"""
+Helpers of the asyncio API: non-blocking HTTP sessions (aiohttp is optional)
+and adapters of blocking code to the event loop.
+"""
+
+import asyncio
+from functools import partial
+from time import monotonic
+from importlib.util import find_spec
+from urllib.parse import urlsplit
+
+from .common import Sessions
+from .log import logger
+from .metrics import Metrics
+from .ratelimit import retry_after
+from .singleton import Singleton
+
+aiohttp = None  # it's imported by the first non-blocking request
+
+
+__all__ = ["AsyncSessions", "aiter_response_lines", "aiter_blocks", "aclip_blocks", "run_sync", "iterate_sync"]
+
+
+#----------------------------------------------------------------------
+def _aiohttp():
+  global aiohttp
+  if aiohttp is None:
+    import aiohttp
+  return aiohttp
+#----------------------------------------------------------------------
+async def run_sync(fn, *args):
+  """ Calls blocking <fn> in the default executor of the loop. """
+  return await asyncio.get_event_loop().run_in_executor(None, fn, *args)
+#----------------------------------------------------------------------
+async def iterate_sync(iterable):
+  """ Yields items of blocking <iterable> which are taken in the default executor one by one. """
+  it = await run_sync(iter, iterable)
+  done = object()
+  while True:
+    item = await run_sync(next, it, done)
+    if item is done:
+      return
+    yield item
+#----------------------------------------------------------------------
+async def aiter_response_lines(response):
+  """ Yields decoded lines while the body is being received; releases the response at the end. """
+  size = 0
+  try:
+    async for line in response.content:
+      size += len(line)
+      yield line.rstrip(b'\r\n').decode('utf-8', "ignore")
+  finally:
+    response.release()
+    Metrics().inc('bars_http_bytes_total', size, host=urlsplit(str(response.url)).netloc)
+#----------------------------------------------------------------------
+async def aiter_blocks(parse, lines, ticker, period, size=10000):
+  """ The same as parsing.iter_blocks() for the async iterable of lines. """
+  span = partial(Metrics().span, 'parse', ticker.provider.__class__.__name__, ticker.symbol)
+  chunk = []
+  async for line in lines:
+    chunk.append(line)
+    if len(chunk) >= size:
+      with span():
+        block = parse(chunk, ticker, period)
+      yield block
+      chunk = []
+  if chunk:
+    with span():
+      block = parse(chunk, ticker, period)
+    yield block
+
+#----------------------------------------------------------------------
+async def aclip_blocks(blocks, start, end, include_end=True):
+  """ The same as parsing.clip_blocks() for the async iterable of blocks. """
+  async for block in blocks:
+    lo, hi = block.between(start, end, include_end)
+    if hi > lo:
+      yield block if hi - lo == len(block) else block[lo:hi]
+    if hi < len(block):
+      return  # the rest is after the end
+
+
+#######################################################################
+class AsyncSessions(object, metaclass=Singleton):
+  """
+  aiohttp sessions of the running event loop, one per host.
+  Pool size and retries are taken from Sessions, requests go through the same rate limiters.
+  """
+  available = find_spec('aiohttp') is not None
+  RETRY_STATUSES = (500, 502, 504)
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._sessions = {}  # (loop, host) -> aiohttp.ClientSession
+
+  #----------------------------------------------------------------------
+  def session(self, url):
+    key = (asyncio.get_event_loop(), urlsplit(url).netloc)
+    sess = self._sessions.get(key)
+    if sess is None or sess.closed:
+      client = _aiohttp()
+      sess = client.ClientSession(connector=client.TCPConnector(limit_per_host=Sessions().pool_size))
+      self._sessions[key] = sess
+    return sess
+
+  #----------------------------------------------------------------------
+  async def get(self, url, **kwargs):
+    """
+    Requests <url> when its host allows it; returns the response with a not read body.
+    Throttled requests (429, 503) and server errors are repeated up to <retries> times.
+    """
+    if not self.available:
+      raise ImportError('aiohttp is required for the non-blocking requests')
+    _aiohttp()  # for its exceptions
+    metrics, host = Metrics(), urlsplit(url).netloc
+    limiter = Sessions().limiter(url)
+    retries, backoff_factor = Sessions().retries, Sessions().backoff_factor
+    for attempt in range(retries + 1):
+      waited = 0.0
+      while True:
+        delay = limiter.reserve(waited)
+        if not delay:
+          break
+        await asyncio.sleep(delay)
+        waited += delay
+      started = monotonic()
+      try:
+        response = await self.session(url).get(url, **kwargs)
+      except aiohttp.ClientConnectionError as e:
+        if attempt == retries:
+          metrics.inc('bars_http_failures_total', host=host, error=e.__class__.__name__)
+          raise
+        metrics.inc('bars_http_retries_total', host=host, reason='error')
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+        continue
+      metrics.observe('bars_http_seconds', monotonic() - started, host=host)
+      if response.status in Sessions.THROTTLE_STATUSES:
+        response.release()
+        if attempt < retries:
+          metrics.inc('bars_http_retries_total', host=host, reason='throttled')
+        limiter.throttle(retry_after(response.headers.get('Retry-After')))
+        logger.warning('{0}: throttled ({1}), rate: {2:.3f}/s'.format(host, response.status, limiter.rate))
+      elif response.status in self.RETRY_STATUSES and attempt < retries:
+        response.release()
+        metrics.inc('bars_http_retries_total', host=host, reason='error')
+        await asyncio.sleep(backoff_factor * (2 ** attempt))
+      else:
+        limiter.success(monotonic() - started)
+        break
+    if response.status >= 400:
+      metrics.inc('bars_http_failures_total', host=host, error='HTTP{0}'.format(response.status))
+    response.raise_for_status()
+    return response
+
+  #----------------------------------------------------------------------
+  async def close(self):
+    """ Closes sessions of the running loop. """
+    loop = asyncio.get_event_loop()
+    for key in [key for key in self._sessions if key[0] is loop]:
+      await self._sessions.pop(key).close()
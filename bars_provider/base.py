@@ -2,9 +2,40 @@
 Common types for providers.
 """
 
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime, date, time, timedelta
 from functools import partial
-from inspect import signature
+from inspect import getattr_static, signature
+from itertools import islice
+from types import FunctionType
+
+numpy = None  # it's imported by the first use (see load_numpy()), False without NumPy
+
+
+EPOCH = datetime(1970, 1, 1)
+_EPOCH_ORDINAL = EPOCH.toordinal()
+NONE = -2 ** 63  # stored instead of absent volume or interest
+
+
+#----------------------------------------------------------------------
+def load_numpy():
+  """ Returns the numpy module or None if it isn't installed; it's slow to import, so it's imported by the first use. """
+  global numpy
+  if numpy is None:
+    try:
+      import numpy as module
+    except ImportError:
+      module = False
+    numpy = module
+  return numpy or None
+#----------------------------------------------------------------------
+def to_epoch(stamp):
+  """ Naive datetime to integer seconds since 1970-01-01 (without any timezone shift). """
+  return (stamp.toordinal() - _EPOCH_ORDINAL) * 86400 + stamp.hour * 3600 + stamp.minute * 60 + stamp.second
+#----------------------------------------------------------------------
+def from_epoch(seconds):
+  return EPOCH + timedelta(seconds=seconds)
 
 
 ########################################################################
@@ -67,18 +98,61 @@ class InvalidDataFormatError(DataError):
 
 #######################################################################
 class Ticker(object):
-  """ Stock symbol."""
-  __slots__ = ("provider", "symbol", "data")
+  """
+  Stock symbol.
+  Provider's methods with the 'ticker' argument are called through it without this argument,
+  e.g. ticker.get_bars(delta); other attributes of the provider are returned as they are.
+  """
+  __slots__ = ("provider", "symbol", "data", "_bound")
+  # (provider class, name) -> True if the method of the class takes 'ticker', False for other methods
+  _methods = {}
 
   #----------------------------------------------------------------------
   def __init__(self, provider, symbol, **data):
     self.provider = provider      
     self.symbol = symbol
     self.data = data
+    self._bound = None  # name -> (provider, method bound to the ticker)
+
+  #----------------------------------------------------------------------
+  @classmethod
+  def _takes_ticker(cls, provider, name):
+    """
+    Returns True/False for methods defined in the provider's class (it's cached for the class)
+    or None for other attributes (instance's ones or made by __getattr__), which are checked every time.
+    """
+    key = (provider.__class__, name)
+    try:
+      return cls._methods[key]
+    except KeyError:
+      pass
+    if not isinstance(getattr_static(provider.__class__, name, None), (FunctionType, staticmethod, classmethod)):
+      return None
+    try:
+      result = 'ticker' in signature(getattr(provider, name)).parameters
+    except (TypeError, ValueError):
+      result = False
+    cls._methods[key] = result
+    return result
 
   #----------------------------------------------------------------------
   def __getattr__(self, name):
-    attr = getattr(self.provider, name)
+    provider = self.provider
+    bound = self._bound
+    if bound is not None and name in bound:
+      owner, method = bound[name]
+      if owner is provider:  # the provider can be replaced
+        return method
+    takes = self._takes_ticker(provider, name) if provider is not None else None
+    if takes is not None and name not in getattr(provider, '__dict__', ()):
+      attr = getattr(provider, name)
+      if takes:
+        attr = partial(attr, self)
+        if bound is None:
+          bound = self._bound = {}
+        bound[name] = (provider, attr)
+      return attr
+    attr = getattr(provider, name)
     try:
       if 'ticker' in signature(attr).parameters:
         attr = partial(attr, self)
@@ -112,7 +186,7 @@ class Bar(object):
                interest=None,):
     self.ticker = ticker
     self.timestamp = timestamp
-    self.period = Bar.timedelta2str(period)
+    self.period = period if isinstance(period, str) else Bar.timedelta2str(period)
     self.open = open_
     self.high = high
     self.low = low
@@ -151,6 +225,8 @@ class Bar(object):
   #----------------------------------------------------------------------
   def __eq__(self, other):
     """Checks equals of all fields even if they are equals None."""
+    if isinstance(other, BarView):
+      other = other.to_bar()
     if not isinstance(other, Bar):
       return False
     if self.ticker != other.ticker:
@@ -182,6 +258,167 @@ class Bar(object):
     return "{ticker.symbol};{timestamp};{period};{open};{high};{low};{close};{volume};{interest}".format(**{a: self.__getattribute__(a) for a in self.__slots__})    
 
 
+#######################################################################
+class BarBlock(object):
+  """
+  Bars of one ticker and period in columns: timestamps are int64 epoch seconds,
+  prices are float64, volume and interest are int64 (NONE if it's absent) arrays.
+  An item is a BarView, a slice is a new block; blocks are joined by + or concat().
+  """
+  __slots__ = ("ticker", "period", "timestamp", "open", "high", "low", "close", "volume", "interest")
+  COLUMNS = ("timestamp", "open", "high", "low", "close", "volume", "interest")
+  TYPECODES = ('q', 'd', 'd', 'd', 'd', 'q', 'q')
+
+  #----------------------------------------------------------------------
+  def __init__(self, ticker, period, *columns):
+    """ <period> is timedelta or its string; <columns> are arrays in the COLUMNS order (empty if omitted). """
+    self.ticker = ticker
+    self.period = period if isinstance(period, str) else Bar.timedelta2str(period)
+    for name, code, values in zip(self.COLUMNS, self.TYPECODES, columns or ((),) * len(self.COLUMNS)):
+      setattr(self, name, values if isinstance(values, array) and values.typecode == code else array(code, values))
+
+  #----------------------------------------------------------------------
+  @classmethod
+  def from_bars(cls, bars, ticker=None, period=None):
+    """ Packs Bar objects (of one ticker and period) into a block. """
+    block = None
+    for it in bars:
+      if block is None:
+        block = cls(ticker or it.ticker, period or it.period)
+      block.append(to_epoch(it.timestamp), it.open, it.high, it.low, it.close, it.volume, it.interest)
+    return block if block is not None else cls(ticker, period or '0')
+
+  #----------------------------------------------------------------------
+  @classmethod
+  def concat(cls, blocks):
+    """ Joins blocks into a new one; they should have the same ticker and period. """
+    result = None
+    for block in blocks:
+      if result is None:
+        result = cls(block.ticker, block.period)
+      result.extend(block)
+    return result
+
+  #----------------------------------------------------------------------
+  def append(self, timestamp, open_, high, low, close, volume=None, interest=None):
+    """ Adds a row; <timestamp> is epoch seconds. """
+    self.timestamp.append(timestamp)
+    self.open.append(open_)
+    self.high.append(high)
+    self.low.append(low)
+    self.close.append(close)
+    self.volume.append(NONE if volume is None else volume)
+    self.interest.append(NONE if interest is None else interest)
+
+  #----------------------------------------------------------------------
+  def extend(self, other):
+    for name in self.COLUMNS:
+      getattr(self, name).extend(getattr(other, name))
+
+  #----------------------------------------------------------------------
+  def __add__(self, other):
+    return BarBlock.concat((self, other))
+
+  #----------------------------------------------------------------------
+  def __len__(self):
+    return len(self.timestamp)
+
+  #----------------------------------------------------------------------
+  def __getitem__(self, key):
+    if isinstance(key, slice):
+      return BarBlock(self.ticker, self.period, *(getattr(self, name)[key] for name in self.COLUMNS))
+    if key < 0:
+      key += len(self)
+    if not 0 <= key < len(self):
+      raise IndexError('BarBlock index out of range')
+    return BarView(self, key)
+
+  #----------------------------------------------------------------------
+  def __iter__(self):
+    for i in range(len(self)):
+      yield BarView(self, i)
+
+  #----------------------------------------------------------------------
+  def between(self, start, end, include_end=True):
+    """ Returns the index range of rows in [start, end] (or [start, end) ) by binary search. """
+    lo = bisect_left(self.timestamp, to_epoch(start))
+    hi = (bisect_right if include_end else bisect_left)(self.timestamp, to_epoch(end), lo)
+    return lo, hi
+
+  #----------------------------------------------------------------------
+  def bars(self, lo=0, hi=None):
+    """ Yields Bar objects for rows in [lo, hi). """
+    hi = len(self) if hi is None else hi
+    ticker, period = self.ticker, self.period
+    o, h, l, c, v, oi = self.open, self.high, self.low, self.close, self.volume, self.interest
+    for i, ts in enumerate(self.timestamp[lo:hi], lo):
+      yield Bar(ticker, from_epoch(ts), period, o[i], h[i], l[i], c[i],
+                None if v[i] == NONE else v[i], None if oi[i] == NONE else oi[i])
+
+  #----------------------------------------------------------------------
+  def columns(self):
+    """ Returns {column: numpy array} sharing the memory of the block (NumPy is required). """
+    numpy = load_numpy()
+    if numpy is None:
+      raise ImportError('NumPy is required for BarBlock.columns()')
+    return {name: numpy.frombuffer(getattr(self, name), dtype='<i8' if code == 'q' else '<f8')
+            for name, code in zip(self.COLUMNS, self.TYPECODES)}
+
+  #----------------------------------------------------------------------
+  def __repr__(self):
+    return "BarBlock:({0};{1};{2})".format(self.ticker.symbol if self.ticker else None, self.period, len(self))
+
+
+#######################################################################
+class BarView(object):
+  """ Read-only bar of a BarBlock row with the same attributes as Bar. """
+  __slots__ = ("block", "index")
+
+  #----------------------------------------------------------------------
+  def __init__(self, block, index):
+    self.block = block
+    self.index = index
+
+  ticker = property(lambda self: self.block.ticker)
+  period = property(lambda self: self.block.period)
+  timestamp = property(lambda self: from_epoch(self.block.timestamp[self.index]))
+  open = property(lambda self: self.block.open[self.index])
+  high = property(lambda self: self.block.high[self.index])
+  low = property(lambda self: self.block.low[self.index])
+  close = property(lambda self: self.block.close[self.index])
+
+  #----------------------------------------------------------------------
+  @property
+  def volume(self):
+    v = self.block.volume[self.index]
+    return None if v == NONE else v
+
+  #----------------------------------------------------------------------
+  @property
+  def interest(self):
+    v = self.block.interest[self.index]
+    return None if v == NONE else v
+
+  #----------------------------------------------------------------------
+  def to_bar(self):
+    return Bar(self.ticker, self.timestamp, self.period, self.open, self.high, self.low, self.close,
+               self.volume, self.interest)
+
+  #----------------------------------------------------------------------
+  def __eq__(self, other):
+    if isinstance(other, BarView):
+      other = other.to_bar()
+    return self.to_bar() == other
+
+  #----------------------------------------------------------------------
+  def __ne__(self, other):
+    return not self.__eq__(other)
+
+  #----------------------------------------------------------------------
+  def __repr__(self):
+    return repr(self.to_bar())
+
+
 ########################################################################
 class DataProvider(object):
   """
@@ -191,8 +428,12 @@ class DataProvider(object):
       return Bar list
     2. def find(self, query):
       return Ticker list
+  It can also override blocks() to return BarBlock iterable without Bar objects
+  and afind()/ablocks() to work without the executor in the event loop.
   """
   __slots__ = ()
+  BLOCK_SIZE = 10000  # rows per block
+  cache = None  # ChunkCache of closed windows, it's set by ChunkCache.configure()
   #----------------------------------------------------------------------
   def __getitem__(self, key):
     values = self.find(key)
@@ -205,14 +446,39 @@ class DataProvider(object):
   def __contains__(self, key):
     return key in self.find(key)
 
+  #----------------------------------------------------------------------
+  def resolve(self, queries):
+    """ Resolves the list of symbols at once; returns dict {query: Ticker} without absent ones. """
+    result = {}
+    for query in queries:
+      try:
+        result[query] = self[query]
+      except (KeyError, DataNotFoundError):
+        pass
+    return result
+
   #----------------------------------------------------------------------
   def find(self, query):
     """ Method returns only available string keys for identify queried ticker. """
     raise NotImplementedError("Method 'find' not implemented.")        
 
   #----------------------------------------------------------------------
-  def get_bars(self, ticker, delta, start=1, end=None):
-    """ Creates a generator which return requested data in minutely bars."""
+  def blocks(self, ticker, start, end, period):
+    """
+    Returns BarBlock iterable of the ticker's data; providers which parse responses
+    into columns override it, others get bars packed by this one.
+    """
+    bars = iter(self.bars(ticker, start, end, period))
+    while True:
+      block = BarBlock.from_bars(islice(bars, self.BLOCK_SIZE), ticker, period)
+      if not len(block):
+        return
+      yield block
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def normalize_range(delta, start=1, end=None):
+    """ Converts <start> and <end> of get_bars() to datetimes rounded to minutes. """
     if not end:
       # Expects trader get new data in the next morning not immediate right after trading session
       end = datetime.now()  # Because providers will return data until but exclude end
@@ -243,5 +509,61 @@ class DataProvider(object):
     if start > end:
       raise ValueError("Start datetime is after end.")
 
+    return start, end
+
+  #----------------------------------------------------------------------
+  def get_bars(self, ticker, delta, start=1, end=None):
+    """ Creates a generator which return requested data in minutely bars."""
+    start, end = self.normalize_range(delta, start, end)
+    cache = self.cache
+    if cache is not None and cache.is_closed(end):
+      return cache.bars(self, ticker, start, end, delta)
     return self.bars(ticker, start, end, delta)
 
+  #----------------------------------------------------------------------
+  def get_blocks(self, ticker, delta, start=1, end=None):
+    """ The same as get_bars() but returns BarBlock iterable. """
+    start, end = self.normalize_range(delta, start, end)
+    cache = self.cache
+    if cache is not None and cache.is_closed(end):
+      return cache.blocks(self, ticker, start, end, delta)
+    return self.blocks(ticker, start, end, delta)
+
+  #----------------------------------------------------------------------
+  async def afind(self, query):
+    """ Non-blocking find(); the blocking one is called in the executor unless it's overridden. """
+    from .aio import run_sync
+    return await run_sync(self.find, query)
+
+  #----------------------------------------------------------------------
+  async def ablocks(self, ticker, start, end, period):
+    """ Async generator of blocks(); the blocking one is iterated in the executor unless it's overridden. """
+    from .aio import run_sync, iterate_sync
+    async for block in iterate_sync(await run_sync(self.blocks, ticker, start, end, period)):
+      yield block
+
+  #----------------------------------------------------------------------
+  async def abars(self, ticker, start, end, period):
+    """ Async generator of bars made from ablocks() """
+    async for block in self.ablocks(ticker, start, end, period):
+      for bar in block.bars():
+        yield bar
+
+  #----------------------------------------------------------------------
+  async def aget_blocks(self, ticker, delta, start=1, end=None):
+    """ The same as get_blocks() but it's an async generator. """
+    start, end = self.normalize_range(delta, start, end)
+    cache = self.cache
+    if cache is not None and cache.is_closed(end):
+      for block in await cache.ablocks(self, ticker, start, end, delta):
+        yield block
+    else:
+      async for block in self.ablocks(ticker, start, end, delta):
+        yield block
+
+  #----------------------------------------------------------------------
+  async def aget_bars(self, ticker, delta, start=1, end=None):
+    """ The same as get_bars() but it's an async generator. """
+    async for block in self.aget_blocks(ticker, delta, start, end):
+      for bar in block.bars():
+        yield bar
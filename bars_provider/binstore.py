@@ -0,0 +1,250 @@
+"""
+Binary file of fixed-width bar records. It's appended by the downloader and read
+through mmap (as zero-copy NumPy structured array if NumPy is installed).
+"""
+
+from bisect import bisect_left
+from itertools import starmap
+import mmap
+import os
+from pathlib import Path
+import struct
+
+from .base import Bar, BarBlock, Ticker, InvalidDataFormatError, NONE, to_epoch, from_epoch, load_numpy
+from .storage import BarWriter
+
+
+__all__ = ["BinaryBarFile", "BinaryBarReader"]
+
+
+MAGIC = b'BARS'
+VERSION = 1
+# magic, version, record size, period ('15', 'H', 'D', ...), symbol
+HEADER = struct.Struct('<4sHH8s48s')
+# timestamp (epoch seconds), open, high, low, close, volume, interest
+RECORD = struct.Struct('<qddddqq')
+# NumPy dtype of RECORD (fields, so NumPy is imported only by records)
+DTYPE = [('timestamp', '<i8'), ('open', '<f8'), ('high', '<f8'), ('low', '<f8'),
+         ('close', '<f8'), ('volume', '<i8'), ('interest', '<i8')]
+
+
+#######################################################################
+class BinaryBarFile(object):
+  """
+  File with a small header and fixed-width records in the time order.
+  The header is written with the first bar, so it knows the symbol and the period.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name):
+    self.path = Path(file_name)
+
+  #----------------------------------------------------------------------
+  def exists(self):
+    return self.path.is_file()
+
+  #----------------------------------------------------------------------
+  def _complete_size(self, size):
+    """ Size of the header and all whole records (a crash can leave a part of the record) """
+    if size < HEADER.size:
+      return 0
+    return size - (size - HEADER.size) % RECORD.size
+
+  #----------------------------------------------------------------------
+  def last_timestamp(self):
+    """ Returns the timestamp of the last record or None for an empty file. """
+    if not self.exists():
+      return None
+    with self.path.open('rb') as f:
+      size = self._complete_size(f.seek(0, os.SEEK_END))
+      if size <= HEADER.size:
+        return None
+      f.seek(size - RECORD.size)
+      return from_epoch(RECORD.unpack(f.read(RECORD.size))[0])
+
+  #----------------------------------------------------------------------
+  def repair(self):
+    """ Cuts the unfinished last record off; returns the number of removed bytes. """
+    with self.path.open('r+b') as f:
+      size = f.seek(0, os.SEEK_END)
+      complete = self._complete_size(size)
+      if complete < size:
+        f.truncate(complete)
+    return size - complete
+
+  #----------------------------------------------------------------------
+  def open(self, append):
+    """ Opens the file for writing; the appended file is repaired before. """
+    if append and self.exists():
+      self.repair()
+      return BinaryBarWriter(self.path, append=True)
+    return BinaryBarWriter(self.path, append=False)
+
+  #----------------------------------------------------------------------
+  def replace(self, other):
+    """ Moves the file of the <other> store over this one. """
+    os.replace(str(other.path), str(self.path))
+
+  #----------------------------------------------------------------------
+  def remove(self):
+    self.path.unlink()
+
+  #----------------------------------------------------------------------
+  def reader(self):
+    return BinaryBarReader(self.path)
+
+  #----------------------------------------------------------------------
+  def read(self, start=None, ticker=None):
+    """ Yields bars from <start> (or from the beginning) to the end of the file. """
+    if not self.exists():
+      return
+    with self.reader() as r:
+      yield from r.bars(start, None, ticker)
+
+  #----------------------------------------------------------------------
+  def tail(self, count, ticker=None):
+    """ Returns the last <count> bars as BarBlock. """
+    if not self.exists():
+      return BarBlock(ticker, '0')
+    with self.reader() as r:
+      if not len(r):
+        return BarBlock(ticker, r.period or '0')
+      return r.block(lo=max(len(r) - count, 0), ticker=ticker)
+
+
+#######################################################################
+class BinaryBarWriter(BarWriter):
+  """ Appends bars as binary records; the header is written before the first bar of the file. """
+
+  #----------------------------------------------------------------------
+  def _header(self, period, symbol):
+    if self.f.tell():
+      return b''
+    return HEADER.pack(MAGIC, VERSION, RECORD.size, period.encode(), symbol.encode('utf-8')[:48])
+
+  #----------------------------------------------------------------------
+  def serialize(self, bars):
+    buf = bytearray(self._header(bars[0].period, bars[0].ticker.symbol))
+    pack = RECORD.pack
+    for it in bars:
+      buf += pack(to_epoch(it.timestamp), it.open, it.high, it.low, it.close,
+                  NONE if it.volume is None else it.volume,
+                  NONE if it.interest is None else it.interest)
+    return bytes(buf)
+
+  #----------------------------------------------------------------------
+  def serialize_block(self, block):
+    # columns are stored with the same NONE, so rows are packed as they are
+    return self._header(block.period, block.ticker.symbol) + b''.join(starmap(RECORD.pack, zip(
+      block.timestamp, block.open, block.high, block.low, block.close, block.volume, block.interest)))
+
+
+#######################################################################
+class _Timestamps(object):
+  """ Sequence of records' timestamps for the bisect functions """
+  __slots__ = ("buf", "count")
+
+  #----------------------------------------------------------------------
+  def __init__(self, buf, count):
+    self.buf = buf
+    self.count = count
+
+  #----------------------------------------------------------------------
+  def __len__(self):
+    return self.count
+
+  #----------------------------------------------------------------------
+  def __getitem__(self, i):
+    return struct.unpack_from('<q', self.buf, HEADER.size + i * RECORD.size)[0]
+
+
+#######################################################################
+class BinaryBarReader(object):
+  """
+  Read-only mmap of the binary bar file.
+  Range queries use a binary search by the timestamp.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name):
+    self.symbol, self.period, self.count = None, None, 0
+    self._file, self._mm = None, None
+    with open(file_name, 'rb') as f:
+      size = f.seek(0, os.SEEK_END)
+      if size >= HEADER.size:
+        f.seek(0)
+        magic, version, record_size, period, symbol = HEADER.unpack(f.read(HEADER.size))
+        if magic != MAGIC or version != VERSION or record_size != RECORD.size:
+          raise InvalidDataFormatError(file_name, magic)
+        self.period = period.rstrip(b'\0').decode()
+        self.symbol = symbol.rstrip(b'\0').decode('utf-8')
+        self.count = (size - HEADER.size) // RECORD.size
+    if self.count:
+      self._file = open(file_name, 'rb')
+      self._mm = mmap.mmap(self._file.fileno(), HEADER.size + self.count * RECORD.size, access=mmap.ACCESS_READ)
+    self._timestamps = _Timestamps(self._mm, self.count)
+
+  #----------------------------------------------------------------------
+  def __len__(self):
+    return self.count
+
+  #----------------------------------------------------------------------
+  def __enter__(self):
+    return self
+
+  #----------------------------------------------------------------------
+  def __exit__(self, *args):
+    self.close()
+
+  #----------------------------------------------------------------------
+  def close(self):
+    self._timestamps = _Timestamps(None, 0)
+    self.count = 0
+    if self._mm is not None:
+      self._mm.close()
+      self._file.close()
+      self._mm, self._file = None, None
+
+  #----------------------------------------------------------------------
+  @property
+  def records(self):
+    """ All records as NumPy structured array (without copying); needs NumPy. """
+    numpy = load_numpy()
+    if numpy is None:
+      raise ImportError("NumPy is required for the structured array view.")
+    if not self.count:
+      return numpy.empty(0, dtype=DTYPE)
+    return numpy.frombuffer(self._mm, dtype=DTYPE, count=self.count, offset=HEADER.size)
+
+  #----------------------------------------------------------------------
+  def search(self, start, end):
+    """ Returns the index range of records in [start, end). """
+    lo = bisect_left(self._timestamps, to_epoch(start)) if start else 0
+    hi = bisect_left(self._timestamps, to_epoch(end), lo) if end else self.count
+    return lo, hi
+
+  #----------------------------------------------------------------------
+  def range(self, start=None, end=None):
+    """ Records in [start, end): NumPy array slice or list of tuples without NumPy. """
+    lo, hi = self.search(start, end)
+    if load_numpy() is not None:
+      return self.records[lo:hi]
+    return [RECORD.unpack_from(self._mm, HEADER.size + i * RECORD.size) for i in range(lo, hi)]
+
+  #----------------------------------------------------------------------
+  def block(self, start=None, end=None, ticker=None, lo=None):
+    """ Returns records in [start, end) (or from the index <lo>) as BarBlock. """
+    lo, hi = self.search(start, end) if lo is None else (lo, self.count)
+    rows = RECORD.iter_unpack(self._mm[HEADER.size + lo * RECORD.size:HEADER.size + hi * RECORD.size])
+    return BarBlock(ticker or Ticker(None, self.symbol), self.period, *zip(*rows))
+
+  #----------------------------------------------------------------------
+  def bars(self, start=None, end=None, ticker=None):
+    """ Yields Bar objects in [start, end). """
+    ticker = ticker or Ticker(None, self.symbol)
+    period = Bar.str2timedelta(self.period) if self.period else None
+    lo, hi = self.search(start, end)
+    for i in range(lo, hi):
+      ts, o, h, l, c, v, oi = RECORD.unpack_from(self._mm, HEADER.size + i * RECORD.size)
+      yield Bar(ticker, from_epoch(ts), period, o, h, l, c,
+                None if v == NONE else v, None if oi == NONE else oi)
@@ -0,0 +1,159 @@
+"""
+On-disk cache of downloaded windows which can't be changed any more.
+"""
+
+from datetime import datetime, timedelta
+import hashlib
+from itertools import starmap
+import os
+from pathlib import Path
+import threading
+
+from .base import Bar, BarBlock, DataProvider
+from .binstore import RECORD
+from .log import logger
+from .singleton import Singleton
+
+
+__all__ = ["ChunkCache"]
+
+
+#######################################################################
+class ChunkCache(object, metaclass=Singleton):
+  """
+  Content-addressed cache of bars for (provider, ticker, period, window).
+  Only windows which were closed <margin> ago are stored; files are evicted
+  in the least recently used order when the total size is over the limit.
+  The cache is off until a directory is configured; configure() sets it to DataProvider.cache.
+  """
+  SUFFIX = '.bars'
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._lock = threading.Lock()
+    self.directory = None
+    self.max_bytes = 512 * 1024 * 1024
+    self.margin = timedelta(days=2)
+    self._size = 0
+    self.hits, self.misses = 0, 0
+
+  #----------------------------------------------------------------------
+  def configure(self, directory, max_size_mb=512, margin_days=2):
+    with self._lock:
+      self.directory = Path(directory) if directory else None
+      self.max_bytes = int(max_size_mb * 1024 * 1024)
+      self.margin = timedelta(days=margin_days)
+      self._size = sum(p.stat().st_size for p in self._files()) if self.directory else 0
+    DataProvider.cache = self if self.enabled else None  # providers look up closed windows in it
+
+  #----------------------------------------------------------------------
+  @property
+  def enabled(self):
+    return self.directory is not None
+
+  #----------------------------------------------------------------------
+  def is_closed(self, end):
+    """ Data of the window which ends before now - margin are not changed. """
+    return end < datetime.now() - self.margin
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def key(provider, ticker, period, start, end):
+    data = ';'.join('{0}={1}'.format(k, v) for k, v in sorted(ticker.data.items()))
+    text = '{0};{1};{2};{3};{4};{5}'.format(provider.__class__.__name__, ticker.symbol, data,
+                                            Bar.timedelta2str(period), start, end)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+  #----------------------------------------------------------------------
+  def _path(self, key):
+    return self.directory / key[:2] / (key + self.SUFFIX)
+
+  #----------------------------------------------------------------------
+  def _files(self):
+    return self.directory.glob('*/*' + self.SUFFIX) if self.directory.is_dir() else []
+
+  #----------------------------------------------------------------------
+  def get(self, key, ticker, period):
+    """ Returns the cached BarBlock or None. """
+    path = self._path(key)
+    try:
+      with path.open('rb') as f:
+        data = f.read()
+      os.utime(str(path))  # the last access for LRU
+    except OSError:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return BarBlock(ticker, period, *zip(*RECORD.iter_unpack(data)))
+
+  #----------------------------------------------------------------------
+  def put(self, key, block):
+    """ Stores the block; empty ones aren't stored: an error of the provider shouldn't be kept as its data. """
+    if not len(block):
+      return
+    data = b''.join(starmap(RECORD.pack, zip(block.timestamp, block.open, block.high, block.low,
+                                             block.close, block.volume, block.interest)))
+    path = self._path(key)
+    try:
+      path.parent.mkdir(parents=True, exist_ok=True)
+      tmp_path = path.with_suffix('.tmp{0}.{1}'.format(os.getpid(), threading.get_ident()))
+      with tmp_path.open('wb') as f:
+        f.write(data)
+      try:
+        old = path.stat().st_size  # the overwritten file
+      except FileNotFoundError:
+        old = 0
+      os.replace(str(tmp_path), str(path))
+    except OSError as e:
+      logger.warning('ChunkCache: {0} is not saved; ({1})'.format(key, e))
+      return
+    with self._lock:
+      self._size += len(data) - old
+      if self._size > self.max_bytes:
+        self._evict()
+
+  #----------------------------------------------------------------------
+  def _evict(self):
+    """ Removes the least recently used files down to 90% of the limit. """
+    files = []
+    for p in self._files():
+      try:
+        st = p.stat()
+        files.append((st.st_mtime, st.st_size, p))
+      except OSError:
+        pass
+    self._size = sum(size for _, size, _ in files)
+    for _, size, p in sorted(files, key=lambda it: it[0]):
+      if self._size <= self.max_bytes * 0.9:
+        break
+      try:
+        p.unlink()
+        self._size -= size
+      except OSError:
+        pass
+
+  #----------------------------------------------------------------------
+  def blocks(self, provider, ticker, start, end, period):
+    """ Returns [BarBlock] of the closed window from the cache or from the provider (and stores it). """
+    key = self.key(provider, ticker, period, start, end)
+    block = self.get(key, ticker, period)
+    if block is None:
+      block = BarBlock.concat(provider.blocks(ticker, start, end, period)) or BarBlock(ticker, period)
+      self.put(key, block)
+    return [block]
+
+  #----------------------------------------------------------------------
+  async def ablocks(self, provider, ticker, start, end, period):
+    """ The same as blocks() for the event loop; files are read and written in the executor. """
+    from .aio import run_sync
+    key = self.key(provider, ticker, period, start, end)
+    block = await run_sync(self.get, key, ticker, period)
+    if block is None:
+      block = BarBlock.concat([it async for it in provider.ablocks(ticker, start, end, period)]) or BarBlock(ticker, period)
+      await run_sync(self.put, key, block)
+    return [block]
+
+  #----------------------------------------------------------------------
+  def bars(self, provider, ticker, start, end, period):
+    """ Returns bars of the closed window from the cache or from the provider (and stores them). """
+    return list(self.blocks(provider, ticker, start, end, period)[0].bars())
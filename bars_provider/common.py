@@ -2,11 +2,15 @@
 Module for common functions
 """
 
-import requests
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
+import threading
+from urllib.parse import urlsplit
 
-__all__ = ["Singleton", "is_float", "is_not_empty", "str2bool", "requests_retry_session"]
+from .log import logger
+from .metrics import Metrics
+from .ratelimit import RateLimiter, retry_after
+from .singleton import Singleton  # it's imported from here by providers
+
+__all__ = ["Singleton", "Sessions", "is_float", "is_not_empty", "str2bool", "requests_retry_session", "iter_response_lines"]
 
 #----------------------------------------------------------------------  
 def is_float(value):
@@ -22,7 +26,12 @@ def is_not_empty(s):
 def str2bool(v):
   return v.lower() in ("yes", "true", "t", "1")
 #----------------------------------------------------------------------
-def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504), session=None,):
+def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500, 502, 504), session=None, pool_size=10,
+                           respect_retry_after_header=True):
+  # requests is imported by the first session: it's slow to import and not needed for cached or covered windows
+  import requests
+  from requests.adapters import HTTPAdapter
+  from urllib3.util.retry import Retry
   session = session or requests.Session()
   retry = Retry(
       total=retries,
@@ -30,17 +39,142 @@ def requests_retry_session(retries=3, backoff_factor=0.3, status_forcelist=(500,
       connect=retries,
       backoff_factor=backoff_factor,
       status_forcelist=status_forcelist,
+      respect_retry_after_header=respect_retry_after_header,
   )
-  adapter = HTTPAdapter(max_retries=retry)
+  adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
   session.mount('http://', adapter)
   session.mount('https://', adapter)
   return session
 
+#----------------------------------------------------------------------
+def iter_response_lines(response, chunk_size=65536):
+  """ Yields decoded lines while the streamed body is being received; closes the response at the end. """
+  size = 0
+  try:
+    for line in response.iter_lines(chunk_size=chunk_size):
+      size += len(line) + 1
+      yield line.decode('utf-8', "ignore")
+  finally:
+    response.close()
+    Metrics().inc('bars_http_bytes_total', size, host=urlsplit(response.url).netloc)
+
 #######################################################################
-class Singleton(type):
-  _instance = None
+class Sessions(object, metaclass=Singleton):
+  """
+  Keep-alive sessions shared by all providers, one session (connection pool) per host.
+  Every request goes through the rate limiter of its host.
+  """
+  # the host asks to slow down
+  THROTTLE_STATUSES = (429, 503)
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._sessions = {}
+    self._limiters = {}
+    self.pool_size = 10
+    self.retries = 3
+    self.backoff_factor = 0.3
+    self.rate = 5.0
+    self.burst = 5
+    self.hosts = {}  # host -> {"RATE": requests per second, "BURST": requests}
+
+  #----------------------------------------------------------------------
+  def configure(self, pool_size=None, retries=None, backoff_factor=None, rate=None, burst=None, hosts=None):
+    """ Changes pool size, retry policy and rate limits; opened sessions are recreated on demand. """
+    with self._lock:
+      self.pool_size = pool_size if pool_size is not None else self.pool_size
+      self.retries = retries if retries is not None else self.retries
+      self.backoff_factor = backoff_factor if backoff_factor is not None else self.backoff_factor
+      self.rate = rate if rate is not None else self.rate
+      self.burst = burst if burst is not None else self.burst
+      self.hosts = hosts if hosts is not None else self.hosts
+      self._limiters = {}
+      sessions, self._sessions = self._sessions, {}
+    for sess in sessions.values():
+      sess.close()
+
+  #----------------------------------------------------------------------
+  def session(self, url):
+    """ Returns the session for the host of <url>. """
+    host = urlsplit(url).netloc
+    with self._lock:
+      sess = self._sessions.get(host)
+      if sess is None:
+        # 429/503 are repeated by get() through the rate limiter
+        sess = requests_retry_session(retries=self.retries, backoff_factor=self.backoff_factor, pool_size=self.pool_size,
+                                      respect_retry_after_header=False)
+        self._sessions[host] = sess
+      return sess
+
+  #----------------------------------------------------------------------
+  def limiter(self, url):
+    """ Returns the rate limiter for the host of <url>. """
+    host = urlsplit(url).netloc
+    with self._lock:
+      limiter = self._limiters.get(host)
+      if limiter is None:
+        limits = self.hosts.get(host, {})
+        limiter = RateLimiter(limits.get('RATE', self.rate), limits.get('BURST', self.burst))
+        self._limiters[host] = limiter
+      return limiter
+
+  #----------------------------------------------------------------------
+  def get(self, url, **kwargs):
+    """ Requests <url> when its host allows it; throttled requests are repeated up to <retries> times. """
+    metrics, host = Metrics(), urlsplit(url).netloc
+    limiter = self.limiter(url)
+    for attempt in range(self.retries + 1):
+      limiter.acquire()
+      try:
+        response = self.session(url).get(url, **kwargs)
+      except Exception as e:
+        metrics.inc('bars_http_failures_total', host=host, error=e.__class__.__name__)
+        raise
+      metrics.observe('bars_http_seconds', response.elapsed.total_seconds(), host=host)
+      # repeated by urllib3 inside of the session (connection errors, 5xx)
+      history = getattr(getattr(response.raw, 'retries', None), 'history', None)
+      if history:
+        metrics.inc('bars_http_retries_total', len(history), host=host, reason='error')
+      if response.status_code not in self.THROTTLE_STATUSES:
+        limiter.success(response.elapsed.total_seconds())
+        return response
+      response.close()
+      if attempt < self.retries:
+        metrics.inc('bars_http_retries_total', host=host, reason='throttled')
+      pause = retry_after(response.headers.get('Retry-After'))
+      limiter.throttle(pause)
+      logger.warning('{0}: throttled ({1}), rate: {2:.3f}/s'.format(host, response.status_code, limiter.rate))
+    metrics.inc('bars_http_failures_total', host=host, error='HTTP{0}'.format(response.status_code))
+    response.raise_for_status()
+
+  #----------------------------------------------------------------------
+  def stats(self):
+    """
+    Returns requests/connections counters for every host (reused = requests - connections)
+    and the state of its rate limiter.
+    """
+    result = {}
+    with self._lock:
+      sessions = list(self._sessions.items())
+    for host, sess in sessions:
+      requests_cnt, connections = 0, 0
+      for adapter in set(sess.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for key in pools.keys():
+          pool = pools.get(key)
+          if pool is not None:
+            requests_cnt += pool.num_requests
+            connections += pool.num_connections
+      result[host] = dict(requests=requests_cnt, connections=connections, reused=max(requests_cnt - connections, 0))
+    with self._lock:
+      limiters = list(self._limiters.items())
+    for host, limiter in limiters:
+      result.setdefault(host, dict(requests=0, connections=0, reused=0))['limiter'] = limiter.state()
+    return result
+
   #----------------------------------------------------------------------
-  def __call__(self, *args, **kw):
-    if not self._instance:
-      self._instance = super(Singleton, self).__call__(*args, **kw)
-    return self._instance
+  def close(self):
+    with self._lock:
+      sessions, self._sessions = self._sessions, {}
+    for sess in sessions.values():
+      sess.close()
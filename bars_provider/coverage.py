@@ -0,0 +1,85 @@
+"""
+Index of time ranges which were already fetched for an output file.
+"""
+
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+
+from .log import logger
+
+
+__all__ = ["Coverage"]
+
+
+#######################################################################
+class Coverage(object):
+  """
+  Sorted disjoint [start, end) ranges which were requested successfully,
+  including the ranges without any bars (weekends, holidays).
+  It's stored near the output file as <file>.cov.
+  """
+  FORMAT = '%Y-%m-%d %H:%M:%S'
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name):
+    path = Path(file_name)
+    self.path = path.with_name(path.name + '.cov')
+    self.ranges = []
+
+  #----------------------------------------------------------------------
+  def load(self):
+    try:
+      with self.path.open() as f:
+        self.ranges = [[datetime.strptime(s, self.FORMAT), datetime.strptime(e, self.FORMAT)]
+                       for s, e in json.load(f)['ranges']]
+    except FileNotFoundError:
+      self.ranges = []
+    except (OSError, ValueError, KeyError) as e:
+      logger.warning('{0}: coverage is reset; ({1})'.format(self.path.name, e))
+      self.ranges = []
+    return self
+
+  #----------------------------------------------------------------------
+  def save(self):
+    tmp_path = self.path.with_name(self.path.name + '.tmp')
+    with tmp_path.open('w') as f:
+      json.dump({'ranges': [[s.strftime(self.FORMAT), e.strftime(self.FORMAT)] for s, e in self.ranges]}, f)
+    os.replace(str(tmp_path), str(self.path))
+
+  #----------------------------------------------------------------------
+  def clear(self):
+    self.ranges = []
+    if self.path.is_file():
+      self.path.unlink()
+
+  #----------------------------------------------------------------------
+  def add(self, start, end):
+    """ Marks [start, end) as fetched; touching ranges are joined. """
+    if start >= end:
+      return
+    result = []
+    for s, e in self.ranges:
+      if e < start or s > end:
+        result.append([s, e])
+      else:
+        start, end = min(s, start), max(e, end)
+    result.append([start, end])
+    self.ranges = sorted(result)
+
+  #----------------------------------------------------------------------
+  def gaps(self, start, end):
+    """ Returns not fetched [start, end) ranges inside of [start, end). """
+    result = []
+    for s, e in self.ranges:
+      if e <= start:
+        continue
+      if s >= end:
+        break
+      if s > start:
+        result.append((start, s))
+      start = max(start, e)
+    if start < end:
+      result.append((start, end))
+    return result
@@ -2,59 +2,152 @@
 Downloads historical data from remote resources defined in config.json
 """
 
+from bisect import bisect_right
+from collections import deque
 from datetime import datetime, timedelta
+from functools import partial
 import json
-from pathlib import Path
+import os
 from sched import scheduler
 from time import sleep, time
 
-
-from .base import DataObtainError, Bar
-from .common import is_not_empty, str2bool
-from .log import logger
+from .base import DataObtainError, InvalidDataFormatError, Bar, BarBlock, to_epoch
+from .common import is_not_empty, str2bool, Sessions
+from .log import logger, setup_logging
+from .binstore import BinaryBarFile
+from .chunkcache import ChunkCache
+from .coverage import Coverage
+from .gzstore import GzipBarFile
+from .hotcache import HotCache
+from .journal import Journal
+from .locks import FileLock, FileLockedError
+from .metrics import Metrics
+from .planner import ChunkPlanner
+from .registry import Providers
+from .resample import Resampler
+from .scheduler import Scheduler, SessionCalendar
+from .sharding import shard_of, shard_name
+from .storage import TextBarFile, merge
 
 
 __all__ = ["Downloads"]
 
 
+# Output formats: file extension -> storage
+STORES = {
+  'txt': TextBarFile,
+  'bin': BinaryBarFile,
+  'txt.gz': GzipBarFile,
+}
+
+
 #######################################################################
 class Downloads(object):
   """
   Load config.json, Downloads historical data
   """
+  # windows which ended earlier than it are complete, even without bars
+  SETTLE_TIME = timedelta(days=1)
+  # symbols with open files per worker in the async mode (others wait before their files are opened)
+  OPEN_SYMBOLS = 4
   #----------------------------------------------------------------------
-  def __init__(self, file_name):
-    self._load_cfg(file_name)
+  def __init__(self, file_name, shard=None):
+    """ <shard> is set for the process of the shard which is started by another process (see SHARDING). """
+    self.file_name = file_name
+    self._load_cfg(file_name, shard)
   #----------------------------------------------------------------------
   @staticmethod
   def save_default_cfg(file_name):
     default_json = """{
     "all":{
         "TIMEOUT":240,
+        "SCHEDULE":{"DELAY":60, "JITTER":30, "RETRY":60,
+                    "SESSIONS":{"FinamProvider":{"DAYS":[0, 1, 2, 3, 4], "START":"07:00", "END":"23:50"},
+                                "QuotemediaProvider":{"DAYS":[0, 1, 2, 3, 4], "START":"09:30", "END":"16:00"}}},
+        "LOCK_FILE":"bars_downloader.lock",
         "TIMEFRAME":"15",
+        "TIMEFRAMES":[],
         "CHUNK_IN_DAYS":10,
+        "ADAPTIVE_CHUNKS":{"FILE":"chunks.json", "TARGET_ROWS":20000, "MAX_LATENCY":20, "MAX_DAYS":3650},
         "DATETIME_START":"201611010000",
         "DATETIME_END":"201612010000",
-        "APPEND_DATA":"yes"
+        "APPEND_DATA":"yes",
+        "FORMAT":"txt",
+        "FSYNC":"no",
+        "WORKERS":1,
+        "ASYNC":"no",
+        "PROVIDER_WORKERS":{},
+        "HTTP":{"POOL_SIZE":10, "RETRIES":3, "BACKOFF_FACTOR":0.3, "RATE":5, "BURST":5,
+                "HOSTS":{"export.finam.ru":{"RATE":1, "BURST":2}}},
+        "CACHE":{"DIR":"cache", "SIZE_MB":512, "MARGIN_DAYS":2},
+        "METRICS":{"FILE":"metrics.prom", "SUMMARY":"", "SUMMARY_KEEP":1000, "PORT":0},
+        "HOT_CACHE":{"SIZE":0, "PORT":0}
     },
     "resources":{
         "bars_provider.finam":{"FinamProvider":["SPFB.SBRF", "SPFB.RTS"]},
         "bars_provider.quotemedia":{"QuotemediaProvider":["^IN"]}
+    },
+    "providers":{
+        "FinamProvider":{"cache_file":"finam_symbols.json", "cache_ttl":1440}
     }
     }"""
     with open(file_name, 'w') as f_out:
       f_out.write(default_json)
   #----------------------------------------------------------------------
-  def _load_cfg(self, file_name):
+  def _load_cfg(self, file_name, shard=None):
     with open(file_name) as f_json:
       data = json.load(f_json)
+      # (provider, symbol, timeframe) are split between SHARDS processes, PROCESSES of them are run here
+      sharding = data['all'].get('SHARDING')
+      self.PROCESSES = max(int(sharding.get('PROCESSES', 1)), 1) if sharding else 1
+      self.SHARDS = max(int(sharding.get('SHARDS', self.PROCESSES)), 1) if sharding else 1
+      self.FIRST_SHARD = int(sharding.get('FIRST', 0)) if sharding else 0
+      if shard is None and sharding and self.PROCESSES == 1:
+        shard = self.FIRST_SHARD
+      self.SHARD = shard  # None for the single downloader and for the parent of processes
+      if self.SHARD is not None and not 0 <= self.SHARD < self.SHARDS:
+        raise InvalidDataFormatError('SHARDING', 'shard {0} is not less than SHARDS'.format(self.SHARD))
       self.DATETIME_START = datetime.strptime(data['all']['DATETIME_START'], "%Y%m%d%H%M")
       self.DATETIME_END = datetime.strptime(data['all']['DATETIME_END'], "%Y%m%d%H%M")
       self.APPEND_DATA = str2bool(data['all']['APPEND_DATA'])
       self.TIMEFRAME = Bar.str2timedelta(data['all']['TIMEFRAME'])
+      # other timeframes are made from the downloaded one
+      self.TIMEFRAMES = sorted({Bar.str2timedelta(v) for v in data['all'].get('TIMEFRAMES', [])} - {self.TIMEFRAME})
+      for period in self.TIMEFRAMES:
+        Resampler(period, self.TIMEFRAME)  # raises if it can't be made
       self.TIMEOUT = data['all']['TIMEOUT']
+      # fetches are planned by the close time of bars
+      self.SCHEDULE = data['all'].get('SCHEDULE')
+      self.LOCK_FILE = shard_name(data['all'].get('LOCK_FILE', 'bars_downloader.lock'), self.SHARD)
       self.CHUNK_IN_DAYS = timedelta(days=data['all']['CHUNK_IN_DAYS'])
+      adaptive = data['all'].get('ADAPTIVE_CHUNKS')
+      self.PLANNER = ChunkPlanner(adaptive.get('FILE', 'chunks.json'), self.CHUNK_IN_DAYS,
+                                  adaptive.get('TARGET_ROWS', 20000), adaptive.get('MAX_LATENCY', 20),
+                                  adaptive.get('MAX_DAYS', 3650)) if adaptive else None
+      self.FORMAT = data['all'].get('FORMAT', 'txt')
+      self.FSYNC = str2bool(data['all'].get('FSYNC', 'no'))
+      if self.FORMAT not in STORES:
+        raise InvalidDataFormatError(self.FORMAT, 'FORMAT can be only {0}'.format(', '.join(STORES)))
+      self.WORKERS = data['all'].get('WORKERS', 1)
+      self.ASYNC = str2bool(data['all'].get('ASYNC', 'no'))
+      self.PROVIDER_WORKERS = data['all'].get('PROVIDER_WORKERS', {})
       self.RESOURCES = data['resources']
+      self.PROVIDERS = data.get('providers', {})
+      http = data['all'].get('HTTP', {})
+      Sessions().configure(pool_size=http.get('POOL_SIZE'),
+                           retries=http.get('RETRIES'),
+                           backoff_factor=http.get('BACKOFF_FACTOR'),
+                           rate=http.get('RATE'), burst=http.get('BURST'),
+                           hosts=http.get('HOSTS'))
+      cache = data['all'].get('CACHE', {})
+      ChunkCache().configure(cache.get('DIR'), cache.get('SIZE_MB', 512), cache.get('MARGIN_DAYS', 2))
+      metrics = data['all'].get('METRICS', {})
+      Metrics().configure(shard_name(metrics.get('FILE'), self.SHARD), shard_name(metrics.get('SUMMARY'), self.SHARD),
+                          self._port(metrics.get('PORT')), metrics.get('HOST', '127.0.0.1'), metrics.get('SUMMARY_KEEP', 1000))
+      # the latest bars of the written files are kept in memory for queries and subscribers
+      hot = data['all'].get('HOT_CACHE', {})
+      HotCache().configure(0 if self._isParent() else hot.get('SIZE', 0), self._port(hot.get('PORT')),
+                           hot.get('HOST', '127.0.0.1'))
     logger.debug('_load_cfg(): OK')
   #----------------------------------------------------------------------
   @classmethod
@@ -64,85 +157,722 @@ class Downloads(object):
                     (sch, interval, action, actionargs))
     action(*actionargs)
   #----------------------------------------------------------------------
+  def _port(self, port):
+    """ Returns the port of the process's http server: one port for every process of the host """
+    if port and self.SHARD is not None:
+      return port + self.SHARD - self.FIRST_SHARD
+    return None if self._isParent() else port  # the parent doesn't download
+  #----------------------------------------------------------------------
+  def _isParent(self):
+    return self.PROCESSES > 1 and self.SHARD is None
+  #----------------------------------------------------------------------
+  def _owns(self, provider, symbol):
+    """ Checks if the (provider, symbol, timeframe) belongs to the shard of this process. """
+    if self.SHARD is None:
+      return True
+    key = '{0};{1};{2}'.format(provider, symbol, Bar.timedelta2str(self.TIMEFRAME))
+    return shard_of(key, self.SHARDS) == self.SHARD
+  #----------------------------------------------------------------------
+  def _runProcesses(self):
+    """ Runs the downloader of every shard of this host in its own process and waits for them. """
+    import multiprocessing
+    processes = [multiprocessing.Process(target=_worker, args=(self.file_name, shard, logger.level),
+                                         name='shard-{0}'.format(shard))
+                 for shard in range(self.FIRST_SHARD, self.FIRST_SHARD + self.PROCESSES)]
+    for process in processes:
+      process.start()
+    try:
+      for process in processes:
+        process.join()
+    except KeyboardInterrupt:
+      print("break downloader!")
+      for process in processes:
+        process.join()  # they get the interrupt too
+  #----------------------------------------------------------------------
   def startTimer(self):
+    if self._isParent():
+      self._runProcesses()
+      return
+    lock = FileLock(self.LOCK_FILE)
+    if not lock.acquire():
+      logger.error('{0} is locked: another downloader is running'.format(self.LOCK_FILE))
+      return
     try:
-      if self.TIMEOUT > 0:
+      if self.TIMEOUT > 0 and self.SCHEDULE is not None:
+        self._scheduler().run_forever()
+      elif self.TIMEOUT > 0:
         sch = scheduler(time, sleep)
-        Downloads._periodic(sch, self.TIMEOUT * 60, self.download)
+        Downloads._periodic(sch, self.TIMEOUT * 60, self.download_async if self.ASYNC else self.download)
         sch.run()
+      elif self.ASYNC:
+        self.download_async()
       else:
         self.download()
     except KeyboardInterrupt:
       print("break downloader!")
+    finally:
+      lock.release()
+  #----------------------------------------------------------------------
+  def _scheduler(self):
+    """ Makes the scheduler of all symbols by the bar close time (SCHEDULE section). """
+    calendars = {name: SessionCalendar(v.get('DAYS', (0, 1, 2, 3, 4)), v.get('START', '00:00'), v.get('END', '23:59'))
+                 for name, v in self.SCHEDULE.get('SESSIONS', {}).items()}
+    result = Scheduler(self._downloadScheduled, self.TIMEFRAME, calendars,
+                       self.SCHEDULE.get('DELAY', 60), self.SCHEDULE.get('JITTER', 30))
+    failed = []
+    for provider, symbols, workers in self._jobs(failed=failed):
+      result.add(provider, symbols, workers)
+    if failed:
+      # e.g. the dictionary of symbols isn't downloaded: providers are made again up to every TIMEOUT
+      result.retry(partial(self._retryJobs, result, failed), self.SCHEDULE.get('RETRY', 60), self.TIMEOUT * 60)
+    return result
+  #----------------------------------------------------------------------
+  def _retryJobs(self, sch, failed):
+    """ Adds providers of the <failed> resources which are made now; returns True when all of them are added. """
+    still = []
+    for provider, symbols, workers in self._jobs(list(failed), still):
+      sch.add(provider, symbols, workers)
+    failed[:] = still
+    return not failed
+  #----------------------------------------------------------------------
+  def _downloadScheduled(self, provider, symbols, workers):
+    """ Downloads the due symbols of the provider. """
+    if self.ASYNC:
+      import asyncio
+      from .aio import AsyncSessions
+      async def run():
+        try:
+          await self._adownloadProvider(provider, symbols, workers)
+        finally:
+          await AsyncSessions().close()
+      loop = asyncio.new_event_loop()
+      try:
+        loop.run_until_complete(run())
+      finally:
+        loop.close()
+    else:
+      self._downloadProvider(symbols=symbols, provider=provider,
+                             dtStart=self.DATETIME_START, dtEnd=self.DATETIME_END,
+                             chunkDays=self.CHUNK_IN_DAYS, timeframe=self.TIMEFRAME,
+                             isAppend=self.APPEND_DATA, workers=workers)
+    self._report()
+  #----------------------------------------------------------------------
+  def _jobs(self, resources=None, failed=None):
+    """
+    Returns (provider, symbols, workers) for every provider class in the resources (or only for <resources>,
+    [(module, class name)]); modules are imported and providers are made by the first cycle, next cycles reuse them.
+    Resources whose providers can't be made now are added to the list <failed>.
+    """
+    jobs = []
+    for key, val in self.RESOURCES.items():
+      for keyc, valc in val.items():
+        if resources is not None and (key, keyc) not in resources:
+          continue
+        valc = [symbol for symbol in valc if self._owns(keyc, symbol)]
+        if not valc:
+          continue
+        try:
+          with Metrics().span('init', keyc):  # providers can load their dictionaries
+            provider = Providers().instance(keyc, key, **self.PROVIDERS.get(keyc, {}))
+          jobs.append((provider, valc, self.PROVIDER_WORKERS.get(keyc, self.WORKERS)))
+        except ModuleNotFoundError:
+          logger.error('error: module "({0})" is not found!'.format(key))
+        except DataObtainError as e:
+          logger.error('error: module "({0})" has a problem: {1}'.format(key, e))
+          if failed is not None:
+            failed.append((key, keyc))
+    return jobs
   #----------------------------------------------------------------------
   def download(self):
     """ Downloads data from all resources (in config.json)."""
-    for key, val in self.RESOURCES.items():
-      try:
-        module = __import__(key)
-        for keyc, valc in val.items():
-          class_ = getattr(module, keyc)
-          self._downloadProvider(symbols=valc, provider=class_(),
-                                  dtStart=self.DATETIME_START, dtEnd=self.DATETIME_END,
-                                  chunkDays=self.CHUNK_IN_DAYS, timeframe=self.TIMEFRAME,
-                                  isAppend=self.APPEND_DATA)
-      except ModuleNotFoundError:
-        logger.error('error: module "({0})" is not found!'.format(key))
-      except DataObtainError as e:
-        logger.error('error: module "({0}) has a problem": '.format(key), e)
-    if self.TIMEOUT > 0:
+    jobs = self._jobs()
+
+    def run(job):
+      provider, symbols, workers = job
+      self._downloadProvider(symbols=symbols, provider=provider,
+                             dtStart=self.DATETIME_START, dtEnd=self.DATETIME_END,
+                             chunkDays=self.CHUNK_IN_DAYS, timeframe=self.TIMEFRAME,
+                             isAppend=self.APPEND_DATA, workers=workers)
+
+    if len(jobs) > 1 and any(int(workers) > 1 for _, _, workers in jobs):
+      from concurrent.futures import ThreadPoolExecutor
+      # Providers are independent hosts, so each one gets its own thread and own limit
+      with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        list(pool.map(run, jobs))
+    else:
+      for job in jobs:
+        run(job)
+    self._report()
+  #----------------------------------------------------------------------
+  def _report(self):
+    """ Logs statistics of the finished downloading and saves learned state. """
+    for host, stats in Sessions().stats().items():
+      logger.debug('{0}: requests: {requests}, connections: {connections}, reused: {reused}'.format(host, **stats))
+      if 'limiter' in stats:
+        logger.debug('{0}: rate: {rate}/s, throttled: {throttled}, slowdowns: {slowdowns}, waited: {waited}s'.format(host, **stats['limiter']))
+    if self.PLANNER is not None:
+      self.PLANNER.save()
+    if ChunkCache().enabled:
+      logger.debug('cache: hits: {0}, misses: {1}'.format(ChunkCache().hits, ChunkCache().misses))
+    summary = Metrics().flush()
+    for name, provider in sorted(summary['providers'].items()):
+      logger.debug('{0}: rows: {1}, bytes: {2}, failures: {3}, slowest: {4}; {5}'.format(
+        name, provider.get('rows', 0), provider.get('bytes', 0), provider.get('failures', 0), summary['bottleneck'].get(name),
+        ', '.join('{0}: {seconds}s (p95 {p95}s)'.format(stage, **v) for stage, v in sorted(provider.get('stages', {}).items()))))
+    if self.TIMEOUT > 0 and self.SCHEDULE is None:
       logger.info('')
       logger.info('Next downloading in {0}...'.format(datetime.now() + timedelta(minutes=self.TIMEOUT)))
       logger.info('')
   #----------------------------------------------------------------------
-  def _downloadProvider(self, provider, symbols, dtStart, dtEnd, chunkDays, timeframe, isAppend):
+  def download_async(self):
+    """ Runs adownload() in a new event loop. """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+      loop.run_until_complete(self.adownload())
+    finally:
+      loop.close()
+  #----------------------------------------------------------------------
+  async def adownload(self):
     """
-    Downloads the stock data for <symbols> from <provider> and put all of this the txt-file
+    Downloads data from all resources in one event loop: all symbols are downloaded concurrently,
+    up to <workers> requests to a provider at once.
     """
+    import asyncio
+    from .aio import AsyncSessions, run_sync
+    jobs = await run_sync(self._jobs)  # providers can load their dictionaries
+    try:
+      await asyncio.gather(*(self._adownloadProvider(provider, symbols, workers)
+                             for provider, symbols, workers in jobs))
+    finally:
+      await AsyncSessions().close()
+    self._report()
+  #----------------------------------------------------------------------
+  async def _adownloadProvider(self, provider, symbols, workers):
+    import asyncio
     clsname = provider.__class__.__name__
-    logger.info('*' * 40)
     logger.info('{0}: start downloading...'.format(clsname))
-    logger.info('*' * 40)
-    for symbol in symbols:
+    workers = max(int(workers), 1)
+    limit = asyncio.Semaphore(workers)
+    opened = asyncio.Semaphore(workers * self.OPEN_SYMBOLS)  # thousands of symbols don't hold their files at once
+
+    async def run(symbol):
+      async with opened:
+        await self._adownloadSymbol(clsname, provider, symbol, limit, workers)
+
+    await asyncio.gather(*(run(symbol) for symbol in symbols))
+    logger.info('{0}: end'.format(clsname))
+  #----------------------------------------------------------------------
+  async def _adownloadSymbol(self, clsname, provider, symbol, limit, workers):
+    """
+    Requests up to <workers> chunks of the symbol ahead and writes them in the order like _downloadProvider();
+    files are written in the executor, so writes and fsync don't block the loop.
+    """
+    import asyncio
+    from .aio import run_sync
+    try:
+      task = await run_sync(self._openSymbol, provider, symbol, self.DATETIME_START, self.DATETIME_END,
+                            self.CHUNK_IN_DAYS, self.TIMEFRAME, self.APPEND_DATA)
+    except KeyError:
+      logger.warning('{0}: skip symbol [{1}] because of absent'.format(clsname, symbol))
+      return
+    except FileLockedError as e:
+      logger.warning('{0}: skip symbol [{1}]; ({2})'.format(clsname, symbol, e))
+      return
+    except Exception as e:
+      logger.error('{0}: skip error; ({1})'.format(clsname, e))
+      return
+    pending = deque()
+    for dtS, dtE in task.chunks:
+      pending.append((dtS, dtE, asyncio.ensure_future(self._afetch(task, dtS, dtE, limit))))
+      while len(pending) >= workers:
+        dtS, dtE, fetching = pending.popleft()
+        await run_sync(self._writeChunk, clsname, task, dtS, dtE, await fetching)
+    while pending:
+      dtS, dtE, fetching = pending.popleft()
+      await run_sync(self._writeChunk, clsname, task, dtS, dtE, await fetching)
+    await run_sync(self._closeSymbol, clsname, task)  # other timeframes are made in the executor
+  #----------------------------------------------------------------------
+  async def _afetch(self, task, dtS, dtE, limit):
+    """ Returns the completed future of the chunk's blocks (or of the error) for _writeChunk(). """
+    from concurrent.futures import Future
+    result = Future()
+    async with limit:
+      started = time()
       try:
-        if not is_not_empty(symbol):
-          raise KeyError
-        logger.info('{0}: from {1} to {2}'.format(symbol, dtStart, dtEnd))
-        # get share
-        SHARE = provider[symbol]
-        # get last date from the file if possible
-        name_s = "{0}_{1}.txt".format(symbol, int(timeframe.total_seconds() / 60))
-        path = Path(name_s)
-        myf = None
-        if isAppend and path.is_file():
-          with path.open() as f:
-            lines = f.readlines()
-            dtStart = datetime.strptime(lines[-1].split(';')[1], '%Y-%m-%d %H:%M:%S') + timeframe if len(lines) > 0 else dtStart
-          myf = path.open('a')
-          logger.debug('{0}: append it to an existing file'.format(name_s))
-        else:
-          myf = path.open('w')
-          logger.debug('(0): new file was created'.format(name_s))
-        
-        # get start/end dates for portions downloading in loop
-        dtS, dtE = dtStart, min([dtStart + chunkDays, datetime.today()])
-
-        # sequentially extracts portion of the bars and append it into the file
-        cnt_all = 0
-        while dtEnd > dtS and dtS <= datetime.today():
-          logger.info('{0}: {1}: {2}'.format(symbol, dtS, dtE))
-          cnt = sum(myf.write('{0}\n'.format(it)) for it in SHARE.get_bars(timeframe, dtS, dtE))
-          dtS, dtE = dtS + chunkDays, dtE + chunkDays
-          logger.info('--- {0}: write: {1} '.format(symbol, cnt))
-          cnt_all += cnt
-          
-        myf.close()
-        logger.info('--- {0}: total: {1}'.format(symbol, cnt_all))
-        logger.info('-' * 40)
-        
-      except KeyError:
-        logger.warning('{0}: skip symbol [{1}] because of absent'.format(clsname, symbol))
+        blocks = _Tail([block async for block in task.share.aget_blocks(self.TIMEFRAME, dtS, dtE)])
+        blocks.elapsed = time() - started
+        result.set_result(blocks)
       except Exception as e:
-        logger.error('{0}: skip error; ({1})'.format(clsname, e))
+        result.set_exception(e)
+    return result
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _chunks(dtStart, dtEnd, chunkDays):
+    """ Splits [dtStart, dtEnd) into the request windows not later than now. """
+    now = datetime.today()
+    dtS = dtStart
+    while dtEnd > dtS and dtS <= now:
+      yield dtS, min(dtS + chunkDays, dtEnd, now)
+      dtS += chunkDays
+  #----------------------------------------------------------------------
+  def _store(self, symbol, timeframe):
+    name_s = "{0}_{1}.{2}".format(symbol, int(timeframe.total_seconds() / 60), self.FORMAT)
+    return STORES[self.FORMAT](name_s)
+  #----------------------------------------------------------------------
+  def _openSymbol(self, provider, symbol, dtStart, dtEnd, chunkDays, timeframe, isAppend):
+    """
+    Resolves <symbol>, opens its file and plans the request windows
+    for the time ranges which are absent in the coverage index.
+    """
+    if not is_not_empty(symbol):
+      raise KeyError
+    logger.info('{0}: from {1} to {2}'.format(symbol, dtStart, dtEnd))
+    # get share
+    with Metrics().span('resolve', provider.__class__.__name__, symbol):
+      share = provider[symbol]
+    store = self._store(symbol, timeframe)
+    lock = None
+    if self.SHARD is not None:
+      # processes of other hosts can be given the symbol by another SHARDS
+      lock = FileLock(store.path.with_name(store.path.name + '.lock'))
+      if not lock.acquire():
+        raise FileLockedError(store.path.name)
+    try:
+      return self._openStore(provider, symbol, share, store, lock, dtStart, dtEnd, chunkDays, timeframe, isAppend)
+    except BaseException:
+      if lock is not None:
+        lock.release()
+      raise
+  #----------------------------------------------------------------------
+  def _openStore(self, provider, symbol, share, store, lock, dtStart, dtEnd, chunkDays, timeframe, isAppend):
+    coverage = Coverage(store.path)
+    journal = Journal(store.path, sync=self.FSYNC)
+    name_s = store.path.name
+    last = None
+    pending = []
+    stale = False
+    if isAppend and store.exists():
+      coverage.load()
+      pending, stale = self._recover(store, coverage, journal.load())
+      last = store.last_timestamp()
+      if last and not coverage.ranges:
+        # the file was made before the coverage index
+        coverage.add(next(iter(store.read())).timestamp, last + timeframe)
+        coverage.save()
+      myf = store.open(append=True)
+      logger.debug('{0}: append it to an existing file'.format(name_s))
+    else:
+      coverage.clear()
+      myf = store.open(append=False)
+      logger.debug('{0}: new file was created'.format(name_s))
+    journal.reset()
+    if stale:
+      journal.resample()  # till other timeframes are made again
+    if HotCache().enabled:
+      HotCache().attach(symbol, timeframe, store, append=isAppend)
+    keys = ChunkPlanner.keys(provider.__class__.__name__, symbol, Bar.timedelta2str(timeframe))
+    gaps = coverage.gaps(dtStart, min(dtEnd, datetime.today()))
+    chunks = self._journaled(journal, self._plan(gaps, chunkDays, keys, pending))
+    task = _SymbolTask(symbol, share, store, myf, coverage, last, chunks, keys, timeframe, isAppend, lock, journal)
+    task.stale = stale
+    return task
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _recover(store, coverage, journal):
+    """
+    Repairs the file after the interrupted run by its journal: the unfinished chunk is cut off,
+    the committed patch is merged and committed chunks are marked in the coverage.
+    Returns windows which were requested but not committed and if other timeframes should be made again.
+    """
+    name_s = store.path.name
+    offset = journal.inflight.get('file')
+    if offset is not None and store.path.stat().st_size > offset:
+      os.truncate(str(store.path), offset)
+      logger.info('{0}: the unfinished chunk is removed'.format(name_s))
+    patch = store.__class__(store.path.with_name(name_s + '.patch'))
+    if patch.exists():
+      size = journal.offsets.get('patch', 0)  # bars after the last commit aren't covered
+      if patch.path.stat().st_size > size:
+        os.truncate(str(patch.path), size)
+      if size:
+        merge(store, patch)
+        journal.stale = True
+        logger.info('{0}: the patch of the interrupted run is merged'.format(name_s))
+      patch.remove()
+    if journal.committed:
+      for start, covered in journal.committed:
+        coverage.add(start, covered)
+      coverage.save()
+    if journal.pending:
+      logger.info('{0}: {1} chunks of the interrupted run are resumed'.format(name_s, len(journal.pending)))
+    return journal.pending, journal.stale
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _journaled(journal, chunks):
+    for dtS, dtE in chunks:
+      journal.plan(dtS, dtE)
+      yield dtS, dtE
+  #----------------------------------------------------------------------
+  def _split(self, start, end, chunkDays, keys):
+    if self.PLANNER is None:
+      return self._chunks(start, end, chunkDays)
+    return self.PLANNER.chunks(keys, start, end, datetime.today())
+  #----------------------------------------------------------------------
+  def _plan(self, gaps, chunkDays, keys, pending=()):
+    """
+    Yields request windows; the <pending> windows of the interrupted run are requested as they were
+    (so closed windows are found in the cache), adaptive sizes are taken at the moment of the request.
+    """
+    for gS, gE in gaps:
+      for pS, pE in pending:
+        pS, pE = max(pS, gS), min(pE, gE)
+        if pS < pE:
+          yield from self._split(gS, pS, chunkDays, keys)
+          yield pS, pE
+          gS = pE
+      yield from self._split(gS, gE, chunkDays, keys)
+  #----------------------------------------------------------------------
+  def _downloadProvider(self, provider, symbols, dtStart, dtEnd, chunkDays, timeframe, isAppend, workers=1):
+    """
+    Downloads the stock data for <symbols> from <provider> and put all of this the txt-file.
+    Up to <workers> chunks are requested at once, but they are written in the order.
+    """
+    clsname = provider.__class__.__name__
+    logger.info('*' * 40)
+    logger.info('{0}: start downloading...'.format(clsname))
+    logger.info('*' * 40)
+
+    def fetch(task, dtS, dtE):
+      started = time()
+      blocks = _Tail(list(task.share.get_blocks(timeframe, dtS, dtE)))
+      blocks.elapsed = time() - started
+      return blocks
+
+    def stream(task, dtS, dtE):
+      return _Tail(task.share.get_blocks(timeframe, dtS, dtE))
+
+    from concurrent.futures import ThreadPoolExecutor
+    workers = max(int(workers), 1)
+    pending = deque()  # requested chunks in the writing order
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+      # One worker writes bars while they are downloading, others keep chunks in memory
+      submit = partial(pool.submit, fetch) if workers > 1 else partial(_Deferred, stream)
+      for symbol in symbols:
+        try:
+          task = self._openSymbol(provider, symbol, dtStart, dtEnd, chunkDays, timeframe, isAppend)
+        except KeyError:
+          logger.warning('{0}: skip symbol [{1}] because of absent'.format(clsname, symbol))
+          continue
+        except FileLockedError as e:
+          logger.warning('{0}: skip symbol [{1}]; ({2})'.format(clsname, symbol, e))
+          continue
+        except Exception as e:
+          logger.error('{0}: skip error; ({1})'.format(clsname, e))
+          continue
+        for dtS, dtE in task.chunks:
+          pending.append((task, dtS, dtE, submit(task, dtS, dtE)))
+          # keeps a bounded number of downloaded chunks in memory
+          while len(pending) > 2 * workers - 1:
+            self._writeChunk(clsname, *pending.popleft())
+        pending.append((task, None, None, None))  # closes the symbol after its chunks
+      while pending:
+        self._writeChunk(clsname, *pending.popleft())
 
     logger.info('{0}: end'.format(clsname))
+  #----------------------------------------------------------------------
+  def _writeChunk(self, clsname, task, dtS, dtE, future):
+    """
+    Waits for the chunk and appends it into the symbol's file;
+    chunks before the end of file are collected for merging.
+    The rest of the truncated window is requested at once, so bars are still written in the order.
+    """
+    if future is None:
+      self._closeSymbol(clsname, task)
+      return
+    origin = None
+    while True:
+      rest = self._writeWindow(clsname, task, dtS, dtE, future, origin)
+      if rest is None:
+        return
+      dtS, dtE, origin = rest
+      future = _Deferred(self._fetchRest, task, dtS, dtE)
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _fetchRest(task, dtS, dtE):
+    started = time()
+    blocks = _Tail(list(task.share.get_blocks(task.timeframe, dtS, dtE)))
+    blocks.elapsed = time() - started
+    return blocks
+  #----------------------------------------------------------------------
+  def _writeWindow(self, clsname, task, dtS, dtE, future, origin=None):
+    """
+    Writes the window and returns (start, end, origin) of its rest if the response is truncated or None.
+    <origin> is (start, end, rows, latency, covered) of the window which is checked by this rest (see is_suspect()).
+    """
+    metrics = Metrics()
+    writer = None
+    try:
+      logger.info('{0}: {1}: {2}'.format(task.symbol, dtS, dtE))
+      blocks = future.result()
+      target = 'patch' if task.last is not None and dtS < task.last else 'file'
+      writer = task.patch_writer() if target == 'patch' else task.file
+      started, committed = time(), writer.committed
+      task.journal.begin(dtS, dtE, target, committed)
+      # bars before the patch are merged without duplicates, both files get only bars after their tails
+      written = [] if target == 'file' and HotCache().enabled else None
+      cnt = writer.write_blocks(_after(blocks, task.patch_tail) if target == 'patch' else _after(blocks, task.tail, written))
+      # the chunk is written completely before it's marked in the journal and the coverage
+      writer.commit(sync=self.FSYNC)
+      last = blocks.last.timestamp if blocks.last is not None else None
+      if target == 'file' and last is not None and (task.tail is None or last > task.tail):
+        task.tail = last
+      elif target == 'patch' and last is not None and (task.patch_tail is None or last > task.patch_tail):
+        task.patch_tail = last
+      # a streamed chunk is received (and parsed) while it's being written
+      metrics.record('fetch', clsname, task.symbol, blocks.fetched)
+      metrics.record('write', clsname, task.symbol, max(time() - started - blocks.waited, 0.0))
+      metrics.inc('bars_chunks_total', provider=clsname, symbol=task.symbol)
+      metrics.inc('bars_rows_total', cnt, provider=clsname, symbol=task.symbol)
+      metrics.inc('bars_bytes_total', writer.committed - committed, provider=clsname, symbol=task.symbol)
+      logger.info('--- {0}: write: {1} '.format(task.symbol, cnt))
+      task.count += cnt
+      closed = dtE < datetime.today() - self.SETTLE_TIME
+      truncated = suspect = False
+      if self.PLANNER is not None:
+        truncated = self.PLANNER.is_truncated(task.keys, blocks.rows, last, dtE, task.timeframe)
+        suspect = closed and not truncated and self.PLANNER.is_suspect(task.keys, blocks.rows, last, dtE, task.timeframe)
+      if truncated:
+        logger.info('--- {0}: truncated at {1}'.format(task.symbol, last))
+      # The fresh, truncated or suspect window is covered up to the last bar only
+      covered = dtE
+      if not closed or truncated or suspect:
+        covered = min(last + task.timeframe, dtE) if last is not None else dtS
+      task.journal.commit(dtS, dtE, target, writer.committed, covered)
+      task.coverage.add(dtS, covered)
+      task.coverage.save()
+      if written:
+        HotCache().add(task.symbol, task.timeframe, written)
+      if self.PLANNER is not None:
+        if origin is not None:
+          # bars after the end of the suspect window mean that it was cut by the provider
+          oS, oE, rows, latency, oCovered = origin
+          self.PLANNER.observe(task.keys, oS, oE, rows, latency, oCovered if last is not None and last >= oCovered else oE)
+        if not suspect:
+          early = closed and last is not None and last + task.timeframe < dtE
+          self.PLANNER.observe(task.keys, dtS, dtE, blocks.rows, blocks.elapsed, covered if truncated else dtE,
+                               grow=not early)
+      if (truncated or suspect) and covered < dtE:
+        # the provider is requested by dates: the rest starts at the day of the last bar to count its limit
+        start = datetime.combine(last.date(), datetime.min.time())
+        start = start if start > dtS else covered
+        task.journal.plan(start, dtE)
+        return start, dtE, (dtS, dtE, blocks.rows, blocks.elapsed, covered) if suspect else None
+    except Exception as e:
+      # the window stays absent in the coverage and will be requested again
+      logger.error('{0}: skip error; ({1})'.format(clsname, e))
+      metrics.inc('bars_chunks_total', provider=clsname, symbol=task.symbol)
+      metrics.inc('bars_failures_total', stage='chunk', provider=clsname, symbol=task.symbol, error=e.__class__.__name__)
+      if writer is not None:
+        writer.rollback()
+        task.journal.abort(dtS, dtE, target)
+    return None
+  #----------------------------------------------------------------------
+  def _closeSymbol(self, clsname, task):
+    """ Closes the downloaded symbol's file and makes other timeframes from it. """
+    append = task.append and not task.stale  # the recovered patch is merged
+    task.close()
+    try:
+      failed = False
+      if task.patch is not None:
+        try:
+          merge(task.store, task.patch)
+          task.journal.resample()
+          task.patch.remove()
+          if HotCache().enabled:
+            HotCache().invalidate(task.symbol, task.timeframe)
+          append = False  # other timeframes are made again
+        except Exception as e:
+          failed = True
+          logger.error('{0}: skip error; ({1})'.format(clsname, e))
+      for period in self.TIMEFRAMES:
+        try:
+          with Metrics().span('resample', clsname, task.symbol):
+            cnt = self._resample(task.symbol, task.timeframe, period, append)
+          logger.info('--- {0}: {1}: resampled: {2}'.format(task.symbol, Bar.timedelta2str(period), cnt))
+        except Exception as e:
+          failed = True
+          logger.error('{0}: skip error; ({1})'.format(clsname, e))
+      # otherwise the patch is merged and other timeframes are made again by the next run
+      if failed:
+        task.journal.close()
+      else:
+        task.journal.clear()
+    finally:
+      # files of other timeframes are written under the lock of the symbol's file
+      if task.lock is not None:
+        task.lock.release()
+  #----------------------------------------------------------------------
+  def _resample(self, symbol, timeframe, period, isAppend):
+    """
+    Appends finished <period> bars made from the <timeframe> file;
+    only base bars after the last result bar are read.
+    """
+    resampler = Resampler(period, timeframe)
+    store = self._store(symbol, period)
+    start = None
+    if isAppend and store.exists():
+      last = store.last_timestamp()
+      start = resampler.next_start(last) if last else None
+    hot = HotCache()
+    written = [] if hot.enabled else None
+    if hot.enabled:
+      hot.attach(symbol, period, store, append=isAppend)
+    writer = store.open(append=isAppend)
+    try:
+      bars = resampler.update(self._store(symbol, timeframe).read(start))
+      cnt = writer.write(_kept(bars, written) if hot.enabled else bars)
+      last = resampler.flush(min(self.DATETIME_END, datetime.now()))
+      if last is not None:
+        cnt += writer.write([last])
+        if hot.enabled:
+          written.append(last)
+    finally:
+      writer.close()
+    if written:
+      hot.add(symbol, period, [BarBlock.from_bars(written)])
+    return cnt
+
+
+#----------------------------------------------------------------------
+def _after(blocks, stamp, written=None):
+  """
+  Yields parts of sorted <blocks> after <stamp>, so a bar at the end of the previous window isn't repeated;
+  the yielded parts are added to the list <written> if it's given.
+  """
+  seconds = to_epoch(stamp) if stamp is not None else None
+  for block in blocks:
+    if seconds is not None:
+      lo = bisect_right(block.timestamp, seconds)
+      if lo == len(block):
+        continue
+      if lo:
+        block = block[lo:]
+      seconds = None
+    if written is not None:
+      written.append(block)
+    yield block
+#----------------------------------------------------------------------
+def _kept(items, written):
+  """ Yields <items> and adds them to the list <written> """
+  for it in items:
+    written.append(it)
+    yield it
+#----------------------------------------------------------------------
+def _worker(file_name, shard, level):
+  """ Entry point of the process of the shard """
+  setup_logging()
+  logger.setLevel(level)
+  Downloads(file_name, shard).startTimer()
+
+
+#######################################################################
+class _SymbolTask(object):
+  """
+  Downloading state of one symbol
+  """
+  __slots__ = ("symbol", "share", "store", "file", "coverage", "last", "chunks", "keys",
+               "timeframe", "append", "lock", "journal", "tail", "patch", "patch_tail", "_patch_writer", "stale", "count")
+
+  #----------------------------------------------------------------------
+  def __init__(self, symbol, share, store, file, coverage, last, chunks, keys, timeframe, append, lock=None, journal=None):
+    self.symbol = symbol
+    self.share = share
+    self.store = store
+    self.file = file
+    self.coverage = coverage
+    self.last = last
+    self.chunks = chunks
+    self.keys = keys
+    self.timeframe = timeframe
+    self.append = append
+    self.lock = lock  # FileLock of the symbol's file in the sharded mode
+    self.journal = journal
+    self.tail = last  # timestamp of the last bar in the file
+    self.patch = None
+    self.patch_tail = None  # timestamp of the last bar in the patch
+    self._patch_writer = None
+    self.stale = False  # other timeframes are made from the whole file
+    self.count = 0
+
+  #----------------------------------------------------------------------
+  def patch_writer(self):
+    """ Writer of bars which should be merged into the middle of the file """
+    if self._patch_writer is None:
+      self.patch = self.store.__class__(self.store.path.with_name(self.store.path.name + '.patch'))
+      self._patch_writer = self.patch.open(append=False)
+    return self._patch_writer
+
+  #----------------------------------------------------------------------
+  def close(self):
+    self.file.close()
+    if self._patch_writer is not None:
+      self._patch_writer.close()
+    self.journal.close()
+    logger.info('--- {0}: total: {1}'.format(self.symbol, self.count))
+    logger.info('-' * 40)
+
+
+#######################################################################
+class _Deferred(object):
+  """ Chunk which is requested only when its result is needed """
+  __slots__ = ("fn", "args")
+
+  #----------------------------------------------------------------------
+  def __init__(self, fn, *args):
+    self.fn = fn
+    self.args = args
+
+  #----------------------------------------------------------------------
+  def result(self):
+    return self.fn(*self.args)
+
+
+#######################################################################
+class _Tail(object):
+  """
+  Iterates over blocks of bars and remembers the last bar and the time of the request;
+  <waited> is the time of waiting for the blocks of the streamed request while they are iterated.
+  """
+  __slots__ = ("blocks", "last", "rows", "elapsed", "waited")
+
+  #----------------------------------------------------------------------
+  def __init__(self, blocks):
+    self.blocks = blocks
+    self.last = None
+    self.rows = 0  # bars of the response
+    self.elapsed = None  # seconds of the request
+    self.waited = 0.0
+
+  #----------------------------------------------------------------------
+  @property
+  def fetched(self):
+    """ Seconds of receiving the blocks: the prefetched request or waiting for the streamed one """
+    return self.elapsed if isinstance(self.blocks, list) else self.waited
+
+  #----------------------------------------------------------------------
+  def __iter__(self):
+    started = time()
+    blocks = iter(self.blocks)
+    while True:
+      waiting = time()
+      block = next(blocks, None)
+      self.waited += time() - waiting
+      if block is None:
+        break
+      if len(block):
+        self.last = block[-1]
+        self.rows += len(block)
+      yield block
+    if self.elapsed is None:
+      self.elapsed = time() - started
@@ -2,15 +2,19 @@
 This module contains FinamProvider which automatically load data from finam.ru web site.
 """
 
-import csv
-from datetime import datetime, timedelta
+from bisect import bisect_left
+from datetime import timedelta
+import json
+import os
 from pathlib import Path
 import re
+from time import time
 
-from .base import DataProvider, InvalidDataFormatError, Ticker, \
-  DataNotFoundError, DataObtainError, Bar
-from .common import requests_retry_session, Singleton
+from .base import DataProvider, Ticker, DataNotFoundError, DataObtainError
+from .common import Sessions, iter_response_lines
 from .log import logger
+from .parsing import parse_finam, iter_blocks, clip_blocks
+from .singleton import Singleton
 
 __all__ = ["FinamProvider"]
 
@@ -18,44 +22,116 @@ __all__ = ["FinamProvider"]
 class FinamSymbols(object, metaclass=Singleton):
   """
   Symbols dictionary will be download once.
+  It's cached in the local file and re-fetched only after <cache_ttl> minutes if it has changed.
   """
+  URL = 'https://www.finam.ru/cache/icharts/icharts.js'
   #----------------------------------------------------------------------
-  def __init__(self):
+  def __init__(self, cache_file='finam_symbols.json', cache_ttl=1440):
     logger.debug("FinamSymbols.init")
     # Download once
     try:
       self.resolutions = None
       self.aEmitentCodes, self.aEmitentIds, self.aEmitentMarkets = None,None,None
-      with requests_retry_session() as sess:
-        response = sess.get('https://www.finam.ru/cache/icharts/icharts.js',)
-        for it in response.iter_lines():
-          line = it.decode("utf-8", "ignore")
-          m = re.match(r"var\s+(\w+)\s*=\s*new\s*Array\s*(.*)", line)
-          if m is None:
-            m = re.match(r"var\s+(\w+)\s*=\s*\s*\[(.*)", line)
-          if m is not None:
-            varname = m.group(1)
-            varval = m.group(2)
-            if varname == "aEmitentIds":
-              self.aEmitentIds = self._parsetuple(varval.replace("'", ""))
-            elif varname == "aEmitentCodes":
-              self.aEmitentCodes = self._parsetuple(varval.replace("'", ""))
-            elif varname == "aEmitentMarkets":
-              self.aEmitentMarkets = self._parsetuple(varval.replace("'", ""))
-       
-        self.resolutions = {
-          timedelta(minutes=1):  2,
-          timedelta(minutes=5):  3,
-          timedelta(minutes=10): 4,
-          timedelta(minutes=15): 5,
-          timedelta(minutes=30): 6,
-          timedelta(hours=1):    7,
-          timedelta(days=1):     8,
-          timedelta(weeks=1):    9,
-        }
+      cache = self._load_cache(cache_file)
+      if cache and time() - cache['fetched'] < cache_ttl * 60:
+        logger.debug('FinamSymbols: from cache {0}'.format(cache_file))
+      else:
+        cache = self._fetch(cache)
+        self._save_cache(cache_file, cache)
+      self.aEmitentCodes, self.aEmitentIds, self.aEmitentMarkets = cache['codes'], cache['ids'], cache['markets']
+      self._build_index()
+
+      self.resolutions = {
+        timedelta(minutes=1):  2,
+        timedelta(minutes=5):  3,
+        timedelta(minutes=10): 4,
+        timedelta(minutes=15): 5,
+        timedelta(minutes=30): 6,
+        timedelta(hours=1):    7,
+        timedelta(days=1):     8,
+        timedelta(weeks=1):    9,
+      }
     except Exception as e:
       raise DataObtainError("FinamSymbols - Finam symbols dictionary", e);
   #----------------------------------------------------------------------
+  def _build_index(self):
+    """ Builds lookup tables: code (case-insensitive), market and emitent id to positions in arrays. """
+    self.codes_index, self.markets_index, self.ids_index = {}, {}, {}
+    for i, (code, id_, market) in enumerate(zip(self.aEmitentCodes, self.aEmitentIds, self.aEmitentMarkets)):
+      self.codes_index.setdefault(code.lower(), []).append((i, market, id_))
+      self.markets_index.setdefault(market, []).append(i)
+      self.ids_index.setdefault(id_, []).append(i)
+    self.sorted_codes = sorted(self.codes_index)
+  #----------------------------------------------------------------------
+  def _fetch(self, cache):
+    """ Downloads the dictionary if it was changed since <cache> was saved. """
+    headers = {}
+    if cache and cache.get('etag'):
+      headers['If-None-Match'] = cache['etag']
+    if cache and cache.get('last_modified'):
+      headers['If-Modified-Since'] = cache['last_modified']
+    try:
+      response = Sessions().get(self.URL, headers=headers)
+      if cache and response.status_code == 304:
+        logger.debug('FinamSymbols: not modified')
+        cache['fetched'] = time()
+        return cache
+      response.raise_for_status()
+      codes, ids, markets = None, None, None
+      for it in response.iter_lines():
+        line = it.decode("utf-8", "ignore")
+        m = re.match(r"var\s+(\w+)\s*=\s*new\s*Array\s*(.*)", line)
+        if m is None:
+          m = re.match(r"var\s+(\w+)\s*=\s*\s*\[(.*)", line)
+        if m is not None:
+          varname = m.group(1)
+          varval = m.group(2)
+          if varname == "aEmitentIds":
+            ids = self._parsetuple(varval.replace("'", ""))
+          elif varname == "aEmitentCodes":
+            codes = self._parsetuple(varval.replace("'", ""))
+          elif varname == "aEmitentMarkets":
+            markets = self._parsetuple(varval.replace("'", ""))
+      if codes is None or ids is None or markets is None:
+        raise ValueError('Unknown format of the symbols dictionary.')
+      return dict(fetched=time(),
+                  etag=response.headers.get('ETag'),
+                  last_modified=response.headers.get('Last-Modified'),
+                  codes=codes, ids=ids, markets=markets)
+    except Exception as e:
+      if not cache:
+        raise
+      logger.warning('FinamSymbols: use an outdated cache; ({0})'.format(e))
+      return cache
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _load_cache(file_name):
+    """ Returns the saved dictionary or None if it's absent or broken. """
+    if not file_name:
+      return None
+    try:
+      with open(file_name, encoding='utf-8') as f:
+        cache = json.load(f)
+      if not isinstance(cache, dict) or not isinstance(cache.get('fetched'), (int, float)) or \
+         not all(isinstance(cache.get(key), list) for key in ('codes', 'ids', 'markets')):
+        raise ValueError('unknown format')
+      return cache
+    except (OSError, ValueError) as e:
+      logger.debug('FinamSymbols: cache is not loaded; ({0})'.format(e))
+      return None
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _save_cache(file_name, cache):
+    if not file_name:
+      return
+    try:
+      tmp_name = '{0}.tmp{1}'.format(file_name, os.getpid())  # other processes can save it at once
+      with open(tmp_name, 'w', encoding='utf-8') as f:
+        json.dump(cache, f, separators=(',', ':'))
+      os.replace(tmp_name, file_name)
+    except OSError as e:
+      logger.warning('FinamSymbols: cache is not saved; ({0})'.format(e))
+  #----------------------------------------------------------------------
   @staticmethod
   def _parsetuple(s, trans=str):
     # Don't use 'eval'. Cause it's dangerous!
@@ -67,8 +143,10 @@ class FinamProvider(DataProvider):
   Loads data from finam.ru.
   """
   __slots__ = ()
-  def __init__(self):
-    FinamSymbols()
+  URL = 'http://export.finam.ru/'
+  HEADERS = {'Referer': "http://www.finam.ru/analysis/export/default.asp"}
+  def __init__(self, cache_file='finam_symbols.json', cache_ttl=1440):
+    FinamSymbols(cache_file, cache_ttl)
   #----------------------------------------------------------------------
   def __getattr__(self, name):
     """transfer attr ref"""
@@ -78,41 +156,52 @@ class FinamProvider(DataProvider):
       raise AttributeError("object has no attribute '{0}'".format(name))
   #----------------------------------------------------------------------
   def _generator(self, ticker, lines, start, end, period):
-    """ Wrap responsed data with CSV parser and return elements in the order. """
-    for datalist in csv.reader(lines.splitlines(), delimiter=';', quotechar='"'):
-      try:
-        d, t, o, h, l, c, v = datalist
-        o, h, l, c, v = float(o), float(h), float(l), float(c), int(v)
-        stamp = datetime.strptime(d + t, "%Y%m%d%H%M%S")
-      except ValueError:
-        raise InvalidDataFormatError(ticker, str(datalist))
-      if stamp < start:
-        continue
-      elif stamp > end:
-        return# raise StopIteration
-      yield Bar(ticker, stamp, period, o, h, l, c, v)
+    """ Wrap responsed data with CSV parser and return blocks of bars in the order. """
+    return clip_blocks(iter_blocks(parse_finam, lines, ticker, period), start, end)
   #----------------------------------------------------------------------
   def find(self, query):
-    result = []
     if self.aEmitentCodes == None:
-      return result
-    for i, code in enumerate(self.aEmitentCodes):
-      if query.lower() == code.lower():
-        result.append(Ticker(self, code, market=self.aEmitentMarkets[i], id=self.aEmitentIds[i]))
+      return []
+    result = [Ticker(self, self.aEmitentCodes[i], market=market, id=id_)
+              for i, market, id_ in self.codes_index.get(query.lower(), ())]
     if not result:
       raise DataNotFoundError(query)
     return result
   #----------------------------------------------------------------------
+  def _tickers(self, indexes):
+    return [Ticker(self, self.aEmitentCodes[i], market=self.aEmitentMarkets[i], id=self.aEmitentIds[i]) for i in indexes]
+  #----------------------------------------------------------------------
+  def find_by_market(self, market):
+    """ Returns all tickers of the market. """
+    return self._tickers(self.markets_index.get(str(market), ()))
+  #----------------------------------------------------------------------
+  def find_by_id(self, id_):
+    """ Returns tickers with the emitent id. """
+    return self._tickers(self.ids_index.get(str(id_), ()))
+  #----------------------------------------------------------------------
+  def find_prefix(self, prefix, limit=None):
+    """ Returns tickers which codes start with <prefix> (case-insensitive), for autocomplete. """
+    prefix = prefix.lower()
+    codes = self.sorted_codes
+    result = []
+    for pos in range(bisect_left(codes, prefix), len(codes)):
+      if not codes[pos].startswith(prefix):
+        break
+      result.extend(i for i, _, _ in self.codes_index[codes[pos]])
+      if limit is not None and len(result) >= limit:
+        break
+    return self._tickers(result[:limit])
+  #----------------------------------------------------------------------
   def save_codes(self, file_name):
     with Path(file_name).open() as f:
       for i, code in enumerate(self.aEmitentCodes):
         f.write('{0};{1};{2};{3}\n'.format(code, self.aEmitentIds[i], self.aEmitentNames[i], self.aEmitentMarkets[i]))
   #----------------------------------------------------------------------
   def bars(self, ticker, start, end, period):
-    """
-    Finds ticker in the finam's database stored in export.js file which parsed before
-    and download data from a remote service
-    """
+    """ Downloads bars; see blocks() """
+    return (bar for block in self.blocks(ticker, start, end, period) for bar in block.bars())
+  #----------------------------------------------------------------------
+  def _url(self, ticker, start, end, period):
     fmt = "%y%m%d"  # Date format of request
     dfrom = start.date()
     dto = end.date()
@@ -146,17 +235,42 @@ class FinamProvider(DataProvider):
     
     # http://export.finam.ru/SBER_080521_080531.csv?d=d&market=517&em=419750&df=21&mf=4&yf=2008&dt=31&mt=4&yt=2008&p=2&f=SBER_080521_080531&e=.csv&cn=SBER&dtf=1&tmf=1&MSOR=1&sep=3&sep2=1&datf=5&at=0
     # url = ("http://195.128.78.52/{f}{e}?" + 
-    url = ("http://export.finam.ru/{f}{e}?" + 
+    url = (self.URL + "{f}{e}?" + 
           "d=d&market={market}&em={em}&df={df}&" + 
           "mf={mf}&yf={yf}&dt={dt}&mt={mt}&yt={yt}&" + 
           "p={p}&f={f}&e={e}&cn={cn}&dtf={dtf}&tmf={tmf}&" + 
           "MSOR={MSOR}&sep={sep}&sep2={sep2}&datf={datf}&at={at}").format(**rdict)
+    return url
+  #----------------------------------------------------------------------
+  def blocks(self, ticker, start, end, period):
+    """
+    Finds ticker in the finam's database stored in export.js file which parsed before
+    and download data from a remote service
+    """
+    url = self._url(ticker, start, end, period)
     try:
-      with requests_retry_session()as sess:
-        response = sess.get(url, headers = {'Referer': "http://www.finam.ru/analysis/export/default.asp"})
-        decoded = response.content.decode('utf-8', "ignore")
-        return self._generator(ticker, decoded, start, end, period) # Return generator which parses data
+      response = Sessions().get(url, headers=self.HEADERS, stream=True)
+      # Return generator which parses data while it's downloading
+      return self._generator(ticker, iter_response_lines(response), start, end, period)
     except Exception as e:
       raise DataObtainError(ticker, e)
     else:
       logger.debug('request OK: {0}'.format(response.status_code))
+  #----------------------------------------------------------------------
+  async def afind(self, query):
+    return self.find(query)  # it's searched in the local index
+  #----------------------------------------------------------------------
+  async def ablocks(self, ticker, start, end, period):
+    """ Non-blocking blocks() through aiohttp (in the executor without it) """
+    from .aio import AsyncSessions, aiter_response_lines, aiter_blocks, aclip_blocks
+    if not AsyncSessions.available:
+      async for block in super(FinamProvider, self).ablocks(ticker, start, end, period):
+        yield block
+      return
+    url = self._url(ticker, start, end, period)
+    try:
+      response = await AsyncSessions().get(url, headers=self.HEADERS)
+    except Exception as e:
+      raise DataObtainError(ticker, e)
+    async for block in aclip_blocks(aiter_blocks(parse_finam, aiter_response_lines(response), ticker, period), start, end):
+      yield block
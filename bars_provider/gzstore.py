@@ -0,0 +1,276 @@
+"""
+Compressed text file of bars: independent gzip members (the file is still read by zcat/gzip) with a block index
+of their offsets and time ranges, so bars are appended, resumed and read from a timestamp without
+decompressing the whole file.
+"""
+
+from bisect import bisect_left
+import gzip
+from itertools import islice
+import os
+from pathlib import Path
+import struct
+import zlib
+
+from .base import BarBlock, to_epoch, from_epoch
+from .storage import BarWriter, TextBarFile, format_bars, format_block
+
+
+__all__ = ["GzipBarFile", "GzipBarWriter"]
+
+
+GZIP_MAGIC = b'\x1f\x8b'
+# offset and size of the member, timestamps (epoch seconds) of its first and last bar, count of bars
+ENTRY = struct.Struct('<QQqqQ')
+
+
+#----------------------------------------------------------------------
+def _scan(f, offset, size):
+  """ Returns the end of the complete gzip member at <offset> and its text or (None, None) if it's broken. """
+  f.seek(offset)
+  decoder = zlib.decompressobj(zlib.MAX_WBITS | 16)
+  parts = []
+  pos = offset
+  while pos < size and not decoder.eof:
+    data = f.read(min(TextBarFile.BLOCK_SIZE * 8, size - pos))
+    if not data:
+      break
+    try:
+      parts.append(decoder.decompress(data))
+    except zlib.error:
+      return None, None
+    pos += len(data)
+  if not decoder.eof:
+    return None, None
+  return pos - len(decoder.unused_data), b''.join(parts)
+
+
+#######################################################################
+class GzipBarFile(object):
+  """
+  Text lines of TextBarFile compressed by members of up to MEMBER_ROWS bars; every commit of the writer
+  finishes its member. The index {file}.idx has an ENTRY per member. It's checked against the file:
+  entries after its end are dropped and complete members without entries (a crash between the writing
+  of the member and of its entry) are found by decompressing only them.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name):
+    self.path = Path(file_name)
+    self.index_path = self.path.with_name(self.path.name + '.idx')
+
+  #----------------------------------------------------------------------
+  def exists(self):
+    return self.path.is_file()
+
+  #----------------------------------------------------------------------
+  def _entries(self, f):
+    """ Returns (entries of complete members, size of the complete part of the file). """
+    size = f.seek(0, os.SEEK_END)
+    entries = []
+    try:
+      with self.index_path.open('rb') as fi:
+        data = fi.read()
+    except FileNotFoundError:
+      data = b''
+    end = 0
+    for entry in ENTRY.iter_unpack(data[:len(data) - len(data) % ENTRY.size]):
+      f.seek(entry[0])
+      if entry[0] != end or entry[0] + entry[1] > size or f.read(2) != GZIP_MAGIC:
+        break
+      entries.append(entry)
+      end = entry[0] + entry[1]
+    f.seek(end)
+    if end < size and f.read(2) != GZIP_MAGIC:  # the index of another file
+      entries, end = [], 0
+    while end < size:
+      member_end, text = _scan(f, end, size)
+      if member_end is None:
+        break
+      lines = text.splitlines()
+      if lines:
+        entries.append((end, member_end - end, to_epoch(TextBarFile.parse_timestamp(lines[0].decode('utf-8'))),
+                        to_epoch(TextBarFile.parse_timestamp(lines[-1].decode('utf-8'))), len(lines)))
+      end = member_end
+    return entries, end
+
+  #----------------------------------------------------------------------
+  def entries(self):
+    """ Returns the index: (offset, size, first timestamp, last timestamp, count) of every member. """
+    if not self.exists():
+      return []
+    with self.path.open('rb') as f:
+      return self._entries(f)[0]
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _lines(f, entry):
+    f.seek(entry[0])
+    return zlib.decompress(f.read(entry[1]), zlib.MAX_WBITS | 16).decode('utf-8', 'ignore').splitlines()
+
+  #----------------------------------------------------------------------
+  def read(self, start=None, ticker=None):
+    """ Yields bars from <start> (or from the beginning); members before <start> aren't decompressed. """
+    if not self.exists():
+      return
+    with self.path.open('rb') as f:
+      entries = self._entries(f)[0]
+      first = bisect_left([it[3] for it in entries], to_epoch(start)) if start is not None else 0
+      for entry in entries[first:]:
+        for line in self._lines(f, entry):
+          if not line.strip():
+            continue
+          bar = TextBarFile.parse_bar(line, ticker)
+          ticker = ticker or bar.ticker  # all bars share one ticker
+          if start is None or bar.timestamp >= start:
+            yield bar
+
+  #----------------------------------------------------------------------
+  def tail(self, count, ticker=None):
+    """ Returns the last <count> bars as BarBlock; only the last members are decompressed. """
+    lines = []
+    if self.exists() and count:
+      with self.path.open('rb') as f:
+        for entry in reversed(self._entries(f)[0]):
+          lines[:0] = [line for line in self._lines(f, entry) if line.strip()]
+          if len(lines) >= count:
+            break
+    bars = []
+    for line in lines[-count:] if count else []:
+      bars.append(TextBarFile.parse_bar(line, ticker))
+      ticker = ticker or bars[-1].ticker
+    return BarBlock.from_bars(bars, ticker)
+
+  #----------------------------------------------------------------------
+  def last_timestamp(self):
+    """ Returns the timestamp of the last bar (from the index) or None for an empty file. """
+    entries = self.entries()
+    return from_epoch(entries[-1][3]) if entries else None
+
+  #----------------------------------------------------------------------
+  def repair(self):
+    """ Cuts the unfinished member off and rewrites the index of the file; returns the number of removed bytes. """
+    with self.path.open('r+b') as f:
+      size = f.seek(0, os.SEEK_END)
+      entries, complete = self._entries(f)
+      if complete < size:
+        f.truncate(complete)
+    with self.index_path.open('wb') as fi:
+      fi.write(b''.join(ENTRY.pack(*it) for it in entries))
+    return size - complete
+
+  #----------------------------------------------------------------------
+  def open(self, append):
+    """ Opens the file for writing; the appended file is repaired before. """
+    if append and self.exists():
+      self.repair()
+      return GzipBarWriter(self.path, append=True)
+    return GzipBarWriter(self.path, append=False)
+
+  #----------------------------------------------------------------------
+  def replace(self, other):
+    """ Moves the file of the <other> store and its index over this one. """
+    os.replace(str(other.path), str(self.path))
+    if other.index_path.is_file():
+      os.replace(str(other.index_path), str(self.index_path))
+    elif self.index_path.is_file():
+      self.index_path.unlink()
+
+  #----------------------------------------------------------------------
+  def remove(self):
+    self.path.unlink()
+    if self.index_path.is_file():
+      self.index_path.unlink()
+
+
+#######################################################################
+class GzipBarWriter(BarWriter):
+  """
+  Appends text lines by gzip members: bars are collected till MEMBER_ROWS or commit() and compressed at once.
+  Entries of the members are written to the index after the members themselves, so the index never points
+  after the end of the file; rollback() drops the collected bars and members after the last commit.
+  """
+  MEMBER_ROWS = 10000
+  LEVEL = 6
+
+  #----------------------------------------------------------------------
+  def __init__(self, path, append):
+    super(GzipBarWriter, self).__init__(path, append)
+    self.index = open(str(Path(path).with_name(Path(path).name + '.idx')), 'ab' if append else 'wb')
+    self._parts, self._rows, self._first, self._last = [], 0, None, None
+    self._entries = []  # entries of the members which aren't in the index yet
+
+  #----------------------------------------------------------------------
+  def _add(self, data, first, last, rows):
+    self._parts.append(data)
+    self._first = first if self._first is None else self._first
+    self._last = last
+    self._rows += rows
+    if self._rows >= self.MEMBER_ROWS:
+      self._finish()
+
+  #----------------------------------------------------------------------
+  def _finish(self):
+    """ Compresses the collected bars to the member. """
+    if self._rows:
+      data = gzip.compress(b''.join(self._parts), self.LEVEL, mtime=0)
+      self._entries.append((self.f.tell(), len(data), self._first, self._last, self._rows))
+      self.f.write(data)
+    self._parts, self._rows, self._first, self._last = [], 0, None, None
+
+  #----------------------------------------------------------------------
+  def write(self, bars):
+    """ Writes bars and returns their count. """
+    cnt = 0
+    bars = iter(bars)
+    while True:
+      batch = list(islice(bars, self.BATCH))
+      if not batch:
+        return cnt
+      self._add(format_bars(batch).encode('utf-8'), to_epoch(batch[0].timestamp), to_epoch(batch[-1].timestamp),
+                len(batch))
+      cnt += len(batch)
+
+  #----------------------------------------------------------------------
+  def write_blocks(self, blocks):
+    """ Writes BarBlock iterable and returns the count of bars. """
+    cnt = 0
+    for block in blocks:
+      if len(block):
+        self._add(format_block(block).encode('utf-8'), block.timestamp[0], block.timestamp[-1], len(block))
+        cnt += len(block)
+    return cnt
+
+  #----------------------------------------------------------------------
+  def _flush_index(self, sync):
+    self._finish()
+    self.f.flush()
+    if sync:
+      os.fsync(self.f.fileno())
+    if self._entries:
+      self.index.write(b''.join(ENTRY.pack(*it) for it in self._entries))
+      self.index.flush()
+      if sync:
+        os.fsync(self.index.fileno())
+      self._entries = []
+
+  #----------------------------------------------------------------------
+  def commit(self, sync=False):
+    """ Finishes the member and makes written bars permanent (on the disk if <sync>). """
+    self._flush_index(sync)
+    self.committed = self.f.tell()
+
+  #----------------------------------------------------------------------
+  def rollback(self):
+    """ Removes bars written after the last commit. """
+    self._parts, self._rows, self._first, self._last = [], 0, None, None
+    self._entries = []
+    super(GzipBarWriter, self).rollback()
+
+  #----------------------------------------------------------------------
+  def close(self):
+    try:
+      self._flush_index(False)
+    finally:
+      self.index.close()
+      self.f.close()
@@ -0,0 +1,292 @@
+"""
+In-memory cache of the latest written bars with queries, subscriptions and a local http server.
+"""
+
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler
+from itertools import count as counter
+import json
+import queue
+import threading
+from urllib.parse import urlsplit, parse_qs
+
+from .base import Bar, BarBlock, Ticker, NONE, to_epoch, from_epoch
+from .log import logger
+from .metrics import ThreadingHTTPServer
+from .singleton import Singleton
+
+
+__all__ = ["HotCache"]
+
+
+#----------------------------------------------------------------------
+def _rows(block):
+  """ Rows of the BarBlock for JSON: [timestamp, open, high, low, close, volume, interest] """
+  return [[str(from_epoch(ts)), o, h, l, c, None if v == NONE else v, None if oi == NONE else oi]
+          for ts, o, h, l, c, v, oi in zip(block.timestamp, block.open, block.high, block.low,
+                                            block.close, block.volume, block.interest)]
+
+
+#######################################################################
+class _Ring(object):
+  """
+  The latest bars of one output file: a BarBlock which is cut to <size> rows when it's twice longer,
+  so appending costs O(1) on average. It's always the tail of the file.
+  """
+  __slots__ = ("store", "block", "size")
+
+  #----------------------------------------------------------------------
+  def __init__(self, store, size):
+    self.store = store
+    self.size = size
+    self.block = None
+
+  #----------------------------------------------------------------------
+  def extend(self, block):
+    if self.block is None:
+      self.block = BarBlock(block.ticker, block.period)
+    self.block.extend(block)
+    if len(self.block) > 2 * self.size:
+      self.block = self.block[-self.size:]
+
+  #----------------------------------------------------------------------
+  def first(self):
+    """ Epoch seconds of the first bar in memory or None """
+    return self.block.timestamp[0] if self.block is not None and len(self.block) else None
+
+
+#######################################################################
+class HotCache(object, metaclass=Singleton):
+  """
+  Up to <size> latest bars of every (symbol, period) which are written by the downloader.
+  last() and range() return BarBlock from memory or read the file if the bars are older;
+  subscribers get every written BarBlock: callback(symbol, period, block) in the writing thread.
+  The cache is off until the size is configured.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._rings = {}  # (symbol, period) -> _Ring
+    self._subscribers = {}  # token -> (callback, symbol, period)
+    self._tokens = counter(1)
+    self.size = 0
+    self._server = None
+
+  #----------------------------------------------------------------------
+  def configure(self, size=0, port=None, host='127.0.0.1'):
+    with self._lock:
+      self.size = int(size or 0)
+      self._rings = {}
+    self.close()
+    if port and self.enabled:
+      self.serve(port, host)
+
+  #----------------------------------------------------------------------
+  @property
+  def enabled(self):
+    return self.size > 0
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _key(symbol, period):
+    return symbol, period if isinstance(period, str) else Bar.timedelta2str(period)
+
+  #----------------------------------------------------------------------
+  def attach(self, symbol, period, store, append=True):
+    """ Sets the file of (symbol, period); bars of the rewritten file (not <append>) are forgotten. """
+    key = self._key(symbol, period)
+    with self._lock:
+      ring = self._rings.get(key)
+      if ring is None or not append or ring.store.path != store.path:
+        self._rings[key] = _Ring(store, self.size)
+
+  #----------------------------------------------------------------------
+  def invalidate(self, symbol, period):
+    """ Forgets bars in memory, e.g. when older bars are merged into the file; they are read again on demand. """
+    key = self._key(symbol, period)
+    with self._lock:
+      ring = self._rings.get(key)
+      if ring is not None:
+        self._rings[key] = _Ring(ring.store, self.size)
+
+  #----------------------------------------------------------------------
+  def add(self, symbol, period, blocks):
+    """ Appends the bars which are committed to the end of the file and sends them to subscribers. """
+    key = self._key(symbol, period)
+    blocks = [block for block in blocks if len(block)]
+    if not blocks:
+      return
+    with self._lock:
+      ring = self._rings.get(key)
+      if ring is not None:
+        for block in blocks:
+          ring.extend(block)
+      subscribers = [callback for callback, s, p in self._subscribers.values()
+                     if (s is None or s == key[0]) and (p is None or p == key[1])]
+    if subscribers:
+      block = BarBlock.concat(blocks)
+      for callback in subscribers:
+        try:
+          callback(key[0], key[1], block)
+        except Exception as e:
+          logger.warning('HotCache: subscriber error; ({0})'.format(e))
+
+  #----------------------------------------------------------------------
+  def _ring(self, symbol, period):
+    ring = self._rings.get(self._key(symbol, period))
+    if ring is None:
+      raise KeyError('{0} {1} is not downloaded'.format(symbol, period))
+    return ring
+
+  #----------------------------------------------------------------------
+  def last(self, symbol, period, count):
+    """ Returns the last <count> bars; the file's tail is read (and kept if it fits) when memory has less. """
+    with self._lock:
+      ring = self._ring(symbol, period)
+      block = ring.block
+      if block is not None and len(block) >= count:
+        return block[-count:] if count else block[:0]
+    tail = ring.store.tail(max(count, self.size), block.ticker if block is not None else None)
+    with self._lock:
+      if ring.block is block and 0 < len(tail) <= ring.size:
+        ring.block = tail  # nothing was added while the file was read
+    return tail[-count:] if count else tail[:0]
+
+  #----------------------------------------------------------------------
+  def range(self, symbol, period, start=None, end=None):
+    """ Returns bars in [start, end) from memory or from the file if they are older. """
+    with self._lock:
+      ring = self._ring(symbol, period)
+      first = ring.first()
+      if first is not None and start is not None and to_epoch(start) >= first:
+        lo, hi = ring.block.between(start, end or from_epoch(ring.block.timestamp[-1] + 1), include_end=False)
+        return ring.block[lo:hi]
+      ticker = ring.block.ticker if ring.block is not None else None
+    bars = ring.store.read(start, ticker)
+    if end is not None:
+      bars = (it for it in bars if it.timestamp < end)
+    return BarBlock.from_bars(bars, ticker or Ticker(None, symbol), self._key(symbol, period)[1])
+
+  #----------------------------------------------------------------------
+  def subscribe(self, callback, symbol=None, period=None):
+    """ Adds callback(symbol, period, block) of new bars of the symbol and period (all if None); returns the token. """
+    token = next(self._tokens)
+    with self._lock:
+      self._subscribers[token] = (callback, symbol, None if period is None else self._key(symbol, period)[1])
+    return token
+
+  #----------------------------------------------------------------------
+  def unsubscribe(self, token):
+    with self._lock:
+      self._subscribers.pop(token, None)
+
+  #----------------------------------------------------------------------
+  def serve(self, port, host='127.0.0.1'):
+    """
+    Starts the http server in a daemon thread:
+      /last?symbol=SPFB.RTS&timeframe=15&count=100
+      /range?symbol=SPFB.RTS&timeframe=15&start=201612010000&end=201612020000
+      /subscribe?symbol=SPFB.RTS&timeframe=15 - server-sent events with new bars
+    Bars are JSON {"symbol", "timeframe", "bars": [[timestamp, open, high, low, close, volume, interest], ...]}.
+    """
+    self._server = ThreadingHTTPServer((host, port), _Handler)
+    self._server.daemon_threads = True
+    self._server.cache = self
+    threading.Thread(target=self._server.serve_forever, name='hotcache', daemon=True).start()
+    logger.debug('HotCache: http://{0}:{1}/'.format(host, self._server.server_address[1]))
+
+  #----------------------------------------------------------------------
+  def close(self):
+    """ Stops the http server. """
+    if self._server is not None:
+      server, self._server = self._server, None
+      server.shutdown()
+      server.server_close()
+
+
+#######################################################################
+class _Handler(BaseHTTPRequestHandler):
+  """ Requests of the HotCache's server """
+  protocol_version = 'HTTP/1.1'
+  KEEPALIVE = 15  # seconds between comments of the idle event stream
+  QUEUE_SIZE = 1000  # blocks for the slow subscriber before it's dropped
+
+  #----------------------------------------------------------------------
+  def _send(self, status, data):
+    body = json.dumps(data).encode('utf-8')
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  #----------------------------------------------------------------------
+  def do_GET(self):
+    url = urlsplit(self.path)
+    query = {k: v[0] for k, v in parse_qs(url.query).items()}
+    cache = self.server.cache
+    try:
+      symbol, period = query.get('symbol'), query.get('timeframe')
+      if period is not None:
+        period = Bar.timedelta2str(Bar.str2timedelta(period))
+      if url.path == '/subscribe':
+        return self._subscribe(cache, symbol, period)
+      if symbol is None or period is None:
+        return self._send(400, dict(error='symbol and timeframe are required'))
+      if url.path == '/last':
+        block = cache.last(symbol, period, int(query.get('count', 1)))
+      elif url.path == '/range':
+        stamps = [datetime.strptime(query[k], "%Y%m%d%H%M") if k in query else None for k in ('start', 'end')]
+        block = cache.range(symbol, period, *stamps)
+      else:
+        return self._send(404, dict(error='unknown path'))
+    except KeyError as e:
+      return self._send(404, dict(error=str(e)))
+    except Exception as e:
+      return self._send(400, dict(error=str(e)))
+    self._send(200, dict(symbol=symbol, timeframe=period, bars=_rows(block)))
+
+  #----------------------------------------------------------------------
+  def _subscribe(self, cache, symbol, period):
+    events = queue.Queue(self.QUEUE_SIZE)
+
+    def push(symbol, period, block):
+      try:
+        events.put_nowait((symbol, period, block))
+      except queue.Full:
+        # the subscriber is too slow: it gets only the end of the stream (put() can't be called under the mutex)
+        with events.mutex:
+          events.queue.clear()
+          events.queue.append(None)
+          events.not_empty.notify()
+
+    token = cache.subscribe(push, symbol, period)
+    try:
+      self.send_response(200)
+      self.send_header('Content-Type', 'text/event-stream')
+      self.send_header('Cache-Control', 'no-cache')
+      self.send_header('Connection', 'close')
+      self.end_headers()
+      while True:
+        try:
+          event = events.get(timeout=self.KEEPALIVE)
+        except queue.Empty:
+          self.wfile.write(b': keepalive\n\n')  # the closed connection is found by it
+          self.wfile.flush()
+          continue
+        if event is None:
+          return
+        symbol_, period_, block = event
+        data = json.dumps(dict(symbol=symbol_, timeframe=period_, bars=_rows(block)))
+        self.wfile.write('data: {0}\n\n'.format(data).encode('utf-8'))
+        self.wfile.flush()
+    except OSError:
+      pass  # the subscriber has gone
+    finally:
+      cache.unsubscribe(token)
+      self.close_connection = True
+
+  #----------------------------------------------------------------------
+  def log_message(self, *args):
+    pass
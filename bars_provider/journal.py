@@ -0,0 +1,130 @@
+"""
+Write-ahead journal of the chunks of an output file.
+"""
+
+from datetime import datetime
+import json
+import os
+from pathlib import Path
+
+from .log import logger
+
+
+__all__ = ["Journal"]
+
+
+#######################################################################
+class Journal(object):
+  """
+  Records of the requested chunks of one output file, stored near it as <file>.journal (JSON lines):
+    plan     - the window is requested;
+    begin    - bars of the window are being written to the target ('file' or 'patch') from the offset;
+    commit   - bars are written up to the offset and the window is covered up to <covered>;
+    abort    - written bars are removed (the window will be requested again);
+    resample - bars are merged into the middle of the file, so other timeframes are made again.
+  After a crash load() finds the windows which were requested but not committed,
+  the unfinished write of every target, the committed windows and if other timeframes are stale.
+  """
+  FORMAT = '%Y-%m-%d %H:%M:%S'
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name, sync=False):
+    path = Path(file_name)
+    self.path = path.with_name(path.name + '.journal')
+    self.sync = sync
+    self.pending = []  # [start, end] of the requested and not committed windows
+    self.inflight = {}  # target -> offset of the unfinished write
+    self.committed = []  # (start, covered) of the committed windows
+    self.offsets = {}  # target -> offset of the last commit
+    self.stale = False  # other timeframes are made again
+    self._f = None
+
+  #----------------------------------------------------------------------
+  def load(self):
+    """ Reads the records left by the previous run; a broken last line (a crash) is ignored. """
+    self.pending, self.inflight, self.committed, self.offsets, self.stale = [], {}, [], {}, False
+    try:
+      with self.path.open() as f:
+        lines = f.read().splitlines()
+    except FileNotFoundError:
+      return self
+    except OSError as e:
+      logger.warning('{0}: journal is not loaded; ({1})'.format(self.path.name, e))
+      return self
+    planned = {}
+    for line in lines:
+      try:
+        rec = json.loads(line)
+        if rec.get('op') == 'resample':
+          self.stale = True
+          continue
+        window = (datetime.strptime(rec['start'], self.FORMAT), datetime.strptime(rec['end'], self.FORMAT))
+      except (ValueError, KeyError):
+        continue
+      op = rec.get('op')
+      if op == 'plan':
+        planned[window] = True
+      elif op == 'begin':
+        self.inflight[rec['target']] = rec['offset']
+      elif op == 'commit':
+        self.inflight.pop(rec['target'], None)
+        self.offsets[rec['target']] = rec['offset']
+        self.committed.append((window[0], datetime.strptime(rec['covered'], self.FORMAT)))
+        planned.pop(window, None)
+      elif op == 'abort':
+        self.inflight.pop(rec['target'], None)
+    self.pending = sorted(list(it) for it in planned)
+    return self
+
+  #----------------------------------------------------------------------
+  def reset(self):
+    """ Starts the new journal (the previous one is recovered). """
+    self.close()
+    self._f = self.path.open('w')
+
+  #----------------------------------------------------------------------
+  def _write(self, op, start=None, end=None, **values):
+    if self._f is None:
+      self._f = self.path.open('a')
+    values.update(op=op)
+    if start is not None:
+      values.update(start=start.strftime(self.FORMAT), end=end.strftime(self.FORMAT))
+    self._f.write(json.dumps(values, sort_keys=True) + '\n')
+    self._f.flush()
+    if self.sync:
+      os.fsync(self._f.fileno())
+
+  #----------------------------------------------------------------------
+  def plan(self, start, end):
+    self._write('plan', start, end)
+
+  #----------------------------------------------------------------------
+  def begin(self, start, end, target, offset):
+    """ It's written before the bars, so a crash during the writing is rolled back to <offset>. """
+    self._write('begin', start, end, target=target, offset=offset)
+
+  #----------------------------------------------------------------------
+  def commit(self, start, end, target, offset, covered):
+    self._write('commit', start, end, target=target, offset=offset, covered=covered.strftime(self.FORMAT))
+
+  #----------------------------------------------------------------------
+  def abort(self, start, end, target):
+    self._write('abort', start, end, target=target)
+
+  #----------------------------------------------------------------------
+  def resample(self):
+    """ It's written before the patch is removed and kept until other timeframes are made from the whole file. """
+    self._write('resample')
+
+  #----------------------------------------------------------------------
+  def close(self):
+    if self._f is not None:
+      self._f.close()
+      self._f = None
+
+  #----------------------------------------------------------------------
+  def clear(self):
+    """ Removes the journal when all its chunks are finished. """
+    self.close()
+    if self.path.is_file():
+      self.path.unlink()
@@ -0,0 +1,93 @@
+"""
+Inter-process advisory locks of files.
+"""
+
+import os
+from pathlib import Path
+
+try:
+  import fcntl
+except ImportError:  # Windows
+  fcntl = None
+  import msvcrt
+
+
+__all__ = ["FileLock", "FileLockedError"]
+
+
+#######################################################################
+class FileLockedError(Exception):
+  """ Raise it when the file is locked by another process. """
+
+  #----------------------------------------------------------------------
+  def __init__(self, path):
+    self.path = path
+
+  #----------------------------------------------------------------------
+  def __str__(self):
+    return "{0} is locked by another downloader".format(self.path)
+
+
+#######################################################################
+class FileLock(object):
+  """
+  Exclusive advisory lock of <path> (flock on POSIX, msvcrt.locking on Windows).
+  The lock is released by release() (or at the end of the with-block) or by the system when the process exits,
+  so a crashed process never leaves a stale lock.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, path):
+    self.path = Path(path)
+    self._fd = None
+
+  #----------------------------------------------------------------------
+  @property
+  def locked(self):
+    return self._fd is not None
+
+  #----------------------------------------------------------------------
+  def acquire(self):
+    """ Takes the lock without waiting; returns False if another process holds it. """
+    if self._fd is not None:
+      return True
+    fd = os.open(str(self.path), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_NBLCK, 1)
+    except OSError:
+      os.close(fd)
+      return False
+    # the owner's pid is written for information only
+    os.ftruncate(fd, 0)
+    os.write(fd, '{0}\n'.format(os.getpid()).encode())
+    self._fd = fd
+    return True
+
+  #----------------------------------------------------------------------
+  def release(self):
+    if self._fd is None:
+      return
+    fd, self._fd = self._fd, None
+    try:
+      if fcntl is not None:
+        fcntl.flock(fd, fcntl.LOCK_UN)
+      else:
+        os.lseek(fd, 0, os.SEEK_SET)
+        msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+    finally:
+      os.close(fd)
+
+  #----------------------------------------------------------------------
+  def __enter__(self):
+    """ Takes the lock or raises FileLockedError. """
+    if not self.acquire():
+      raise FileLockedError(self.path.name)
+    return self
+
+  #----------------------------------------------------------------------
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.release()
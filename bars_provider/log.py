@@ -3,7 +3,7 @@ logging setup module
 """
 
 import json
-import logging.config
+import logging
 import os
 
 logger = logging.getLogger(__package__)
@@ -19,8 +19,9 @@ def setup_logging(
   value = os.getenv(env_key, None)
   path = value if value else default_path
   if os.path.exists(path):
+    from logging.config import dictConfig  # it's slow to import and only the main module configures logging
     with open(path, 'rt') as f:
       config = json.load(f)
-    logging.config.dictConfig(config)
+    dictConfig(config)
   else:
     logging.basicConfig(level=default_level)
@@ -0,0 +1,327 @@
+"""
+Instrumentation of the downloading: latency histograms and counters of the stages,
+the Prometheus text format (file or http endpoint) and JSON summaries of download cycles.
+"""
+
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import os
+from pathlib import Path
+from socketserver import ThreadingMixIn
+import threading
+from time import perf_counter
+
+from .log import logger
+from .singleton import Singleton
+
+
+__all__ = ["Metrics", "Histogram"]
+
+
+# seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+#######################################################################
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+  """ HTTP server with a daemon thread per request (http.server has it since Python 3.7) """
+  daemon_threads = True
+
+
+HELP = {
+  'bars_stage_seconds': ('histogram', 'Seconds of the download stages (init, resolve, fetch, parse, write)'),
+  'bars_rows_total': ('counter', 'Bars written to the output files'),
+  'bars_bytes_total': ('counter', 'Bytes written to the output files'),
+  'bars_chunks_total': ('counter', 'Requested chunks'),
+  'bars_failures_total': ('counter', 'Failed stages'),
+  'bars_http_seconds': ('histogram', 'Seconds till the response headers'),
+  'bars_http_bytes_total': ('counter', 'Bytes of the response bodies'),
+  'bars_http_retries_total': ('counter', 'Repeated requests'),
+  'bars_http_failures_total': ('counter', 'Requests without a response'),
+}
+
+
+#----------------------------------------------------------------------
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+#----------------------------------------------------------------------
+def _labels(labels, extra=()):
+  items = list(labels) + list(extra)
+  if not items:
+    return ''
+  return '{' + ','.join('{0}="{1}"'.format(k, _escape(v)) for k, v in items) + '}'
+#----------------------------------------------------------------------
+def _number(value):
+  return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+#######################################################################
+class Histogram(object):
+  """ Counts of observations by the upper bounds of BUCKETS (the last one is +Inf), their sum and max. """
+  __slots__ = ("counts", "sum", "max")
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self.counts = [0] * (len(BUCKETS) + 1)
+    self.sum = 0.0
+    self.max = 0.0
+
+  #----------------------------------------------------------------------
+  @property
+  def count(self):
+    return sum(self.counts)
+
+  #----------------------------------------------------------------------
+  def observe(self, value):
+    self.counts[bisect_left(BUCKETS, value)] += 1
+    self.sum += value
+    self.max = max(self.max, value)
+
+  #----------------------------------------------------------------------
+  def quantile(self, q):
+    """ Estimates the quantile by the linear interpolation inside of its bucket. """
+    total = self.count
+    if not total:
+      return None
+    rank = q * total
+    seen = 0
+    for i, cnt in enumerate(self.counts):
+      if cnt and seen + cnt >= rank:
+        lower = BUCKETS[i - 1] if i else 0.0
+        upper = BUCKETS[i] if i < len(BUCKETS) else self.max
+        return min(lower + (upper - lower) * (rank - seen) / cnt, self.max)
+      seen += cnt
+    return self.max
+
+
+#######################################################################
+class Metrics(object, metaclass=Singleton):
+  """
+  Histograms and counters by name and labels. They are kept for the whole run (the Prometheus text)
+  and for the current cycle (the summary), which is finished by flush().
+  Listeners get every finished span: listener(stage, labels, seconds, error), e.g. for tracing.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._total = ({}, {})  # histograms, counters: (name, labels) -> value
+    self._cycle = ({}, {})
+    self._started = datetime.now()
+    self.listeners = []
+    self.file_name = None
+    self.summary_file = None
+    self.summary_keep = 1000
+    self._server = None
+
+  #----------------------------------------------------------------------
+  def configure(self, file_name=None, summary_file=None, port=None, host='127.0.0.1', summary_keep=1000):
+    """
+    Sets the Prometheus text file, the JSON lines file of the last <summary_keep> cycle summaries
+    and the port of the http endpoint.
+    """
+    self.file_name = file_name
+    self.summary_file = summary_file
+    self.summary_keep = max(int(summary_keep), 1)
+    self.close()
+    if port:
+      self.serve(port, host)
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+  #----------------------------------------------------------------------
+  def observe(self, name, seconds, **labels):
+    key = self._key(name, labels)
+    with self._lock:
+      for histograms, _ in (self._total, self._cycle):
+        hist = histograms.get(key)
+        if hist is None:
+          hist = histograms[key] = Histogram()
+        hist.observe(seconds)
+
+  #----------------------------------------------------------------------
+  def inc(self, name, value=1, **labels):
+    key = self._key(name, labels)
+    with self._lock:
+      for _, counters in (self._total, self._cycle):
+        counters[key] = counters.get(key, 0) + value
+
+  #----------------------------------------------------------------------
+  @contextmanager
+  def span(self, stage, provider, symbol=''):
+    """ Measures the block as the <stage> of the provider's symbol; an exception is counted as a failure. """
+    started = perf_counter()
+    error = None
+    try:
+      yield
+    except BaseException as e:
+      error = e
+      raise
+    finally:
+      self.record(stage, provider, symbol, perf_counter() - started, error)
+
+  #----------------------------------------------------------------------
+  def record(self, stage, provider, symbol, seconds, error=None):
+    """ Records the stage which was measured outside of span(). """
+    labels = dict(stage=stage, provider=provider, symbol=symbol)
+    self.observe('bars_stage_seconds', seconds, **labels)
+    if error is not None:
+      self.inc('bars_failures_total', error=error.__class__.__name__, **labels)
+    for listener in self.listeners:
+      try:
+        listener(stage, labels, seconds, error)
+      except Exception as e:
+        logger.warning('Metrics: listener error; ({0})'.format(e))
+
+  #----------------------------------------------------------------------
+  def text(self):
+    """ Returns all metrics of the run in the Prometheus text format. """
+    with self._lock:
+      histograms = sorted((k, list(v.counts), v.sum) for k, v in self._total[0].items())
+      counters = sorted(self._total[1].items())
+    lines = []
+    described = set()
+
+    def describe(name):
+      if name not in described:
+        described.add(name)
+        kind, text = HELP.get(name, ('untyped', name))
+        lines.append('# HELP {0} {1}'.format(name, text))
+        lines.append('# TYPE {0} {1}'.format(name, kind))
+
+    for (name, labels), counts, total in histograms:
+      describe(name)
+      cumulative = 0
+      for bound, cnt in zip(BUCKETS + ('+Inf',), counts):
+        cumulative += cnt
+        lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, [('le', bound)]), cumulative))
+      lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), _number(total)))
+      lines.append('{0}_count{1} {2}'.format(name, _labels(labels), cumulative))
+    for (name, labels), value in counters:
+      describe(name)
+      lines.append('{0}{1} {2}'.format(name, _labels(labels), _number(value)))
+    return '\n'.join(lines) + '\n'
+
+  #----------------------------------------------------------------------
+  def summary(self):
+    """
+    Returns the dict of the current cycle: stages of every provider (count, seconds, max, p50, p95),
+    rows, bytes and failures by provider and symbol, HTTP stats by host and the slowest stage of every provider.
+    """
+    with self._lock:
+      histograms, counters = dict(self._cycle[0]), dict(self._cycle[1])
+    now = datetime.now()
+    result = dict(started=self._started.isoformat(timespec='seconds'), finished=now.isoformat(timespec='seconds'),
+                  seconds=round((now - self._started).total_seconds(), 3),
+                  providers={}, symbols={}, hosts={}, bottleneck={})
+    stages = {}
+    for (name, labels), hist in histograms.items():
+      labels = dict(labels)
+      if name == 'bars_stage_seconds':
+        total = stages.setdefault(labels['provider'], {}).setdefault(labels['stage'], Histogram())
+        for i, cnt in enumerate(hist.counts):
+          total.counts[i] += cnt
+        total.sum += hist.sum
+        total.max = max(total.max, hist.max)
+        if labels['symbol']:
+          symbol = result['symbols'].setdefault('{provider};{symbol}'.format(**labels), {})
+          symbol['seconds'] = round(symbol.get('seconds', 0.0) + hist.sum, 6)
+      elif name == 'bars_http_seconds':
+        host = result['hosts'].setdefault(labels['host'], {})
+        host.update(requests=hist.count, seconds=round(hist.sum, 6), p95=round(hist.quantile(0.95), 6))
+    for provider, by_stage in stages.items():
+      result['providers'][provider] = dict(stages={stage: dict(count=hist.count, seconds=round(hist.sum, 6),
+                                                               max=round(hist.max, 6),
+                                                               p50=round(hist.quantile(0.5), 6),
+                                                               p95=round(hist.quantile(0.95), 6))
+                                                   for stage, hist in by_stage.items()})
+      # stages of the streamed response overlap (fetch includes parse), so parse isn't compared with fetch
+      result['bottleneck'][provider] = max(by_stage, key=lambda stage: (stage != 'parse', by_stage[stage].sum))
+    for (name, labels), value in counters.items():
+      labels = dict(labels)
+      if name in ('bars_rows_total', 'bars_bytes_total', 'bars_chunks_total', 'bars_failures_total'):
+        field = name[len('bars_'):-len('_total')]
+        provider = result['providers'].setdefault(labels['provider'], {})
+        provider[field] = provider.get(field, 0) + value
+        if labels.get('symbol'):
+          symbol = result['symbols'].setdefault('{provider};{symbol}'.format(**labels), {})
+          symbol[field] = symbol.get(field, 0) + value
+      elif name.startswith('bars_http_'):
+        host = result['hosts'].setdefault(labels['host'], {})
+        field = name[len('bars_http_'):-len('_total')]
+        host[field] = host.get(field, 0) + value
+    return result
+
+  #----------------------------------------------------------------------
+  def flush(self):
+    """ Finishes the cycle: writes the text file and appends the summary (older ones are dropped); returns the summary. """
+    result = self.summary()
+    with self._lock:
+      self._cycle = ({}, {})
+      self._started = datetime.now()
+    try:
+      if self.file_name:
+        path = Path(self.file_name)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with tmp_path.open('w') as f:
+          f.write(self.text())
+        os.replace(str(tmp_path), str(path))  # a collector never reads a half of the file
+      if self.summary_file:
+        self._save_summary(result)
+    except OSError as e:
+      logger.warning('Metrics: not saved; ({0})'.format(e))
+    return result
+
+  #----------------------------------------------------------------------
+  def _save_summary(self, result):
+    """ Rewrites the summaries file with the last <summary_keep> lines, so it doesn't grow without bound. """
+    path = Path(self.summary_file)
+    try:
+      with path.open() as f:
+        lines = f.read().splitlines()
+    except FileNotFoundError:
+      lines = []
+    lines = lines[len(lines) + 1 - self.summary_keep:] + [json.dumps(result, sort_keys=True)]
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('w') as f:
+      f.write(''.join(line + '\n' for line in lines))
+    os.replace(str(tmp_path), str(path))
+
+  #----------------------------------------------------------------------
+  def serve(self, port, host='127.0.0.1'):
+    """ Starts the http endpoint /metrics in a daemon thread. """
+    metrics = self
+
+    class Handler(BaseHTTPRequestHandler):
+      def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+          self.send_error(404)
+          return
+        body = metrics.text().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+      def log_message(self, *args):
+        pass
+
+    self._server = ThreadingHTTPServer((host, port), Handler)
+    self._server.daemon_threads = True
+    threading.Thread(target=self._server.serve_forever, name='metrics', daemon=True).start()
+    logger.debug('Metrics: http://{0}:{1}/metrics'.format(host, self._server.server_address[1]))
+
+  #----------------------------------------------------------------------
+  def close(self):
+    """ Stops the http endpoint. """
+    if self._server is not None:
+      server, self._server = self._server, None
+      server.shutdown()
+      server.server_close()
@@ -0,0 +1,181 @@
+"""
+Batch parsers which turn a provider's response into BarBlock columns.
+"""
+
+from array import array
+import csv
+from datetime import date
+from functools import partial
+from itertools import islice
+from tempfile import TemporaryFile
+
+from .base import BarBlock, InvalidDataFormatError, NONE, to_epoch, from_epoch, _EPOCH_ORDINAL
+from .metrics import Metrics
+
+
+__all__ = ["parse_finam", "parse_quotemedia", "iter_blocks", "clip_blocks", "reverse_lines", "LineSpool", "to_epoch", "from_epoch"]
+
+
+#######################################################################
+class _StampCache(dict):
+  """ Converts date and time strings to seconds; every distinct string is parsed once. """
+
+  #----------------------------------------------------------------------
+  def __init__(self, parse):
+    super(_StampCache, self).__init__()
+    self.parse = parse
+
+  #----------------------------------------------------------------------
+  def __missing__(self, key):
+    value = self[key] = self.parse(key)
+    return value
+
+
+#----------------------------------------------------------------------
+def _ymd(s):
+  """ 'YYYYMMDD' or 'YYYY-MM-DD' to seconds of the midnight """
+  s = s.replace('-', '')
+  return (date(int(s[:4]), int(s[4:6]), int(s[6:8])).toordinal() - _EPOCH_ORDINAL) * 86400
+#----------------------------------------------------------------------
+def _hms(s):
+  """ 'HHMMSS' to seconds from the midnight """
+  if len(s) != 6:
+    raise ValueError(s)
+  return int(s[:2]) * 3600 + int(s[2:4]) * 60 + int(s[4:6])
+
+
+_DATES = _StampCache(_ymd)
+_TIMES = _StampCache(_hms)
+
+
+#----------------------------------------------------------------------
+def _split(line, delimiter):
+  """ Splits the CSV line; the csv module is used only for quoted values. """
+  if '"' in line:
+    return next(csv.reader((line,), delimiter=delimiter, quotechar='"'))
+  return line.split(delimiter)
+
+
+#----------------------------------------------------------------------
+def parse_finam(lines, ticker, period):
+  """ Parses 'DATE;TIME;OPEN;HIGH;LOW;CLOSE;VOL' lines. """
+  block = BarBlock(ticker, period)
+  ts, o, h, l, c, v = block.timestamp, block.open, block.high, block.low, block.close, block.volume
+  for line in lines:
+    if not line:
+      continue
+    datalist = _split(line, ';')
+    try:
+      d, t, op, hi, lo, cl, vol = datalist
+      ts.append(_DATES[d] + _TIMES[t])
+      o.append(float(op))
+      h.append(float(hi))
+      l.append(float(lo))
+      c.append(float(cl))
+      v.append(int(vol))
+    except ValueError:
+      raise InvalidDataFormatError(ticker, str(datalist))
+  block.interest.extend(array('q', (NONE,)) * len(ts))  # not provided
+  return block
+
+
+#----------------------------------------------------------------------
+def parse_quotemedia(lines, ticker, period):
+  """
+  Parses 'date,open,high,low,close,volume,...' lines; rows which have not a numeric open are skipped.
+  Lines must be passed in the time order.
+  """
+  block = BarBlock(ticker, period)
+  ts, o, h, l, c, v = block.timestamp, block.open, block.high, block.low, block.close, block.volume
+  for line in lines:
+    if not line:
+      continue
+    datalist = _split(line, ',')
+    try:
+      d, op, hi, lo, cl, vol = datalist[:6]
+      try:
+        op = float(op)
+      except ValueError:
+        continue  # header
+      ts.append(_DATES[d])
+      o.append(op)
+      h.append(float(hi))
+      l.append(float(lo))
+      c.append(float(cl))
+      v.append(int(vol))
+    except ValueError:
+      raise InvalidDataFormatError(ticker, str(datalist))
+  block.interest.extend(array('q', (NONE,)) * len(ts))  # not provided
+  return block
+
+
+#----------------------------------------------------------------------
+def clip_blocks(blocks, start, end, include_end=True):
+  """ Yields parts of sorted <blocks> in [start, end] (or [start, end) ); stops after the end. """
+  for block in blocks:
+    lo, hi = block.between(start, end, include_end)
+    if hi > lo:
+      yield block if hi - lo == len(block) else block[lo:hi]
+    if hi < len(block):
+      return  # the rest is after the end
+
+
+#----------------------------------------------------------------------
+def iter_blocks(parse, lines, ticker, period, size=10000):
+  """ Parses <lines> by <size> rows, so the first block is ready before all lines are received. """
+  span = partial(Metrics().span, 'parse', ticker.provider.__class__.__name__, ticker.symbol)
+  lines = iter(lines)
+  while True:
+    chunk = list(islice(lines, size))
+    if not chunk:
+      return
+    with span():  # the time of receiving lines isn't included
+      block = parse(chunk, ticker, period)
+    yield block
+
+
+#######################################################################
+class LineSpool(object):
+  """
+  Collects lines to read them in the reversed order keeping only <size> lines in memory;
+  full blocks are moved to a temporary file.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, size=10000):
+    self.size = size
+    self.block = []
+    self.offsets = []
+    self.f = None
+
+  #----------------------------------------------------------------------
+  def add(self, line):
+    self.block.append(line)
+    if len(self.block) >= self.size:
+      if self.f is None:
+        self.f = TemporaryFile()
+      data = '\n'.join(self.block).encode('utf-8')
+      self.offsets.append((self.f.tell(), len(data)))
+      self.f.write(data)
+      self.block = []
+
+  #----------------------------------------------------------------------
+  def reversed(self):
+    """ Yields the collected lines from the last one; the temporary file is removed at the end. """
+    try:
+      yield from reversed(self.block)
+      for offset, length in reversed(self.offsets):
+        self.f.seek(offset)
+        yield from reversed(self.f.read(length).decode('utf-8').split('\n'))
+    finally:
+      if self.f is not None:
+        self.f.close()
+
+
+#----------------------------------------------------------------------
+def reverse_lines(lines, size=10000):
+  """ Yields <lines> in the reversed order with the bounded memory (see LineSpool). """
+  spool = LineSpool(size)
+  for line in lines:
+    spool.add(line)
+  yield from spool.reversed()
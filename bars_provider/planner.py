@@ -0,0 +1,140 @@
+"""
+Adaptive size of the request windows.
+"""
+
+from datetime import datetime, time, timedelta
+import json
+import os
+from pathlib import Path
+
+from .log import logger
+
+
+__all__ = ["ChunkPlanner"]
+
+
+#######################################################################
+class ChunkPlanner(object):
+  """
+  Learns the window size (in days) for every provider/ticker/period
+  from rows per request, latency and truncated responses: the limit is the most rows of a truncated response,
+  full is the most rows of a complete one.
+  A new ticker starts with the size learned for its provider and period.
+  Sizes are stored in the json-file between runs.
+  """
+  MIN_DAYS = 1
+  # a shorter response which ends earlier is a weekend or holidays rather than the provider's limit
+  MIN_TRUNCATED_ROWS = 1000
+  HOLIDAYS = timedelta(days=4)
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name, default, target_rows=20000, max_latency=20.0, max_days=3650):
+    self.path = Path(file_name)
+    self.default = default.total_seconds() / 86400
+    self.target_rows = target_rows
+    self.max_latency = max_latency
+    self.max_days = max_days
+    self.sizes = {}  # key -> {"days": window size, "limit": rows of the truncated response, "full": rows of the complete one}
+    self._changed = set()
+    self.load()
+
+  #----------------------------------------------------------------------
+  def load(self):
+    try:
+      with self.path.open() as f:
+        self.sizes = json.load(f)
+    except FileNotFoundError:
+      self.sizes = {}
+    except (OSError, ValueError) as e:
+      logger.warning('{0}: chunk sizes are reset; ({1})'.format(self.path.name, e))
+      self.sizes = {}
+
+  #----------------------------------------------------------------------
+  def save(self):
+    """ Saves the sizes learned by this process over the ones saved by other processes since the loading. """
+    changed = {key: self.sizes[key] for key in self._changed}
+    self.load()
+    self.sizes.update(changed)
+    tmp_path = self.path.with_name('{0}.tmp{1}'.format(self.path.name, os.getpid()))
+    with tmp_path.open('w') as f:
+      json.dump(self.sizes, f, indent=1, sort_keys=True)
+    os.replace(str(tmp_path), str(self.path))
+
+  #----------------------------------------------------------------------
+  @staticmethod
+  def keys(provider, symbol, period):
+    """ Returns keys of the ticker and of its provider/period """
+    return '{0};{1};{2}'.format(provider, symbol, period), '{0};*;{1}'.format(provider, period)
+
+  #----------------------------------------------------------------------
+  def size(self, keys):
+    """ Returns the window size rounded to whole days: providers are requested by dates. """
+    days = self.default
+    for key in keys:
+      if key in self.sizes:
+        days = self.sizes[key]['days']
+        break
+    return timedelta(days=max(round(days), self.MIN_DAYS))
+
+  #----------------------------------------------------------------------
+  def chunks(self, keys, start, end, now):
+    """ Splits [start, end) into the windows of the current learned size which end at midnight. """
+    dtS = start
+    while end > dtS and dtS <= now:
+      dtE = min(datetime.combine((dtS + self.size(keys)).date(), time()), end, now)
+      yield dtS, dtE
+      dtS = dtE
+
+  #----------------------------------------------------------------------
+  def _learned(self, keys, name):
+    return max(self.sizes.get(key, {}).get(name, 0) for key in keys)
+
+  #----------------------------------------------------------------------
+  def is_truncated(self, keys, rows, last, end, period):
+    """
+    Checks if the response of the window which ends at <end> was cut by the provider:
+    it has the learned limit of rows or it's long and ends days before the end.
+    """
+    if last is None or last + period >= end:
+      return False
+    limit = self._learned(keys, 'limit')
+    if limit and rows >= limit:
+      return True
+    return rows >= self.MIN_TRUNCATED_ROWS and last + max(self.HOLIDAYS, 3 * period) < end
+
+  #----------------------------------------------------------------------
+  def is_suspect(self, keys, rows, last, end, period):
+    """
+    Checks if the response can be cut: it ends before the window's end by bars (a night or a weekend look the same)
+    and it has as many rows as the largest complete response or more, whatever the limit of the provider is.
+    The rest of the window tells it (see observe()).
+    """
+    return last is not None and last + period < end and rows >= self._learned(keys, 'full')
+
+  #----------------------------------------------------------------------
+  def observe(self, keys, start, end, rows, latency, covered, grow=True):
+    """
+    Updates the size after the request of [start, end) which returned <rows>
+    in <latency> seconds and covered the window up to <covered> (less than end if truncated).
+    The window isn't made larger than the current size unless <grow>: a complete response which ended
+    before the end of the window is known to be complete only if it's checked by its rest.
+    """
+    days = max((end - start).total_seconds() / 86400, 1e-6)
+    for key in keys:
+      self._changed.add(key)
+      state = self.sizes.setdefault(key, {'days': self.size(keys).total_seconds() / 86400})
+      if covered < end:
+        # the provider's limit: the next window should get only a part of the rows
+        part = max((covered - start).total_seconds() / 86400, 0) / days
+        state['limit'] = max(state.get('limit', 0), rows)
+        new = days * part * 0.8
+      else:
+        state['full'] = max(state.get('full', 0), rows)
+        target = min(self.target_rows, state.get('limit', self.target_rows) * 0.8)
+        new = days * target / rows if rows else days * 2
+        new = min(max(new, state['days'] / 2), state['days'] * 2)  # smooth changes
+        if latency and latency > self.max_latency:
+          new = min(new, days * self.max_latency / latency)
+        if not grow:
+          new = min(new, max(days, state['days']))
+      state['days'] = round(min(max(new, self.MIN_DAYS), self.max_days), 3)
@@ -3,13 +3,12 @@ This module contains QuotemediaProvider which automatically load data from quote
 Daily only.
 """
 
-import csv
-from datetime import datetime, timedelta
+from datetime import timedelta
 
-from .base import DataProvider, InvalidDataFormatError, Bar, \
-  DataNotFoundError, Ticker, DataObtainError
-from .common import is_float, requests_retry_session
+from .base import DataProvider, DataNotFoundError, Ticker, DataObtainError
+from .common import Sessions, iter_response_lines
 from .log import logger
+from .parsing import parse_quotemedia, iter_blocks, clip_blocks, reverse_lines, LineSpool
 
 
 __all__ = ["QuotemediaProvider"]
@@ -20,24 +19,13 @@ class QuotemediaProvider(DataProvider):
   Loads data from resource.
   """
   __slots__ = ()
+  URL = 'https://app.quotemedia.com/quotetools/getHistoryDownload.csv'
   #----------------------------------------------------------------------
   def _generator(self, ticker, lines, start, end, period):
-    """ Wrap responsed data with CSV parser and return elements in the order. """
-    for datalist in csv.reader(reversed(lines.splitlines()), delimiter=',', quotechar='"'):
-      try:
-        # date,open,high,low,close,volume,changed,changep,adjclose,tradeval,tradevol
-        d, o, h, l, c, v = datalist[:6]
-        if not is_float(o):
-          continue
-        o, h, l, c, v = float(o), float(h), float(l), float(c), int(v)
-        stamp = datetime.strptime(d, "%Y-%m-%d")
-      except ValueError:
-        raise InvalidDataFormatError(ticker, str(datalist))
-      if stamp < start:
-        continue
-      elif stamp >= end:
-        return #raise StopIteration
-      yield Bar(ticker, stamp, period, o, h, l, c, v)
+    """ Wrap responsed data with CSV parser and return blocks of bars in the order. """
+    # date,open,high,low,close,volume,changed,changep,adjclose,tradeval,tradevol
+    # rows are sent from the newest, so they are reversed with the bounded memory
+    return clip_blocks(iter_blocks(parse_quotemedia, reverse_lines(lines), ticker, period), start, end, include_end=False)
   #----------------------------------------------------------------------
   def find(self, query):
     if not query:
@@ -45,8 +33,11 @@ class QuotemediaProvider(DataProvider):
     return [Ticker(self, query.lower())]
   #----------------------------------------------------------------------
   def bars(self, ticker, start, end, period):
-    """Download ticker' data from a remote service"""
-    period = timedelta(days=1) # only days can used
+    """ Downloads bars; see blocks() """
+    return (bar for block in self.blocks(ticker, start, end, period) for bar in block.bars())
+  #----------------------------------------------------------------------
+  @classmethod
+  def _url(cls, ticker, start, end):
     dfrom = start.date()
     dto = end.date()
     rdict = dict(
@@ -63,16 +54,43 @@ class QuotemediaProvider(DataProvider):
     # &startDay=17&startMonth=1&startYear=2017&endDay=27
     # &endMonth=3&endYear=2017&isRanged=false
     # &symbol=^IN:US
-    url = ("https://app.quotemedia.com/quotetools/getHistoryDownload.csv?" + 
+    url = (cls.URL + "?" + 
           "webmasterId=501&startDay={startDay}&" +
           "startMonth={startMonth}&startYear={startYear}&" +
           "endDay={endDay}&endMonth={endMonth}&endYear={endYear}&" +
           "isRanged=false&symbol={symbol}").format(**rdict)
+    return url
+  #----------------------------------------------------------------------
+  def blocks(self, ticker, start, end, period):
+    """Download ticker' data from a remote service"""
+    period = timedelta(days=1) # only days can used
+    url = self._url(ticker, start, end)
     try:
-      response = requests_retry_session().get(url)#, headers = {'Referer': "http://www.finam.ru/analysis/export/default.asp"})
-      decoded = response.content.decode('utf-8', "ignore")
-      return self._generator(ticker, decoded, start, end, period) # Return generator which parses data
+      response = Sessions().get(url, stream=True)#, headers = {'Referer': "http://www.finam.ru/analysis/export/default.asp"})
+      return self._generator(ticker, iter_response_lines(response), start, end, period) # Return generator which parses data
     except Exception as e:
       raise DataObtainError(ticker, e)
     else:
       logger.debug('request OK: {0}'.format(response.status_code))
+  #----------------------------------------------------------------------
+  async def afind(self, query):
+    return self.find(query)
+  #----------------------------------------------------------------------
+  async def ablocks(self, ticker, start, end, period):
+    """ Non-blocking blocks() through aiohttp (in the executor without it) """
+    from .aio import AsyncSessions, aiter_response_lines
+    if not AsyncSessions.available:
+      async for block in super(QuotemediaProvider, self).ablocks(ticker, start, end, period):
+        yield block
+      return
+    period = timedelta(days=1) # only days can used
+    try:
+      response = await AsyncSessions().get(self._url(ticker, start, end))
+    except Exception as e:
+      raise DataObtainError(ticker, e)
+    # rows are sent from the newest, so all of them are received before parsing
+    spool = LineSpool()
+    async for line in aiter_response_lines(response):
+      spool.add(line)
+    for block in clip_blocks(iter_blocks(parse_quotemedia, spool.reversed(), ticker, period), start, end, include_end=False):
+      yield block
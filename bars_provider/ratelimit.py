@@ -0,0 +1,127 @@
+"""
+Rate limiting of requests to one host.
+"""
+
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+import threading
+from time import monotonic, sleep
+
+
+__all__ = ["RateLimiter", "retry_after"]
+
+
+#----------------------------------------------------------------------
+def retry_after(value):
+  """ Returns seconds from the Retry-After header (seconds or http-date) or None. """
+  if not value:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  try:
+    return max((parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds(), 0.0)
+  except (TypeError, ValueError):
+    return None
+
+
+#######################################################################
+class RateLimiter(object):
+  """
+  Token bucket of one host: <rate> requests per second with bursts up to <burst> requests.
+  The rate is halved when the host throttles (429, 503) or the latency grows <slow_factor> times
+  over its average, and it's restored step by step by successful requests.
+  """
+  RECOVERY = 0.05  # part of the configured rate added by a successful request
+
+  #----------------------------------------------------------------------
+  def __init__(self, rate=5.0, burst=5, min_rate=0.1, slow_factor=3.0):
+    self._lock = threading.Lock()
+    self.max_rate = float(rate)
+    self.rate = float(rate)
+    self.burst = max(float(burst), 1.0)
+    self.min_rate = min(float(min_rate), self.max_rate)
+    self.slow_factor = slow_factor
+    self.tokens = self.burst
+    self.latency = None  # moving average of seconds till the response headers
+    self.requests, self.throttled, self.slowdowns = 0, 0, 0
+    self.waited = 0.0
+    self._stamp = monotonic()
+    self._blocked_until = 0.0
+    self._decreased = 0.0
+
+  #----------------------------------------------------------------------
+  def _refill(self, now):
+    if now > self._stamp:
+      self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+      self._stamp = now
+
+  #----------------------------------------------------------------------
+  def _decrease(self, now):
+    """ Halves the rate, but not more often than once per interval between requests. """
+    if now - self._decreased >= 1.0 / self.rate:
+      self.rate = max(self.min_rate, self.rate / 2)
+      self._decreased = now
+
+  #----------------------------------------------------------------------
+  def reserve(self, waited=0.0):
+    """ Takes a token without blocking; returns 0 or seconds to wait before the next try. """
+    with self._lock:
+      now = monotonic()
+      self._refill(now)
+      delay = self._blocked_until - now
+      if delay > 0:
+        return delay
+      if self.tokens >= 1:
+        self.tokens -= 1
+        self.requests += 1
+        self.waited += waited
+        return 0.0
+      return (1 - self.tokens) / self.rate
+
+  #----------------------------------------------------------------------
+  def acquire(self):
+    """ Blocks until the request is allowed; returns seconds of waiting. """
+    waited = 0.0
+    while True:
+      delay = self.reserve(waited)
+      if not delay:
+        return waited
+      sleep(delay)
+      waited += delay
+
+  #----------------------------------------------------------------------
+  def success(self, latency):
+    """ Records the successful request which got the response in <latency> seconds. """
+    with self._lock:
+      if self.latency is not None and latency > self.latency * self.slow_factor:
+        self.slowdowns += 1
+        self._decrease(monotonic())
+      else:
+        self.rate = min(self.max_rate, self.rate + self.max_rate * self.RECOVERY)
+      self.latency = latency if self.latency is None else self.latency * 0.8 + latency * 0.2
+
+  #----------------------------------------------------------------------
+  def throttle(self, pause=None):
+    """ Records the throttled request; no requests are allowed for <pause> seconds (Retry-After). """
+    with self._lock:
+      now = monotonic()
+      self.throttled += 1
+      self._decrease(now)
+      self._blocked_until = max(self._blocked_until, now + (pause if pause is not None else 1.0 / self.rate))
+      # no burst after the pause
+      self.tokens = 0.0
+      self._stamp = self._blocked_until
+
+  #----------------------------------------------------------------------
+  def state(self):
+    """ Returns the current state for monitoring. """
+    with self._lock:
+      now = monotonic()
+      self._refill(now)
+      return dict(rate=round(self.rate, 3), max_rate=self.max_rate, burst=self.burst,
+                  tokens=round(self.tokens, 2), blocked=round(max(self._blocked_until - now, 0.0), 3),
+                  latency=None if self.latency is None else round(self.latency, 3),
+                  requests=self.requests, throttled=self.throttled, slowdowns=self.slowdowns,
+                  waited=round(self.waited, 3))
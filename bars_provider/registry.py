@@ -0,0 +1,75 @@
+"""
+Registry of the data providers: modules are imported on the first use, classes and instances are kept.
+"""
+
+import importlib
+import json
+import threading
+
+from .singleton import Singleton
+
+
+__all__ = ["Providers", "BUILTIN"]
+
+
+# class name -> module of the providers of this package (they are exported by it lazily)
+BUILTIN = {
+  'FinamProvider': 'bars_provider.finam',
+  'QuotemediaProvider': 'bars_provider.quotemedia',
+}
+
+
+#######################################################################
+class Providers(object, metaclass=Singleton):
+  """
+  Provider classes by (module, class name) and their instances by constructor arguments.
+  The module is imported when its class is requested for the first time, so startup doesn't pay
+  for providers (and their HTTP libraries) which aren't used; instances are made once per process
+  and serve all download cycles.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self):
+    self._lock = threading.RLock()
+    self._modules = dict(BUILTIN)  # class name -> module
+    self._classes = {}  # (module, class name) -> class
+    self._instances = {}  # (class, arguments) -> provider
+
+  #----------------------------------------------------------------------
+  def register(self, name, module):
+    """ Adds the provider class <name> of the module (it isn't imported until it's used). """
+    with self._lock:
+      self._modules[name] = module
+
+  #----------------------------------------------------------------------
+  def get_class(self, name, module=None):
+    """ Returns the provider class; <module> is the registered one by default. Raises ModuleNotFoundError or AttributeError. """
+    module = module or self._modules.get(name)
+    if module is None:
+      raise AttributeError('provider "{0}" is not registered'.format(name))
+    key = (module, name)
+    with self._lock:
+      class_ = self._classes.get(key)
+      if class_ is None:
+        imported = importlib.import_module(module)
+        if not hasattr(imported, name):
+          imported = importlib.import_module(module.split('.')[0])  # the class is exported by the package
+        class_ = self._classes[key] = getattr(imported, name)
+      return class_
+
+  #----------------------------------------------------------------------
+  def instance(self, name, module=None, **kwargs):
+    """ Returns the provider made with <kwargs>; it's made once, later calls return the same object. """
+    class_ = self.get_class(name, module)
+    key = (class_, json.dumps(kwargs, sort_keys=True, default=str))
+    with self._lock:
+      provider = self._instances.get(key)
+      if provider is None:
+        provider = self._instances[key] = class_(**kwargs)
+      return provider
+
+  #----------------------------------------------------------------------
+  def clear(self):
+    """ Forgets the made providers (classes are kept), e.g. after the configuration is changed. """
+    with self._lock:
+      self._instances = {}
@@ -0,0 +1,105 @@
+"""
+Aggregates bars of a base timeframe into a coarser one.
+"""
+
+from datetime import datetime, timedelta
+
+from .base import Bar, InvalidDataFormatError
+
+
+__all__ = ["Resampler"]
+
+
+DAY = timedelta(days=1)
+WEEK = timedelta(weeks=1)
+SECOND = timedelta(seconds=1)
+
+
+#######################################################################
+class Resampler(object):
+  """
+  Incremental aggregation of base bars into <period> bars (any value of Bar.str2timedelta).
+  Base bars can be stamped by the close time (like Finam's) or by the open time;
+  intraday result bars are stamped the same way, daily and weekly ones by the date.
+  The trailing bar is kept in <current> and updated by every new base bar.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, period, base, close_stamp=True):
+    if period <= base or (period < DAY and period % base) or (period >= DAY and DAY % base):
+      raise InvalidDataFormatError(Bar.timedelta2str(period),
+                                   "can't be made from {0} bars".format(Bar.timedelta2str(base)))
+    self.period = period
+    self.base = base
+    # close stamps of intraday base bars belongs to the previous interval
+    self.shift = SECOND if close_stamp and base < DAY else timedelta()
+    self.close_label = close_stamp and period < DAY
+    self.current = None
+    self._start = None  # start of the current bucket
+    self._covered = None  # time up to which base bars were pushed
+
+  #----------------------------------------------------------------------
+  def bucket(self, stamp):
+    """ Returns the start of interval which contains base bar's <stamp>. """
+    stamp -= self.shift
+    day = datetime.combine(stamp.date(), datetime.min.time())
+    if self.period >= WEEK:
+      return day - timedelta(days=day.weekday())
+    if self.period >= DAY:
+      return day
+    step = int(self.period.total_seconds())
+    return day + timedelta(seconds=int((stamp - day).total_seconds()) // step * step)
+
+  #----------------------------------------------------------------------
+  def label(self, start):
+    """ Timestamp of the result bar for the interval from <start> """
+    return start + self.period if self.close_label else start
+
+  #----------------------------------------------------------------------
+  def next_start(self, label):
+    """ Returns the first timestamp of base bars after the result bar with <label>. """
+    start = label - self.period if self.close_label else label
+    return start + self.period + self.shift
+
+  #----------------------------------------------------------------------
+  def end(self, label):
+    """ Time when the result bar with <label> is finished """
+    return self.next_start(label) - self.shift
+
+  #----------------------------------------------------------------------
+  def push(self, bar):
+    """ Adds the base bar; returns the previous result bar if it's finished by this one or None. """
+    start = self.bucket(bar.timestamp)
+    self._covered = bar.timestamp if self.shift else bar.timestamp + self.base
+    cur = self.current
+    if cur is not None and start == self._start:
+      cur.high = max(cur.high, bar.high)
+      cur.low = min(cur.low, bar.low)
+      cur.close = bar.close
+      cur.volume = None if cur.volume is None or bar.volume is None else cur.volume + bar.volume
+      cur.interest = bar.interest
+      return None
+    self._start = start
+    self.current = Bar(bar.ticker, self.label(start), self.period,
+                       bar.open, bar.high, bar.low, bar.close, bar.volume, bar.interest)
+    return cur
+
+  #----------------------------------------------------------------------
+  def update(self, bars):
+    """ Adds base bars and yields the finished result bars. """
+    for it in bars:
+      done = self.push(it)
+      if done is not None:
+        yield done
+
+  #----------------------------------------------------------------------
+  def flush(self, until):
+    """
+    Returns the trailing bar (and forgets it) if it's finished by base bars or before <until>;
+    otherwise returns None.
+    """
+    cur = self.current
+    if cur is not None and (self._covered >= self.end(cur.timestamp) or self.end(cur.timestamp) < until):
+      self.current, self._start = None, None
+      return cur
+    return None
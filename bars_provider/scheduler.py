@@ -0,0 +1,163 @@
+"""
+Planning of fetches by the close time of bars.
+"""
+
+from datetime import datetime, time, timedelta
+import heapq
+from itertools import count
+import random
+from time import sleep
+
+from .base import InvalidDataFormatError
+from .log import logger
+
+
+__all__ = ["SessionCalendar", "Scheduler"]
+
+
+DAY = timedelta(days=1)
+WEEK = timedelta(weeks=1)
+
+
+#######################################################################
+class SessionCalendar(object):
+  """
+  Trading days (0 is Monday) and hours of a provider in the local time.
+  A bar is expected if it's opened inside of a session;
+  daily bars are closed at the end of the session, weekly ones at the end of the last day of the week.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, days=(0, 1, 2, 3, 4), start='00:00', end='23:59'):
+    if not days:
+      raise InvalidDataFormatError('DAYS', 'at least one trading day is required')
+    self.days = frozenset(days)
+    self.start = datetime.strptime(start, '%H:%M').time()
+    self.end = datetime.strptime(end, '%H:%M').time()
+
+  #----------------------------------------------------------------------
+  def is_open(self, stamp):
+    return stamp.weekday() in self.days and self.start <= stamp.time() < self.end
+
+  #----------------------------------------------------------------------
+  def next_close(self, after, period):
+    """ Returns the close time of the first <period> bar of a session which is closed after <after>. """
+    if period >= DAY:
+      day = after.date()
+      while True:
+        close = datetime.combine(day, self.end)
+        if close > after and day.weekday() in self.days and \
+           (period < WEEK or day.weekday() == max(self.days)):
+          return close
+        day += DAY
+    step = int(period.total_seconds())
+    midnight = datetime.combine(after.date(), time())
+    close = midnight + timedelta(seconds=(int((after - midnight).total_seconds()) // step + 1) * step)
+    # bars are counted from the midnight, so the loop is bounded by a week
+    while not self.is_open(close - period):
+      close += period
+    return close
+
+
+#######################################################################
+class Scheduler(object):
+  """
+  Plans a fetch of every (provider, symbol) of <period> bars in <delay> seconds
+  (plus random <jitter>) after the close of its next bar in the provider's session.
+  Symbols of a provider which are due are fetched together by run(provider, symbols, workers)
+  and planned again after it; fetches are run one by one, so they never overlap.
+  Providers which can't be made yet are added later by the retry function (see retry()).
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, run, period, calendars=None, delay=60, jitter=30):
+    self.run = run
+    self.period = period
+    self.calendars = calendars or {}  # provider's class name -> SessionCalendar
+    self.delay = timedelta(seconds=delay)
+    self.jitter = jitter
+    self._queue = []  # (due time, order, job index, symbol)
+    self._order = count()
+    self._jobs = []
+    self._retry = None  # [function, interval, max interval, due time]
+
+  #----------------------------------------------------------------------
+  def calendar(self, provider):
+    return self.calendars.get(provider.__class__.__name__) or SessionCalendar(days=range(7))
+
+  #----------------------------------------------------------------------
+  def add(self, provider, symbols, workers=1, due=None):
+    """ Adds symbols of the provider; they are fetched at <due> (now by default) and planned after it. """
+    self._jobs.append((provider, workers))
+    index = len(self._jobs) - 1
+    for symbol in symbols:
+      heapq.heappush(self._queue, (due or datetime.now(), next(self._order), index, symbol))
+
+  #----------------------------------------------------------------------
+  def due(self, provider, after):
+    """ Planned time of the fetch after the next bar close """
+    close = self.calendar(provider).next_close(after, self.period)
+    return close + self.delay + timedelta(seconds=random.uniform(0, self.jitter))
+
+  #----------------------------------------------------------------------
+  def retry(self, fn, interval=60, max_interval=3600):
+    """
+    Calls fn() in <interval> seconds till it returns True (it adds providers which are made by add());
+    the interval is doubled up to <max_interval> after every failure.
+    """
+    self._retry = [fn, interval, max(interval, max_interval), datetime.now() + timedelta(seconds=interval)]
+
+  #----------------------------------------------------------------------
+  def _run_retry(self):
+    fn, interval, max_interval, _ = self._retry
+    done = False
+    try:
+      done = fn()
+    except Exception as e:
+      logger.error('Scheduler: skip error; ({0})'.format(e))
+    if done:
+      self._retry = None
+    else:
+      interval = min(interval * 2, max_interval)
+      self._retry = [fn, interval, max_interval, datetime.now() + timedelta(seconds=interval)]
+
+  #----------------------------------------------------------------------
+  def next_time(self):
+    times = [self._queue[0][0]] if self._queue else []
+    if self._retry is not None:
+      times.append(self._retry[3])
+    return min(times) if times else None
+
+  #----------------------------------------------------------------------
+  def run_pending(self, now=None):
+    """ Fetches all symbols which are due; returns the number of runs. """
+    now = now or datetime.now()
+    if self._retry is not None and self._retry[3] <= now:
+      self._run_retry()
+    batches = {}
+    while self._queue and self._queue[0][0] <= now:
+      _, _, index, symbol = heapq.heappop(self._queue)
+      batches.setdefault(index, []).append(symbol)
+    for index, symbols in sorted(batches.items()):
+      provider, workers = self._jobs[index]
+      try:
+        self.run(provider, symbols, workers)
+      except Exception as e:
+        logger.error('{0}: skip error; ({1})'.format(provider.__class__.__name__, e))
+      # the next bar is planned from the end of this run, so a long run can't repeat itself
+      finished = datetime.now()
+      for symbol in symbols:
+        heapq.heappush(self._queue, (self.due(provider, finished), next(self._order), index, symbol))
+    if batches:
+      logger.info('Next downloading in {0}...'.format(self.next_time()))
+    return len(batches)
+
+  #----------------------------------------------------------------------
+  def run_forever(self):
+    """ Runs fetches while there are symbols or providers which will be retried. """
+    while self._queue or self._retry is not None:
+      delay = (self.next_time() - datetime.now()).total_seconds()
+      if delay > 0:
+        sleep(min(delay, 60))  # clock changes are noticed at least every minute
+      else:
+        self.run_pending()
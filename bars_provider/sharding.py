@@ -0,0 +1,29 @@
+"""
+Splitting of the download work between processes (possibly on several hosts with a shared filesystem).
+"""
+
+import hashlib
+from pathlib import Path
+
+
+__all__ = ["shard_of", "shard_name"]
+
+
+#----------------------------------------------------------------------
+def shard_of(key, shards):
+  """
+  Returns the shard (0 .. shards - 1) of the string <key> by rendezvous hashing:
+  the key belongs to the shard with the highest hash of (key, shard), so when the number of shards
+  is changed only the keys of the added or removed shards are moved.
+  """
+  if shards <= 1:
+    return 0
+  data = key.encode('utf-8')
+  return max(range(shards), key=lambda shard: hashlib.md5(data + b';%d' % shard).digest())
+#----------------------------------------------------------------------
+def shard_name(file_name, shard):
+  """ Adds the shard to the name of the process's own file: 'metrics.prom' -> 'metrics.2.prom' """
+  if shard is None or not file_name:
+    return file_name
+  path = Path(file_name)
+  return str(path.with_name('{0}.{1}{2}'.format(path.stem, shard, path.suffix)))
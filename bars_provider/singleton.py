@@ -0,0 +1,15 @@
+"""
+Metaclass of the objects which are shared by the whole process
+"""
+
+__all__ = ["Singleton"]
+
+
+#######################################################################
+class Singleton(type):
+  _instance = None
+  #----------------------------------------------------------------------
+  def __call__(self, *args, **kw):
+    if not self._instance:
+      self._instance = super(Singleton, self).__call__(*args, **kw)
+    return self._instance
@@ -0,0 +1,299 @@
+"""
+Output files of the downloaded bars.
+"""
+
+from datetime import datetime
+import heapq
+from itertools import islice
+from operator import attrgetter
+import os
+from pathlib import Path
+
+from .base import Bar, BarBlock, Ticker, NONE, from_epoch
+
+
+__all__ = ["TextBarFile", "BarWriter", "TextBarWriter", "format_bars", "format_block", "merge"]
+
+
+# the same line as Bar.__repr__ makes, but without a dict for every bar
+_LINE = '{0};{1};{2};{3};{4};{5};{6};{7};{8}\n'.format
+_FIELDS = attrgetter('timestamp', 'period', 'open', 'high', 'low', 'close', 'volume', 'interest')
+
+
+#----------------------------------------------------------------------
+def format_bars(bars):
+  """ Returns text lines of <bars> as one string. """
+  return ''.join([_LINE(it.ticker.symbol, *_FIELDS(it)) for it in bars])
+#----------------------------------------------------------------------
+def format_block(block):
+  """ Returns text lines of the BarBlock as one string. """
+  symbol, period = block.ticker.symbol, block.period
+  return ''.join([_LINE(symbol, from_epoch(ts), period, o, h, l, c,
+                        None if v == NONE else v, None if oi == NONE else oi)
+                  for ts, o, h, l, c, v, oi in zip(block.timestamp, block.open, block.high, block.low,
+                                                    block.close, block.volume, block.interest)])
+
+
+#----------------------------------------------------------------------
+def merge(store, patch):
+  """
+  Merges bars of the <patch> store into the <store> keeping the time order;
+  bars with the same timestamp are written once (the old one is kept).
+  """
+  tmp = store.__class__(store.path.with_name(store.path.name + '.tmp'))
+  writer = tmp.open(append=False)
+  try:
+    bars = heapq.merge(store.read(), patch.read(), key=lambda it: it.timestamp)
+    cnt = writer.write(_unique(bars))
+  finally:
+    writer.close()
+  store.replace(tmp)
+  return cnt
+#----------------------------------------------------------------------
+def _unique(bars):
+  last = None
+  for it in bars:
+    if it.timestamp != last:
+      last = it.timestamp
+      yield it
+
+
+#######################################################################
+class TextBarFile(object):
+  """
+  Text file with one bar per line in the Bar.__repr__ format.
+  The resume point is read from the tail, so it costs the same for any file size.
+  """
+  BLOCK_SIZE = 8192
+  TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+  #----------------------------------------------------------------------
+  def __init__(self, file_name):
+    self.path = Path(file_name)
+
+  #----------------------------------------------------------------------
+  def exists(self):
+    return self.path.is_file()
+
+  #----------------------------------------------------------------------
+  def _complete_size(self, f):
+    """ Returns the file size without the unfinished last line (it's left by a crash). """
+    f.seek(0, os.SEEK_END)
+    pos = f.tell()
+    while pos > 0:
+      size = min(self.BLOCK_SIZE, pos)
+      f.seek(pos - size)
+      found = f.read(size).rfind(b'\n')
+      if found >= 0:
+        return pos - size + found + 1
+      pos -= size
+    return 0
+
+  #----------------------------------------------------------------------
+  def tail_lines(self):
+    """ Yields the complete lines from the end to the start of the file. """
+    with self.path.open('rb') as f:
+      pos = self._complete_size(f)
+      rest = b''
+      while pos > 0:
+        size = min(self.BLOCK_SIZE, pos)
+        pos -= size
+        f.seek(pos)
+        lines = (f.read(size) + rest).split(b'\n')
+        rest = lines[0]  # can be a part of the line from the previous block
+        for line in reversed(lines[1:]):
+          if line.strip():
+            yield line.decode('utf-8', 'ignore')
+      if rest.strip():
+        yield rest.decode('utf-8', 'ignore')
+
+  #----------------------------------------------------------------------
+  @classmethod
+  def parse_timestamp(cls, line):
+    return datetime.strptime(line.split(';')[1], cls.TIMESTAMP_FORMAT)
+
+  #----------------------------------------------------------------------
+  @classmethod
+  def parse_bar(cls, line, ticker=None):
+    """ Makes Bar from the line; <ticker> is created by the symbol if it's omitted. """
+    symbol, stamp, period, o, h, l, c, v, oi = line.rstrip().split(';')
+    return Bar(ticker or Ticker(None, symbol), datetime.strptime(stamp, cls.TIMESTAMP_FORMAT),
+               Bar.str2timedelta(period), float(o), float(h), float(l), float(c),
+               None if v == 'None' else int(v), None if oi == 'None' else int(oi))
+
+  #----------------------------------------------------------------------
+  def _seek(self, f, start):
+    """ Moves to the first line with the timestamp >= <start> by a binary search over the byte offsets. """
+    def first_stamp(pos):
+      # timestamp of the first line which starts at >= pos
+      f.seek(max(pos - 1, 0))
+      if pos:
+        f.readline()
+      for line in f:
+        try:
+          return self.parse_timestamp(line.decode('utf-8', 'ignore'))
+        except (IndexError, ValueError):
+          continue
+      return None
+
+    lo, hi = 0, self._complete_size(f)
+    while lo < hi:
+      mid = (lo + hi) // 2
+      stamp = first_stamp(mid)
+      if stamp is None or stamp >= start:
+        hi = mid
+      else:
+        lo = mid + 1
+    f.seek(max(lo - 1, 0))
+    if lo:
+      f.readline()
+
+  #----------------------------------------------------------------------
+  def read(self, start=None, ticker=None):
+    """ Yields bars from <start> (or from the beginning) to the end of the file. """
+    if not self.exists():
+      return
+    with self.path.open('rb') as f:
+      end = self._complete_size(f)
+      if start is not None:
+        self._seek(f, start)
+      else:
+        f.seek(0)
+      while f.tell() < end:
+        line = f.readline().decode('utf-8', 'ignore')
+        if line.strip():
+          bar = self.parse_bar(line, ticker)
+          ticker = ticker or bar.ticker  # all bars share one ticker
+          yield bar
+
+  #----------------------------------------------------------------------
+  def tail(self, count, ticker=None):
+    """ Returns the last <count> bars as BarBlock; only the tail of the file is read. """
+    bars = []
+    if self.exists():
+      for line in self.tail_lines():
+        if len(bars) >= count:
+          break
+        bar = self.parse_bar(line, ticker)
+        ticker = ticker or bar.ticker
+        bars.append(bar)
+    return BarBlock.from_bars(reversed(bars), ticker)
+
+  #----------------------------------------------------------------------
+  def last_timestamp(self):
+    """ Returns the timestamp of the last valid bar or None for an empty file. """
+    if not self.exists():
+      return None
+    for line in self.tail_lines():
+      try:
+        return self.parse_timestamp(line)
+      except (IndexError, ValueError):
+        continue  # broken line, try the previous one
+    return None
+
+  #----------------------------------------------------------------------
+  def repair(self):
+    """ Cuts the unfinished last line off; returns the number of removed bytes. """
+    with self.path.open('r+b') as f:
+      size = f.seek(0, os.SEEK_END)
+      complete = self._complete_size(f)
+      if complete < size:
+        f.truncate(complete)
+    return size - complete
+
+  #----------------------------------------------------------------------
+  def open(self, append):
+    """ Opens the file for writing; the appended file is repaired before. """
+    if append and self.exists():
+      self.repair()
+      return TextBarWriter(self.path, append=True)
+    return TextBarWriter(self.path, append=False)
+
+  #----------------------------------------------------------------------
+  def replace(self, other):
+    """ Moves the file of the <other> store over this one. """
+    os.replace(str(other.path), str(self.path))
+
+  #----------------------------------------------------------------------
+  def remove(self):
+    self.path.unlink()
+
+
+#######################################################################
+class BarWriter(object):
+  """
+  Appends bars to the file by batches of serialized bars in large buffered blocks.
+  Bars since the last commit() can be thrown away by rollback(), so a failed chunk
+  doesn't leave its part in the file; a crash can leave only an unfinished tail
+  which is cut off by the store's repair() on the next opening.
+  Derived writers define serialize(bars) -> bytes and can define serialize_block(block) -> bytes.
+  """
+  BATCH = 4096  # bars serialized at once
+  BUFFER_SIZE = 1024 * 1024
+
+  #----------------------------------------------------------------------
+  def __init__(self, path, append):
+    self.f = open(str(path), 'ab' if append else 'wb', buffering=self.BUFFER_SIZE)
+    self.committed = self.f.tell()
+
+  #----------------------------------------------------------------------
+  def serialize(self, bars):
+    raise NotImplementedError
+
+  #----------------------------------------------------------------------
+  def write(self, bars):
+    """ Writes bars and returns their count. """
+    cnt = 0
+    bars = iter(bars)
+    while True:
+      batch = list(islice(bars, self.BATCH))
+      if not batch:
+        return cnt
+      self.f.write(self.serialize(batch))
+      cnt += len(batch)
+
+  #----------------------------------------------------------------------
+  def serialize_block(self, block):
+    return self.serialize(list(block))
+
+  #----------------------------------------------------------------------
+  def write_blocks(self, blocks):
+    """ Writes BarBlock iterable and returns the count of bars. """
+    cnt = 0
+    for block in blocks:
+      if len(block):
+        self.f.write(self.serialize_block(block))
+        cnt += len(block)
+    return cnt
+
+  #----------------------------------------------------------------------
+  def commit(self, sync=False):
+    """ Makes written bars permanent (on the disk if <sync>), e.g. at the end of the chunk. """
+    self.f.flush()
+    if sync:
+      os.fsync(self.f.fileno())
+    self.committed = self.f.tell()
+
+  #----------------------------------------------------------------------
+  def rollback(self):
+    """ Removes bars written after the last commit. """
+    self.f.flush()
+    self.f.truncate(self.committed)
+    self.f.seek(self.committed)
+
+  #----------------------------------------------------------------------
+  def close(self):
+    self.f.close()
+
+
+#######################################################################
+class TextBarWriter(BarWriter):
+  """ Appends bars as text lines. """
+
+  #----------------------------------------------------------------------
+  def serialize(self, bars):
+    return format_bars(bars).encode('utf-8')
+
+  #----------------------------------------------------------------------
+  def serialize_block(self, block):
+    return format_block(block).encode('utf-8')
@@ -0,0 +1,3 @@
+"""
+Benchmarks of the download pipeline against a local stand-in of the providers.
+"""
@@ -0,0 +1,230 @@
+"""
+Local stand-in of finam.ru and quotemedia.com for benchmarks.
+It serves a synthetic symbols dictionary (icharts.js) and bars in the formats of both providers.
+
+Standalone:  python -m benchmarks.mockserver --port 8080 --rows 50000 --latency 0.05 --error-rate 0.01
+"""
+
+import argparse
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from pathlib import Path
+import random
+from socketserver import ThreadingMixIn
+import subprocess
+import sys
+import threading
+from time import sleep
+from urllib.parse import urlsplit, parse_qs
+from urllib.request import urlopen
+
+
+__all__ = ["MockServer", "make_symbols_js", "finam_lines", "quotemedia_lines"]
+
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# Finam's period codes (p=) in minutes
+FINAM_PERIODS = {2: 1, 3: 5, 4: 10, 5: 15, 6: 30, 7: 60, 8: 1440, 9: 10080}
+QUOTEMEDIA_HEADER = 'date,open,high,low,close,volume,changed,changep,adjclose,tradeval,tradevol'
+
+
+#----------------------------------------------------------------------
+def symbol_code(i):
+  return 'SYM{0:04d}'.format(i)
+#----------------------------------------------------------------------
+def make_symbols_js(count):
+  """ Text of icharts.js with <count> symbols on 5 markets """
+  ids = ','.join(str(1000 + i) for i in range(count))
+  names = ','.join("'Name {0}'".format(i) for i in range(count))
+  codes = ','.join("'{0}'".format(symbol_code(i)) for i in range(count))
+  markets = ','.join(str(i % 5 + 1) for i in range(count))
+  # without the closing ';' as FinamSymbols._parsetuple() expects it
+  return ('var aEmitentIds = new Array({0})\n'
+          'var aEmitentNames = new Array({1})\n'
+          'var aEmitentCodes = new Array({2})\n'
+          'var aEmitentMarkets = new Array({3})\n').format(ids, names, codes, markets)
+#----------------------------------------------------------------------
+def _prices(seed, n):
+  """ Deterministic random walk of (open, high, low, close, volume) """
+  rnd = random.Random(seed)
+  price = 100.0 + rnd.random() * 100
+  for _ in range(n):
+    close = max(price + rnd.uniform(-1, 1), 1.0)
+    yield price, max(price, close) + 0.5, min(price, close) - 0.5, close, rnd.randint(1, 10000)
+    price = close
+#----------------------------------------------------------------------
+def _stamps(start, end, period, limit=None):
+  """ Opens of bars between <start> and <end> on working days """
+  result = []
+  stamp = start
+  while stamp < end and (limit is None or len(result) < limit):
+    if stamp.weekday() < 5:
+      result.append(stamp)
+    stamp += period
+  return result
+#----------------------------------------------------------------------
+def finam_lines(symbol, start, end, period, limit=None):
+  """ 'DATE;TIME;OPEN;HIGH;LOW;CLOSE;VOL' lines of <period> bars; Finam cuts the answer by <limit> rows """
+  stamps = _stamps(start, end, period, limit)
+  return ['{0:%Y%m%d;%H%M%S};{1:.2f};{2:.2f};{3:.2f};{4:.2f};{5}'.format(stamp + period, *bar)
+          for stamp, bar in zip(stamps, _prices(symbol, len(stamps)))]
+#----------------------------------------------------------------------
+def quotemedia_lines(symbol, start, end):
+  """ Daily lines from the newest with the header as quotemedia.com sends them """
+  stamps = _stamps(start, end, timedelta(days=1))
+  lines = ['{0:%Y-%m-%d},{1:.2f},{2:.2f},{3:.2f},{4:.2f},{5},0,0,{4:.2f},0,{5}'.format(stamp, *bar)
+           for stamp, bar in zip(stamps, _prices(symbol, len(stamps)))]
+  lines.append(QUOTEMEDIA_HEADER)
+  lines.reverse()
+  return lines
+
+
+#######################################################################
+class _Server(ThreadingMixIn, HTTPServer):
+  """ http.server.ThreadingHTTPServer of Python 3.7 """
+  daemon_threads = True
+
+
+#######################################################################
+class _Handler(BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+
+  #----------------------------------------------------------------------
+  def do_GET(self):
+    srv = self.server
+    url = urlsplit(self.path)
+    query = {k: v[0] for k, v in parse_qs(url.query).items()}
+    with srv.lock:
+      srv.stats['requests'] += 1
+      failed = srv.error_rate > 0 and srv.random.random() < srv.error_rate
+    if srv.latency > 0:
+      sleep(srv.latency)
+    if failed:
+      with srv.lock:
+        srv.stats['errors'] += 1
+      return self._send(503, b'', [('Retry-After', '0')])
+    if url.path.endswith('.js'):
+      body = srv.symbols_js
+    elif url.path == '/stats':
+      with srv.lock:
+        body = json.dumps(srv.stats).encode()
+    elif url.path.endswith('getHistoryDownload.csv'):
+      start = datetime(int(query['startYear']), int(query['startMonth']) + 1, int(query['startDay']))
+      end = datetime(int(query['endYear']), int(query['endMonth']) + 1, int(query['endDay'])) + timedelta(days=1)
+      body = ('\n'.join(quotemedia_lines(query['symbol'], start, end)) + '\n').encode()
+    elif url.path.endswith('.csv'):
+      start = datetime(int(query['yf']), int(query['mf']) + 1, int(query['df']))
+      end = datetime(int(query['yt']), int(query['mt']) + 1, int(query['dt'])) + timedelta(days=1)
+      period = timedelta(minutes=FINAM_PERIODS[int(query['p'])])
+      body = ''.join(line + '\r\n' for line in finam_lines(query['cn'], start, end, period, srv.rows)).encode()
+    else:
+      return self._send(404, b'')
+    with srv.lock:
+      srv.stats['bytes'] += len(body)
+    self._send(200, body)
+
+  #----------------------------------------------------------------------
+  def _send(self, status, body, headers=()):
+    self.send_response(status)
+    for name, value in headers:
+      self.send_header(name, value)
+    self.send_header('Content-Length', str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  #----------------------------------------------------------------------
+  def log_message(self, *args):
+    pass
+
+
+#----------------------------------------------------------------------
+def make_server(port=0, symbols=100, rows=None, latency=0.0, error_rate=0.0, seed=0):
+  """ HTTP server of the stand-in: <rows> is the limit of rows per answer, <latency> is seconds before it """
+  srv = _Server(('127.0.0.1', port), _Handler)
+  srv.symbols_js = make_symbols_js(symbols).encode()
+  srv.rows, srv.latency, srv.error_rate = rows, latency, error_rate
+  srv.random = random.Random(seed)
+  srv.lock = threading.Lock()
+  srv.stats = dict(requests=0, errors=0, bytes=0)
+  return srv
+
+
+#######################################################################
+class MockServer(object):
+  """
+  The stand-in in a child process, so its work isn't measured with the benchmarked code.
+  point() redirects the providers to it.
+  """
+
+  #----------------------------------------------------------------------
+  def __init__(self, symbols=100, rows=None, latency=0.0, error_rate=0.0, seed=0):
+    self.args = ['--symbols', str(symbols), '--latency', str(latency), '--error-rate', str(error_rate), '--seed', str(seed)]
+    if rows:
+      self.args += ['--rows', str(rows)]
+    self.url = None
+    self._process = None
+
+  #----------------------------------------------------------------------
+  def start(self):
+    self._process = subprocess.Popen([sys.executable, '-m', 'benchmarks.mockserver', '--port', '0'] + self.args,
+                                     stdout=subprocess.PIPE, universal_newlines=True, cwd=str(ROOT))
+    self.url = self._process.stdout.readline().strip()
+    if not self.url:
+      raise RuntimeError('mock server is not started')
+    return self.url
+
+  #----------------------------------------------------------------------
+  def stop(self):
+    if self._process is not None:
+      self._process.terminate()
+      self._process.wait()
+      self._process = None
+
+  #----------------------------------------------------------------------
+  def stats(self):
+    """ Counters of requests, errors and bytes of the server """
+    with urlopen(self.url + '/stats') as response:
+      return json.loads(response.read().decode())
+
+  #----------------------------------------------------------------------
+  def point(self):
+    """ Redirects class-level URLs of the providers to the server. """
+    from bars_provider.finam import FinamSymbols, FinamProvider
+    from bars_provider.quotemedia import QuotemediaProvider
+    FinamSymbols.URL = self.url + '/cache/icharts/icharts.js'
+    FinamProvider.URL = self.url + '/'
+    QuotemediaProvider.URL = self.url + '/quotetools/getHistoryDownload.csv'
+
+  #----------------------------------------------------------------------
+  def __enter__(self):
+    self.start()
+    self.point()
+    return self
+
+  #----------------------------------------------------------------------
+  def __exit__(self, exc_type, exc_val, exc_tb):
+    self.stop()
+
+
+#----------------------------------------------------------------------
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+  parser.add_argument('--port', type=int, default=8080)
+  parser.add_argument('--symbols', type=int, default=100, help='symbols in icharts.js')
+  parser.add_argument('--rows', type=int, default=None, help='limit of rows per answer')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds before an answer')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='part of answers with 503')
+  parser.add_argument('--seed', type=int, default=0)
+  args = parser.parse_args()
+  srv = make_server(args.port, args.symbols, args.rows, args.latency, args.error_rate, args.seed)
+  print('http://127.0.0.1:{0}'.format(srv.server_port), flush=True)
+  try:
+    srv.serve_forever()
+  except KeyboardInterrupt:
+    pass
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,280 @@
+"""
+Benchmarks of the download pipeline against the local stand-in of the providers.
+Results are saved as JSON and can be compared with the results of another version:
+
+  python -m benchmarks.run --output new.json
+  python -m benchmarks.run --output new.json --compare old.json --threshold 0.1
+
+The exit code is 1 if a benchmark is slower than in <compare> more than <threshold>.
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import logging
+import os
+from pathlib import Path
+import platform
+import statistics
+import sys
+import tempfile
+from time import perf_counter
+
+from bars_provider import __version__
+from bars_provider.base import Ticker
+from bars_provider.binstore import BinaryBarWriter
+from bars_provider.downloads import Downloads
+from bars_provider.finam import FinamProvider
+from bars_provider.gzstore import GzipBarWriter
+from bars_provider.log import logger
+from bars_provider.quotemedia import QuotemediaProvider
+from bars_provider.storage import TextBarWriter
+
+from .mockserver import MockServer, finam_lines, quotemedia_lines, symbol_code
+
+
+START = datetime(2020, 1, 1)
+
+
+#----------------------------------------------------------------------
+def _finam_ticker(i=0):
+  return Ticker(FinamProvider(cache_file=''), symbol_code(i), market=str(i % 5 + 1), id=str(1000 + i))
+#----------------------------------------------------------------------
+def _period_rows(rows, period):
+  """ End of the range which has <rows> bars on working days """
+  return START + period * (rows * 7 // 5 + 1)
+#----------------------------------------------------------------------
+def bench_parse_finam(args):
+  """ FinamProvider._generator over minute lines """
+  period = timedelta(minutes=1)
+  end = _period_rows(args.rows, period)
+  lines = finam_lines('X', START, end, period, args.rows)
+  ticker = _finam_ticker()
+
+  def run():
+    return dict(rows=sum(len(block) for block in ticker.provider._generator(ticker, lines, START, end, period)))
+  return run
+#----------------------------------------------------------------------
+def bench_parse_quotemedia(args):
+  """ QuotemediaProvider._generator over daily lines from the newest """
+  period = timedelta(days=1)
+  end = _period_rows(args.rows, period)
+  lines = quotemedia_lines('X', START, end)
+  provider = QuotemediaProvider()
+  ticker = Ticker(provider, 'x')
+
+  def run():
+    return dict(rows=sum(len(block) for block in provider._generator(ticker, lines, START, end, period)))
+  return run
+#----------------------------------------------------------------------
+def _blocks(rows):
+  period = timedelta(minutes=1)
+  end = _period_rows(rows, period)
+  ticker = _finam_ticker()
+  return list(ticker.provider._generator(ticker, finam_lines('X', START, end, period, rows), START, end, period))
+#----------------------------------------------------------------------
+def _bench_writer(args, write):
+  path = Path(args.workdir) / 'serialize.out'
+
+  def run():
+    written = write(path)
+    return dict(rows=written, bytes=path.stat().st_size)
+  return run
+#----------------------------------------------------------------------
+def bench_serialize_repr(args):
+  """ Bar.__repr__ lines, the way of the old versions """
+  bars = [bar for block in _blocks(args.rows) for bar in block.bars()]
+
+  def write(path):
+    with open(str(path), 'w') as f:
+      f.write(''.join([repr(bar) + '\n' for bar in bars]))
+    return len(bars)
+  return _bench_writer(args, write)
+#----------------------------------------------------------------------
+def bench_serialize_bars(args):
+  """ TextBarWriter.write() of Bar objects """
+  bars = [bar for block in _blocks(args.rows) for bar in block.bars()]
+
+  def write(path):
+    writer = TextBarWriter(path, append=False)
+    try:
+      return writer.write(bars)
+    finally:
+      writer.close()
+  return _bench_writer(args, write)
+#----------------------------------------------------------------------
+def _bench_write_blocks(args, cls):
+  blocks = _blocks(args.rows)
+
+  def write(path):
+    writer = cls(path, append=False)
+    try:
+      return writer.write_blocks(blocks)
+    finally:
+      writer.close()
+  return _bench_writer(args, write)
+#----------------------------------------------------------------------
+def bench_serialize_blocks(args):
+  """ TextBarWriter.write_blocks() of BarBlock """
+  return _bench_write_blocks(args, TextBarWriter)
+#----------------------------------------------------------------------
+def bench_serialize_binary(args):
+  """ BinaryBarWriter.write_blocks() of BarBlock """
+  return _bench_write_blocks(args, BinaryBarWriter)
+#----------------------------------------------------------------------
+def bench_serialize_gzip(args):
+  """ GzipBarWriter.write_blocks() of BarBlock """
+  return _bench_write_blocks(args, GzipBarWriter)
+#----------------------------------------------------------------------
+def bench_find(args):
+  """ FinamProvider.find() of every symbol of the dictionary """
+  provider = FinamProvider(cache_file='')
+  queries = [symbol_code(i).lower() for i in range(args.symbols)]
+
+  def run():
+    return dict(rows=sum(len(provider.find(query)) for query in queries))
+  return run
+#----------------------------------------------------------------------
+def bench_ticker_getattr(args):
+  """ Ticker.get_blocks/get_bars lookups delegated to the provider """
+  tickers = [_finam_ticker(i) for i in range(100)]
+
+  def run():
+    for _ in range(args.rows // 200):
+      for ticker in tickers:
+        ticker.get_blocks
+        ticker.get_bars
+    return dict(rows=args.rows // 200 * len(tickers) * 2)
+  return run
+#----------------------------------------------------------------------
+def _bench_download(args, is_async):
+  config = dict(all=dict(TIMEOUT=0, TIMEFRAME=str(args.timeframe), CHUNK_IN_DAYS=args.chunk_days,
+                         DATETIME_START=START.strftime('%Y%m%d%H%M'),
+                         DATETIME_END=(START + timedelta(days=args.days)).strftime('%Y%m%d%H%M'),
+                         APPEND_DATA='no', FORMAT=args.format, WORKERS=args.workers,
+                         ASYNC='yes' if is_async else 'no', LOCK_FILE='bars_downloader.lock',
+                         HTTP=dict(POOL_SIZE=args.workers, RETRIES=3, BACKOFF_FACTOR=0.01, RATE=10000, BURST=100)),
+                resources={'bars_provider.finam': {'FinamProvider': [symbol_code(i) for i in range(args.download_symbols)]},
+                           'bars_provider.quotemedia': {'QuotemediaProvider': ['q{0}'.format(i) for i in range(args.download_symbols)]}},
+                providers={'FinamProvider': {'cache_file': ''}})
+  directory = Path(args.workdir) / ('download_async' if is_async else 'download')
+  directory.mkdir(exist_ok=True)
+  with open(str(directory / 'config.json'), 'w') as f:
+    json.dump(config, f)
+
+  def run():
+    cwd = os.getcwd()
+    os.chdir(str(directory))
+    try:
+      requests = args.server.stats()['requests']
+      downloads = Downloads('config.json')
+      if is_async:
+        downloads.download_async()
+      else:
+        downloads.download()
+    finally:
+      os.chdir(cwd)
+    files = [it for it in directory.iterdir() if it.name.endswith(('.txt', '.bin', '.txt.gz'))]
+    rows = 0
+    if args.format == 'txt':
+      for it in files:
+        with it.open('rb') as f:
+          rows += sum(1 for _ in f)
+    return dict(rows=rows or None, bytes=sum(it.stat().st_size for it in files),
+                requests=args.server.stats()['requests'] - requests - 1)
+  return run
+#----------------------------------------------------------------------
+def bench_download(args):
+  """ End-to-end Downloads.download() of both providers """
+  return _bench_download(args, False)
+#----------------------------------------------------------------------
+def bench_download_async(args):
+  """ End-to-end Downloads.download_async() of both providers """
+  return _bench_download(args, True)
+
+
+BENCHMARKS = dict((name[len('bench_'):], fn) for name, fn in sorted(globals().items()) if name.startswith('bench_'))
+
+
+#----------------------------------------------------------------------
+def measure(fn, repeat):
+  """ Runs <fn> <repeat> times; returns timings and counters of the last run. """
+  times = []
+  counters = {}
+  for _ in range(repeat):
+    started = perf_counter()
+    counters = fn()
+    times.append(perf_counter() - started)
+  result = dict(best=min(times), median=statistics.median(times), runs=[round(it, 6) for it in times])
+  result.update((k, v) for k, v in counters.items() if v is not None)
+  if counters.get('rows'):
+    result['rows_per_sec'] = round(counters['rows'] / result['best'])
+  result['best'], result['median'] = round(result['best'], 6), round(result['median'], 6)
+  return result
+#----------------------------------------------------------------------
+def compare(results, baseline, threshold):
+  """ Prints the ratio of the best times to <baseline>; returns names of the slower benchmarks. """
+  slower = []
+  for name, result in sorted(results['results'].items()):
+    old = baseline['results'].get(name)
+    if not old or not old.get('best'):
+      continue
+    ratio = result['best'] / old['best']
+    mark = ''
+    if ratio > 1 + threshold:
+      mark = '  <- slower'
+      slower.append(name)
+    print('{0:24} {1:10.4f}s {2:10.4f}s {3:7.2f}x{4}'.format(name, old['best'], result['best'], ratio, mark))
+  return slower
+#----------------------------------------------------------------------
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='Benchmarks of bars_provider with a local stand-in of the providers.')
+  parser.add_argument('names', nargs='*', help='benchmarks to run: {0} (all by default)'.format(', '.join(BENCHMARKS)))
+  parser.add_argument('--output', help='JSON file of results')
+  parser.add_argument('--compare', help='JSON file of results to compare with')
+  parser.add_argument('--threshold', type=float, default=0.1, help='allowed slowdown against --compare')
+  parser.add_argument('--repeat', type=int, default=3)
+  parser.add_argument('--rows', type=int, default=100000, help='bars of the parse and serialize benchmarks')
+  parser.add_argument('--symbols', type=int, default=5000, help='symbols in the dictionary')
+  parser.add_argument('--download-symbols', type=int, default=4, help='symbols of every provider to download')
+  parser.add_argument('--days', type=int, default=60, help='days to download')
+  parser.add_argument('--timeframe', default='1')
+  parser.add_argument('--chunk-days', type=int, default=10)
+  parser.add_argument('--format', default='txt')
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--max-rows', type=int, default=None, help='limit of rows per answer of the server')
+  parser.add_argument('--latency', type=float, default=0.0, help='seconds before an answer of the server')
+  parser.add_argument('--error-rate', type=float, default=0.0, help='part of answers with 503')
+  args = parser.parse_args(argv)
+  names = args.names or list(BENCHMARKS)
+  unknown = set(names) - set(BENCHMARKS)
+  if unknown:
+    parser.error('unknown benchmarks: {0}'.format(', '.join(sorted(unknown))))
+  logger.setLevel(logging.WARNING)
+
+  results = dict(version=__version__, python=platform.python_version(), platform=platform.platform(),
+                 created=datetime.now().isoformat(timespec='seconds'),
+                 params={k: v for k, v in vars(args).items() if k not in ('names', 'output', 'compare')},
+                 results={})
+  with MockServer(args.symbols, args.max_rows, args.latency, args.error_rate) as server, \
+       tempfile.TemporaryDirectory() as workdir:
+    args.server, args.workdir = server, workdir
+    for name in names:
+      results['results'][name] = measure(BENCHMARKS[name](args), args.repeat)
+      print('{0:24} {1:10.4f}s  {2}'.format(name, results['results'][name]['best'],
+                                            ', '.join('{0}: {1}'.format(k, v) for k, v in results['results'][name].items()
+                                                      if k not in ('best', 'median', 'runs'))), flush=True)
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(results, f, indent=2)
+  if args.compare:
+    with open(args.compare) as f:
+      baseline = json.load(f)
+    print()
+    if compare(results, baseline, args.threshold):
+      return 1
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())